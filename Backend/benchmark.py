@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Load test / benchmark for the backend, the big brother of test_concurrent.py.
+
+Runs each scenario at each concurrency level against a running server and
+reports latency percentiles (p50/p95/p99), throughput and error counts:
+
+    upload      POST /process-document/        (docling + metadata + extraction + save)
+    stream      POST /process-document/stream/ (same, timed per stage from the SSE events)
+    inference   POST /inference-document/
+    try_prompt  POST /try-prompt/
+    listing     GET  /documents/?limit=50
+
+For repeatable numbers run the server against fake_oci_server.py so OCI
+latency is fixed rather than whatever the region does today:
+
+    python fake_oci_server.py --latency-ms 800 --output-tokens 300 &
+    OCI_GENAI_ENDPOINT=http://127.0.0.1:8090 ./start_server.sh
+    python benchmark.py --concurrency 1 4 16 --requests 32 --output bench_results/after.json
+    python benchmark.py ... --compare bench_results/before.json
+
+The corpus is every PDF in --corpus; when the directory is empty, --make-corpus
+N small text PDFs (different content each, so the docling cache sees distinct
+files) are generated into it. Results are written as JSON tagged with the git
+commit so runs on different commits can be compared with --compare.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import subprocess
+import statistics
+import concurrent.futures
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+
+BASE_URL = "http://localhost:8080"
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CORPUS = os.path.join(HERE, "bench_corpus")
+DEFAULT_SCHEMA = os.path.join(HERE, "test.json")
+SCENARIOS = ["upload", "stream", "inference", "try_prompt", "listing"]
+
+
+# === Fixture corpus ===
+def _pdf_text(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_fixture_pdf(path: str, lines: List[str]) -> None:
+    """Write a one-page PDF with a text layer (Helvetica, one line per entry)."""
+    stream = ["BT", "/F1 10 Tf", "14 TL", "50 800 Td"]
+    for line in lines:
+        stream.append(f"({_pdf_text(line)}) Tj T*")
+    stream.append("ET")
+    content = "\n".join(stream).encode("latin-1", "replace")
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+        b"/Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Length " + str(len(content)).encode() + b" >>\nstream\n" + content + b"\nendstream",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def make_corpus(directory: str, count: int, seed: int = 7) -> List[str]:
+    """Generate `count` purchase-order style PDFs into directory."""
+    rng = random.Random(seed)
+    clients = ["Acme Industrial", "Northwind Traders", "Globex Corporation", "Initech Supplies"]
+    products = ["Steel bolts", "Copper wire", "Hydraulic pump", "Safety gloves", "LED panel", "Pallet wrap"]
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for index in range(count):
+        client = clients[index % len(clients)]
+        lines = [
+            f"PURCHASE ORDER PO-{10000 + index}",
+            f"Client: {client}",
+            f"Date: 2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            f"Email: orders@{client.split()[0].lower()}.example.com",
+            "",
+            "Item    Description    Quantity    Price",
+        ]
+        for line_no in range(rng.randint(5, 25)):
+            lines.append(
+                f"{line_no + 1}    {rng.choice(products)}    {rng.randint(1, 500)}    {rng.uniform(1, 900):.2f}"
+            )
+        lines += ["", f"Total: {rng.uniform(1000, 90000):.2f} EUR"]
+        path = os.path.join(directory, f"fixture_{index:03d}.pdf")
+        make_fixture_pdf(path, lines)
+        paths.append(path)
+    return paths
+
+
+def load_corpus(directory: str, make: int) -> List[str]:
+    paths = sorted(
+        os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(".pdf")
+    ) if os.path.isdir(directory) else []
+    if not paths and make:
+        paths = make_corpus(directory, make)
+    if not paths:
+        sys.exit(f"No PDFs in {directory} (use --make-corpus N to generate fixtures)")
+    return paths
+
+
+# === Requests (each returns a dict with at least ok/elapsed) ===
+def _json_result(response: requests.Response) -> Dict[str, Any]:
+    """ok/error of a JSON endpoint; non-2xx and non-JSON answers are reported as HTTP errors."""
+    if not response.ok:
+        return {"ok": False, "error": f"HTTP {response.status_code}: {response.text[:200]}"}
+    try:
+        body = response.json()
+    except ValueError:
+        return {"ok": False, "error": f"HTTP {response.status_code}: not JSON: {response.text[:200]}"}
+    if not isinstance(body, dict):
+        return {"ok": False, "error": f"HTTP {response.status_code}: unexpected body: {response.text[:200]}"}
+    return {"ok": body.get("status") == "success", "error": body.get("message")}
+
+
+def _upload(session: requests.Session, path: str, schema_json: str, use_cache: bool, endpoint: str) -> Dict[str, Any]:
+    with open(path, "rb") as f:
+        response = session.post(
+            f"{BASE_URL}{endpoint}",
+            files={"file": (os.path.basename(path), f, "application/pdf")},
+            data={"schema_json": schema_json, "use_cache": str(use_cache).lower()},
+            timeout=600,
+        )
+    return _json_result(response)
+
+
+def _stream_upload(session: requests.Session, path: str, schema_json: str, use_cache: bool) -> Dict[str, Any]:
+    """POST /process-document/stream/ and time each SSE event relative to the request start."""
+    start = time.perf_counter()
+    marks: Dict[str, float] = {}
+    ok, error = False, None
+    with open(path, "rb") as f:
+        response = session.post(
+            f"{BASE_URL}/process-document/stream/",
+            files={"file": (os.path.basename(path), f, "application/pdf")},
+            data={"schema_json": schema_json, "use_cache": str(use_cache).lower()},
+            stream=True,
+            timeout=600,
+        )
+    if not response.ok:
+        error = f"HTTP {response.status_code}: {response.text[:200]}"
+        response.close()
+        return {"ok": False, "error": error, "stages": {}}
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event:"):
+            event = line.split(":", 1)[1].strip()
+        elif line.startswith("data:") and event:
+            now = time.perf_counter() - start
+            if event == "stage":
+                marks.setdefault(json.loads(line[5:]).get("stage"), now)
+            elif event == "token":
+                marks.setdefault("first_token", now)
+            elif event == "result":
+                ok = True
+                marks["done"] = now
+            elif event == "error":
+                error = json.loads(line[5:]).get("message")
+                marks["done"] = now
+    response.close()
+    if not ok and error is None:
+        # e.g. a JSON error answer instead of an event stream
+        error = "stream ended without a result event"
+
+    # Stage duration = time until the next stage started
+    order = [name for name in ("docling", "metadata", "extraction", "saving", "done") if name in marks]
+    stages = {name: marks[nxt] - marks[name] for name, nxt in zip(order, order[1:])}
+    if "first_token" in marks and "extraction" in marks:
+        stages["time_to_first_token"] = marks["first_token"] - marks["extraction"]
+    return {"ok": ok, "error": error, "stages": stages}
+
+
+def _try_prompt(session: requests.Session, path: str, schema_json: str, use_cache: bool) -> Dict[str, Any]:
+    response = session.post(
+        f"{BASE_URL}/try-prompt/",
+        json={
+            "document": f"Purchase order from {os.path.basename(path)} with a table of items",
+            "user_prompt": "Extract every line item; use ISO dates.",
+            "schema_json": schema_json,
+            "use_cache": use_cache,
+        },
+        timeout=600,
+    )
+    return _json_result(response)
+
+
+def _listing(session: requests.Session, path: str, schema_json: str, use_cache: bool) -> Dict[str, Any]:
+    response = session.get(f"{BASE_URL}/documents/", params={"limit": 50}, timeout=600)
+    return _json_result(response)
+
+
+RUNNERS: Dict[str, Callable[..., Dict[str, Any]]] = {
+    "upload": lambda s, p, sj, uc: _upload(s, p, sj, uc, "/process-document/"),
+    "stream": _stream_upload,
+    "inference": lambda s, p, sj, uc: _upload(s, p, sj, uc, "/inference-document/"),
+    "try_prompt": _try_prompt,
+    "listing": _listing,
+}
+
+
+# === Measurement ===
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an unsorted list (0.0 for an empty one)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    return {
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "mean": statistics.fmean(latencies) if latencies else 0.0,
+        "max": max(latencies, default=0.0),
+    }
+
+
+def run_level(scenario: str, concurrency: int, total: int, corpus: List[str], schema_json: str, use_cache: bool) -> Dict[str, Any]:
+    runner = RUNNERS[scenario]
+    sessions = [requests.Session() for _ in range(concurrency)]
+
+    def _one(index: int) -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            result = runner(sessions[index % concurrency], corpus[index % len(corpus)], schema_json, use_cache)
+        except Exception as e:
+            result = {"ok": False, "error": str(e)}
+        result["elapsed"] = time.perf_counter() - start
+        return result
+
+    wall_start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(_one, range(total)))
+    wall = time.perf_counter() - wall_start
+    for session in sessions:
+        session.close()
+
+    ok = [r for r in results if r["ok"]]
+    level = {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": total - len(ok),
+        "wall_seconds": wall,
+        "throughput_rps": len(ok) / wall if wall else 0.0,
+        "latency": summarize([r["elapsed"] for r in ok]),
+    }
+    errors = sorted({str(r.get("error")) for r in results if not r["ok"]})
+    if errors:
+        level["error_samples"] = errors[:5]
+    stage_names = sorted({name for r in ok for name in r.get("stages", {})})
+    if stage_names:
+        level["stages"] = {
+            name: summarize([r["stages"][name] for r in ok if name in r.get("stages", {})]) for name in stage_names
+        }
+    return level
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, text=True).strip()
+    except Exception:
+        return None
+
+
+def print_level(scenario: str, level: Dict[str, Any]) -> None:
+    lat = level["latency"]
+    print(
+        f"{scenario:<11} c={level['concurrency']:<3} n={level['requests']:<4} err={level['errors']:<3} "
+        f"{level['throughput_rps']:7.2f} req/s  p50={lat['p50']:.3f}s p95={lat['p95']:.3f}s p99={lat['p99']:.3f}s"
+    )
+    for name, stage in level.get("stages", {}).items():
+        print(f"{'':<14}{name:<20} p50={stage['p50']:.3f}s p95={stage['p95']:.3f}s")
+    for error in level.get("error_samples", []):
+        print(f"{'':<14}error: {error[:160]}")
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    """Print p50/p95/throughput changes against a previous results file."""
+    print(f"\nCompared with {baseline.get('commit')} ({baseline.get('timestamp')}):")
+
+    def _delta(new: float, old: float) -> str:
+        return f"{(new - old) / old * 100:+6.1f}%" if old else "    n/a"
+
+    for scenario, levels in current["scenarios"].items():
+        old_levels = {level["concurrency"]: level for level in baseline.get("scenarios", {}).get(scenario, [])}
+        for level in levels:
+            old = old_levels.get(level["concurrency"])
+            if old is None:
+                continue
+            print(
+                f"{scenario:<11} c={level['concurrency']:<3} "
+                f"p50 {_delta(level['latency']['p50'], old['latency']['p50'])}  "
+                f"p95 {_delta(level['latency']['p95'], old['latency']['p95'])}  "
+                f"throughput {_delta(level['throughput_rps'], old['throughput_rps'])}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default=BASE_URL)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=None, help="requests per level (default: 4 x concurrency)")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="directory of PDFs to upload")
+    parser.add_argument("--make-corpus", type=int, default=20, help="fixtures to generate when the corpus is empty")
+    parser.add_argument("--schema", default=DEFAULT_SCHEMA, help="schema JSON file (test.json by default)")
+    parser.add_argument("--no-cache", action="store_true", help="send use_cache=false (measure cold OCI calls)")
+    parser.add_argument("--output", default=None, help="results file (default bench_results/<time>-<commit>.json)")
+    parser.add_argument("--compare", default=None, help="previous results file to diff against")
+    args = parser.parse_args()
+
+    BASE_URL = args.base_url.rstrip("/")
+    corpus = load_corpus(args.corpus, args.make_corpus)
+    with open(args.schema) as f:
+        schema = json.load(f)
+    schema_json = json.dumps(schema[0] if isinstance(schema, list) else schema)
+
+    commit = git_commit()
+    results: Dict[str, Any] = {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "base_url": BASE_URL,
+        "corpus_size": len(corpus),
+        "use_cache": not args.no_cache,
+        "scenarios": {},
+    }
+    print(f"Benchmarking {BASE_URL} at commit {commit} with {len(corpus)} PDFs")
+    for scenario in args.scenarios:
+        for concurrency in args.concurrency:
+            total = args.requests or 4 * concurrency
+            level = run_level(scenario, concurrency, total, corpus, schema_json, not args.no_cache)
+            results["scenarios"].setdefault(scenario, []).append(level)
+            print_level(scenario, level)
+
+    output = args.output or os.path.join(
+        HERE, "bench_results", f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{commit or 'nogit'}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
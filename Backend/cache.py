@@ -0,0 +1,273 @@
+import os
+import json
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, Tuple, Optional
+
+from metrics import CACHE_REQUESTS
+
+
+def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Return the md5 hex digest of a file's content (the cache key format used in cache/)."""
+    digest = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DoclingCache:
+    """
+    Content-addressed cache of Docling conversions.
+
+    Each entry is stored as <md5 of file content>-<config digest>.json with
+    "markdown" and "metadata" keys; the digest covers the conversion config
+    (OCR mode, sharding, pipeline options, Docling version), so changing any
+    of them misses instead of serving output of the old settings. Entries of
+    a previous config are left to LRU eviction. Writes go through a temp file + os.replace so readers in
+    other gunicorn workers never see a partial file, and the total size of the
+    directory is bounded with least-recently-used eviction (file mtime is
+    bumped on every hit).
+    """
+
+    TMP_PREFIX = ".tmp-"
+
+    def __init__(self, cache_dir: str = "cache", max_bytes: int = 512 * 1024 * 1024, config: Dict[str, Any] = None):
+        self.cache_dir = Path(cache_dir)
+        self.config_digest = (
+            hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+            if config else None
+        )
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def _path(self, key: str) -> Path:
+        if self.config_digest:
+            return self.cache_dir / f"{key}-{self.config_digest}.json"
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Return (markdown, metadata) for a content hash, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            markdown = entry["markdown"]
+            metadata = entry.get("metadata", {})
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            CACHE_REQUESTS.inc(1, "docling", "miss")
+            return None
+        except (ValueError, KeyError, OSError) as e:
+            # Corrupt or foreign file: treat as a miss and let the next write replace it
+            logging.warning(f"Ignoring unreadable cache entry {path}: {e}")
+            with self._lock:
+                self.misses += 1
+            CACHE_REQUESTS.inc(1, "docling", "miss")
+            return None
+
+        try:
+            # Mark as recently used for LRU eviction
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        with self._lock:
+            self.hits += 1
+        CACHE_REQUESTS.inc(1, "docling", "hit")
+        return markdown, metadata
+
+    def put(self, key: str, markdown: str, metadata: Dict[str, Any]) -> None:
+        """Atomically store a conversion result, then enforce the size bound."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=self.TMP_PREFIX, suffix=".json")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"markdown": markdown, "metadata": metadata}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            self.writes += 1
+        self._evict()
+
+    def _evict(self) -> None:
+        """Remove least-recently-used entries until the cache fits in max_bytes."""
+        entries = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue  # removed concurrently by another worker
+            if entry.name.startswith(self.TMP_PREFIX):
+                # Leftover from a worker that died mid-write
+                if now - st.st_mtime > 3600:
+                    self._remove(entry.path)
+                continue
+            if not entry.name.endswith(".json"):
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if self._remove(path):
+                with self._lock:
+                    self.evictions += 1
+            total -= size
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.unlink(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for this worker process."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "max_bytes": self.max_bytes,
+                "config_digest": self.config_digest,
+            }
+
+
+class LLMResponseCache:
+    """
+    Persistent SQLite cache of LLM responses.
+
+    Keys are a sha256 over the prompt and every request parameter that can
+    change the answer (model, max_tokens, temperature, top_p, top_k). Entries
+    expire after ttl_seconds and the table is trimmed to max_entries by least
+    recent access. The database file is shared by all gunicorn workers.
+    """
+
+    def __init__(self, db_path: str = "llm_cache.db", ttl_seconds: int = 7 * 24 * 3600, max_entries: int = 10000):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+        conn = self._conn()
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            output_tokens INTEGER,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)")
+        conn.commit()
+
+    def _conn(self):
+        if not hasattr(self._local, "connection"):
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = conn
+        return self._local.connection
+
+    @staticmethod
+    def make_key(prompt: str, **params: Any) -> str:
+        payload = json.dumps({"prompt": prompt, **params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, Optional[int]]]:
+        """Return (response_text, output_tokens) or None if missing/expired."""
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT response, output_tokens FROM llm_cache WHERE key = ? AND created_at >= ?",
+            (key, now - self.ttl_seconds),
+        ).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            CACHE_REQUESTS.inc(1, "llm", "miss")
+            return None
+
+        conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+        conn.commit()
+        with self._lock:
+            self.hits += 1
+        CACHE_REQUESTS.inc(1, "llm", "hit")
+        return row[0], row[1]
+
+    def put(self, key: str, response: str, output_tokens: Optional[int]) -> None:
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, response, output_tokens, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, response, output_tokens, now, now),
+        )
+        # Expired rows first, then the least recently used rows over the bound
+        removed = conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,)).rowcount
+        removed += conn.execute(
+            """
+            DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        ).rowcount
+        conn.commit()
+        if removed:
+            with self._lock:
+                self.evictions += removed
+
+    def record_bypass(self) -> None:
+        with self._lock:
+            self.bypassed += 1
+        CACHE_REQUESTS.inc(1, "llm", "bypass")
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for this worker process."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+            }
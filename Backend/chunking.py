@@ -0,0 +1,139 @@
+import re
+from typing import Any, Dict, List
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for budgeting (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+def _markdown_blocks(markdown: str) -> List[str]:
+    """
+    Split Docling markdown into atomic blocks: every table is one block, every
+    heading starts a new block, other text is split on blank lines.
+    """
+    blocks: List[str] = []
+    current: List[str] = []
+    in_table = False
+
+    def flush():
+        if current:
+            blocks.append("\n".join(current).strip("\n"))
+            current.clear()
+
+    for line in markdown.splitlines():
+        is_table_line = line.lstrip().startswith("|")
+        if is_table_line != in_table:
+            flush()
+            in_table = is_table_line
+        if not in_table:
+            if not line.strip():
+                flush()
+                continue
+            if line.startswith("#"):
+                flush()
+        current.append(line)
+    flush()
+    return [block for block in blocks if block.strip()]
+
+
+def _split_oversized(block: str, max_tokens: int) -> List[str]:
+    """Cut a block larger than the budget; tables keep their header rows on every piece."""
+    lines = block.splitlines()
+    header: List[str] = []
+    if len(lines) > 1 and lines[0].lstrip().startswith("|") and re.match(r"^\s*\|[\s:|-]+\|\s*$", lines[1]):
+        header, lines = lines[:2], lines[2:]
+
+    pieces: List[str] = []
+    header_tokens = estimate_tokens("\n".join(header)) if header else 0
+    current, current_tokens = list(header), header_tokens
+    width = max_tokens * 4
+    for line in lines:
+        # Hard-wrap single lines that are larger than the whole budget
+        for segment in [line[i:i + width] for i in range(0, len(line), width)] or [line]:
+            segment_tokens = estimate_tokens(segment)
+            if len(current) > len(header) and current_tokens + segment_tokens > max_tokens:
+                pieces.append("\n".join(current))
+                current, current_tokens = list(header), header_tokens
+            current.append(segment)
+            current_tokens += segment_tokens
+    if len(current) > len(header):
+        pieces.append("\n".join(current))
+    return pieces
+
+
+def split_markdown(markdown: str, max_tokens: int) -> List[str]:
+    """
+    Pack markdown into chunks of at most max_tokens (estimated), cutting only on
+    section/table/paragraph boundaries unless a single block is itself too large.
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+
+    for block in _markdown_blocks(markdown):
+        block_tokens = estimate_tokens(block)
+        if block_tokens > max_tokens:
+            if current:
+                chunks.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            chunks.extend(_split_oversized(block, max_tokens))
+            continue
+        if current and current_tokens + block_tokens > max_tokens:
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(block)
+        current_tokens += block_tokens
+
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks or [markdown]
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and value.strip() == "") or value == [] or value == {}
+
+
+def is_failed_extraction(result: Any) -> bool:
+    """A chunk answer without fields: not a JSON object, or a parse error ({"error": ..., "raw": ...})."""
+    return not isinstance(result, dict) or ("error" in result and "raw" in result)
+
+
+def merge_extractions(results: List[Any], schema: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    Deterministically merge per-chunk extraction results (in chunk order):
+    - lists (line items) are concatenated in chunk order
+    - nested objects are merged recursively
+    - scalars take the first non-empty value
+    Keys follow the schema order, then first appearance. Failed chunks
+    (is_failed_extraction) are skipped; the caller reports them.
+    """
+    results = [result for result in results if not is_failed_extraction(result)]
+    keys: List[str] = list(schema.keys()) if schema else []
+    for result in results:
+        for key in result:
+            if key not in keys:
+                keys.append(key)
+
+    merged: Dict[str, Any] = {}
+    for key in keys:
+        values = [result[key] for result in results if key in result]
+        if not values:
+            if schema and key in schema:
+                merged[key] = ""
+            continue
+
+        if any(isinstance(value, list) for value in values):
+            # split_markdown chunks do not overlap, so a row repeated in two chunks is a
+            # real repeated line item: concatenate without deduplication
+            items: List[Any] = []
+            for value in values:
+                items.extend(
+                    item for item in (value if isinstance(value, list) else [value]) if not _is_empty(item)
+                )
+            merged[key] = items
+        elif all(isinstance(value, dict) for value in values):
+            merged[key] = merge_extractions(values)
+        else:
+            merged[key] = next((value for value in values if not _is_empty(value)), values[0])
+    return merged
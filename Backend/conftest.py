@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Backend modules import each other flat (from chunking import ...), as when the server runs from here
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Scripts that drive a running server (see their docstrings), not pytest tests
+collect_ignore = ["test_concurrent.py", "benchmark.py"]
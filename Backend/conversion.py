@@ -0,0 +1,597 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import unicodedata
+import importlib.metadata
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, List, Optional, Tuple
+
+from docling.datamodel.base_models import InputFormat
+from docling.datamodel.pipeline_options import (
+    PdfPipelineOptions,
+    TesseractCliOcrOptions,
+)
+from docling.document_converter import DocumentConverter, PdfFormatOption
+
+from metrics import OCR_PAGE_SECONDS, QUEUE_WAIT_SECONDS
+from tracing import run_in_executor, set_attributes, start_span
+
+
+# A page needs at least this many non-space characters in its embedded text
+# layer (mostly letters/digits, no garbage glyphs) to skip OCR in adaptive mode
+TEXT_LAYER_MIN_CHARS = 50
+
+# Number of leading text blocks kept in the structural summary of a document
+LEAD_BLOCKS = 20
+
+# Element types that continue across a page break (a table or list cut by a
+# shard edge exports differently than in a serial conversion)
+CONTINUED_LABELS = ("table", "list_item")
+
+# Page furniture is ignored when looking at the elements on either side of a shard edge
+FURNITURE_LABELS = ("page_header", "page_footer")
+
+
+def pdf_pipeline_options(force_ocr: bool = True) -> PdfPipelineOptions:
+    """Full-page Tesseract OCR, or (force_ocr=False) the embedded text layer only."""
+    if force_ocr:
+        return PdfPipelineOptions(
+            do_ocr=True,
+            force_full_page_ocr=True,
+            ocr_options=TesseractCliOcrOptions(lang=["auto"]),
+        )
+    return PdfPipelineOptions(do_ocr=False)
+
+
+def build_converter(force_ocr: bool = True) -> DocumentConverter:
+    """
+    Docling converter for PDFs: full-page Tesseract OCR, or (force_ocr=False)
+    the embedded text layer only.
+    """
+    return DocumentConverter(
+        format_options={
+            InputFormat.PDF: PdfFormatOption(
+                pipeline_options=pdf_pipeline_options(force_ocr)
+            )
+        }
+    )
+
+
+def conversion_config(ocr_mode: str, shard_pages: int, shard_min_pages: int) -> Dict[str, Any]:
+    """
+    Everything besides the file that shapes a conversion's output (part of the
+    Docling cache key): Docling version, OCR mode and its text-layer threshold,
+    sharding, and the pipeline options of each converter in use.
+    """
+    try:
+        docling_version = importlib.metadata.version("docling")
+    except importlib.metadata.PackageNotFoundError:
+        docling_version = None
+    modes = (True, False) if ocr_mode == "adaptive" else (True,)
+    return {
+        "docling": docling_version,
+        "ocr_mode": ocr_mode,
+        "text_layer_min_chars": TEXT_LAYER_MIN_CHARS if ocr_mode == "adaptive" else None,
+        "shard_pages": shard_pages,
+        "shard_min_pages": shard_min_pages if shard_pages else None,
+        "pipelines": {
+            "ocr" if force_ocr else "text": pdf_pipeline_options(force_ocr).model_dump(mode="json")
+            for force_ocr in modes
+        },
+    }
+
+
+def convert_document(
+    converter: DocumentConverter,
+    file_path: str,
+    page_range: Optional[Tuple[int, int]] = None
+) -> Tuple[str, Dict[str, Any]]:
+    """Run Docling on a file (optionally only pages start..end, 1-based inclusive) and return (markdown, basic metadata)."""
+    if page_range is not None:
+        conv = converter.convert(file_path, page_range=page_range)
+    else:
+        conv = converter.convert(file_path)
+    markdown = conv.document.export_to_markdown()
+
+    metadata = {
+        "language": getattr(conv, "language", "auto"),
+        "structure": document_structure(conv.document),
+    }
+    if page_range is not None:
+        # Consumed (and removed) by stitch_shards / split_element_edges
+        metadata["shard_edges"] = shard_edges(conv.document)
+    return markdown, metadata
+
+
+def shard_edges(document) -> Dict[str, Optional[str]]:
+    """Labels of the first and last body elements of a converted page range."""
+    labels = [
+        str(getattr(item.label, "value", item.label))
+        for item, _ in document.iterate_items()
+    ]
+    labels = [label for label in labels if label not in FURNITURE_LABELS]
+    return {"first": labels[0] if labels else None, "last": labels[-1] if labels else None}
+
+
+def document_structure(document, max_blocks: int = LEAD_BLOCKS) -> Dict[str, Any]:
+    """
+    Compact structural summary kept alongside the markdown (and in the cache):
+    the first text blocks in reading order and the header row of every table.
+    """
+    lead_blocks: List[str] = []
+    for item, _ in document.iterate_items():
+        text = getattr(item, "text", None)
+        if text and text.strip():
+            lead_blocks.append(text.strip())
+            if len(lead_blocks) >= max_blocks:
+                break
+
+    table_headers: List[List[str]] = []
+    for table in document.tables:
+        grid = table.data.grid
+        if not grid:
+            continue
+        header_rows = [row for row in grid if any(cell.column_header for cell in row)] or grid[:1]
+        table_headers.append([cell.text.strip() for cell in header_rows[0]])
+
+    return {"lead_blocks": lead_blocks, "table_headers": table_headers}
+
+
+def is_pdf(file_path: str) -> bool:
+    """Uploads are stored without an extension: check the magic bytes."""
+    with open(file_path, "rb") as f:
+        return f.read(5) == b"%PDF-"
+
+
+def pdf_page_count(file_path: str) -> int:
+    """Number of pages if the file is a PDF, else 0."""
+    if not is_pdf(file_path):
+        return 0
+    import pypdfium2  # installed with docling
+
+    pdf = pypdfium2.PdfDocument(file_path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def text_layer_is_usable(text: str, min_chars: int = TEXT_LAYER_MIN_CHARS) -> bool:
+    """Heuristic quality check of a page's embedded text."""
+    chars = "".join(text.split())
+    if len(chars) < min_chars:
+        return False
+    alnum = sum(ch.isalnum() for ch in chars)
+    garbage = sum(1 for ch in chars if ch == "\ufffd" or unicodedata.category(ch) in ("Cc", "Co", "Cn"))
+    return alnum / len(chars) >= 0.5 and garbage / len(chars) < 0.05
+
+
+def pages_needing_ocr(file_path: str, min_chars: int = TEXT_LAYER_MIN_CHARS) -> List[bool]:
+    """For each PDF page, True when it is scanned/image-only or its text layer is unusable."""
+    import pypdfium2  # installed with docling
+
+    decisions = []
+    pdf = pypdfium2.PdfDocument(file_path)
+    try:
+        for index in range(len(pdf)):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            try:
+                text = textpage.get_text_range()
+            finally:
+                textpage.close()
+                page.close()
+            needs_ocr = not text_layer_is_usable(text, min_chars)
+            logging.debug(
+                f"[OCR PLAN] {os.path.basename(file_path)} page {index + 1}: "
+                f"{'ocr' if needs_ocr else 'text layer'} ({len(text.strip())} embedded chars)"
+            )
+            decisions.append(needs_ocr)
+    finally:
+        pdf.close()
+    return decisions
+
+
+def shard_page_ranges(page_count: int, shard_pages: int) -> List[Tuple[int, int]]:
+    """Split pages 1..page_count into consecutive (start, end) ranges of at most shard_pages."""
+    return [
+        (start, min(start + shard_pages - 1, page_count))
+        for start in range(1, page_count + 1, shard_pages)
+    ]
+
+
+def split_element_edges(
+    tasks: List[Tuple[Optional[Tuple[int, int]], bool]],
+    shards: List[Tuple[str, Dict[str, Any]]]
+) -> List[int]:
+    """
+    Indexes i where the edge between shard i and shard i+1 cuts an element: both
+    sides are shards of the same OCR run and the element before the edge and
+    the one after it are both table / list parts.
+    """
+    split = []
+    for i in range(len(tasks) - 1):
+        (range_a, ocr_a), (range_b, ocr_b) = tasks[i], tasks[i + 1]
+        if range_a is None or range_b is None or ocr_a != ocr_b or range_a[1] + 1 != range_b[0]:
+            continue
+        last = shards[i][1].get("shard_edges", {}).get("last")
+        first = shards[i + 1][1].get("shard_edges", {}).get("first")
+        if last in CONTINUED_LABELS and last == first:
+            split.append(i)
+    return split
+
+
+def merge_split_tasks(
+    tasks: List[Tuple[Optional[Tuple[int, int]], bool]],
+    split: List[int]
+) -> List[Tuple[int, int, Tuple[int, int], bool]]:
+    """
+    Group shards joined by a split edge: (first index, last index, merged page
+    range, force_ocr) for every group of more than one shard.
+    """
+    groups = []
+    for i in split:
+        if groups and groups[-1][1] == i:
+            groups[-1][1] = i + 1
+        else:
+            groups.append([i, i + 1])
+    return [
+        (first, last, (tasks[first][0][0], tasks[last][0][1]), tasks[first][1])
+        for first, last in groups
+    ]
+
+
+def stitch_shards(shards: List[Tuple[str, Dict[str, Any]]]) -> Tuple[str, Dict[str, Any]]:
+    """
+    Join per-shard markdown in page order. Docling separates blocks with a blank
+    line, so this matches a serial export when no element spans a shard edge
+    (shards around such an edge are reconverted as one range before stitching,
+    see split_element_edges).
+    """
+    markdown = "\n\n".join(part.strip() for part, _ in shards if part.strip())
+    if not shards:
+        return markdown, {}
+
+    metadata = {key: value for key, value in shards[0][1].items() if key != "shard_edges"}
+    structures = [meta.get("structure") for _, meta in shards if meta.get("structure")]
+    if structures:
+        metadata["structure"] = {
+            "lead_blocks": [block for structure in structures for block in structure["lead_blocks"]][:LEAD_BLOCKS],
+            "table_headers": [header for structure in structures for header in structure["table_headers"]],
+        }
+    return markdown, metadata
+
+
+def plan_conversion(
+    file_path: str,
+    ocr_mode: str = "full",
+    shard_pages: int = 0,
+    shard_min_pages: int = 0
+) -> List[Tuple[Optional[Tuple[int, int]], bool]]:
+    """
+    Split a document into conversion tasks of (page_range, force_ocr), in page order.
+    A page_range of None means the whole document.
+
+    - ocr_mode "full": every page goes through full-page OCR (the original behaviour).
+    - ocr_mode "adaptive": pages with a usable text layer are converted without OCR;
+      consecutive pages with the same decision are grouped into one range.
+    - PDFs with at least shard_min_pages pages are further cut into ranges of at
+      most shard_pages pages so they can be converted in parallel.
+    """
+    decisions = None
+    try:
+        if not is_pdf(file_path):
+            return [(None, True)]
+        if ocr_mode == "adaptive":
+            # One pass over the PDF: the text layer check also gives the page count
+            try:
+                decisions = pages_needing_ocr(file_path)
+            except Exception as e:
+                logging.warning(f"Text layer check failed for {file_path}, using full OCR: {e}")
+        page_count = len(decisions) if decisions is not None else pdf_page_count(file_path)
+    except Exception as e:
+        logging.warning(f"Could not read PDF pages of {file_path}, converting as a whole: {e}")
+        page_count = 0
+    if page_count == 0:
+        return [(None, True)]
+    adaptive = decisions is not None
+    if decisions is None:
+        decisions = [True] * page_count
+
+    # Runs of consecutive pages with the same OCR decision
+    runs = []
+    for page, needs_ocr in enumerate(decisions, start=1):
+        if runs and runs[-1][2] == needs_ocr:
+            runs[-1][1] = page
+        else:
+            runs.append([page, page, needs_ocr])
+    if adaptive:
+        # The per-page decisions, as ranges of the pages sent to OCR
+        ocr_pages = ", ".join(f"{start}-{end}" if end > start else str(start) for start, end, ocr in runs if ocr)
+        logging.info(
+            f"[OCR PLAN] {os.path.basename(file_path)}: {sum(decisions)}/{page_count} pages need OCR"
+            + (f" (pages {ocr_pages})" if ocr_pages else "")
+        )
+
+    shard = shard_pages > 0 and page_count >= max(shard_min_pages, shard_pages + 1)
+    if len(runs) == 1 and not shard:
+        return [(None, runs[0][2])]
+
+    tasks = []
+    for start, end, needs_ocr in runs:
+        if shard:
+            for shard_start, shard_end in shard_page_ranges(end - start + 1, shard_pages):
+                tasks.append(((start + shard_start - 1, start + shard_end - 1), needs_ocr))
+        else:
+            tasks.append(((start, end), needs_ocr))
+
+    ocr_pages = sum(decisions)
+    logging.info(
+        f"Converting {file_path} ({page_count} pages, {ocr_pages} with OCR) in {len(tasks)} tasks"
+    )
+    return tasks
+
+
+def task_pages(file_path: str, page_range: Optional[Tuple[int, int]]) -> int:
+    """Page count of one conversion task (0 if unknown)."""
+    if page_range is not None:
+        return page_range[1] - page_range[0] + 1
+    try:
+        return pdf_page_count(file_path)
+    except Exception:
+        return 0
+
+
+def convert_planned(
+    converters: Dict[bool, DocumentConverter],
+    file_path: str,
+    tasks: List[Tuple[Optional[Tuple[int, int]], bool]]
+) -> Tuple[str, Dict[str, Any]]:
+    """Run a conversion plan serially in this process (used when the process pool is disabled)."""
+    return stitch_shards([
+        convert_document(converters[force_ocr], file_path, page_range)
+        for page_range, force_ocr in tasks
+    ])
+
+
+# === Process pool worker side ===
+# Each worker process builds its converters once (models loaded, PDF pipeline
+# initialized) and reuses them for every document it is handed.
+_worker_converters: Dict[bool, DocumentConverter] = {}
+
+
+def _init_worker(ocr_mode: str = "full") -> None:
+    modes = [True, False] if ocr_mode == "adaptive" else [True]
+    for force_ocr in modes:
+        converter = build_converter(force_ocr)
+        try:
+            converter.initialize_pipeline(InputFormat.PDF)
+        except Exception as e:
+            # The pipeline will be initialized lazily on the first conversion instead
+            logging.warning(f"Docling warm-up failed in worker {os.getpid()}: {e}")
+        _worker_converters[force_ocr] = converter
+
+
+def _convert_in_worker(
+    file_path: str,
+    page_range: Optional[Tuple[int, int]] = None,
+    force_ocr: bool = True
+) -> Tuple[str, Dict[str, Any], float, float]:
+    started = time.time()
+    if force_ocr not in _worker_converters:
+        _worker_converters[force_ocr] = build_converter(force_ocr)
+    markdown, metadata = convert_document(_worker_converters[force_ocr], file_path, page_range)
+    return markdown, metadata, started, time.time()
+
+
+class ConversionPool:
+    """
+    Dedicated process pool for CPU-bound Docling/Tesseract conversion.
+
+    Conversions run outside the serving process, so OCR can use every core
+    without holding the GIL that the event loop and the I/O executor need.
+    Each document is split by plan_conversion (page shards, and in adaptive
+    OCR mode text-layer vs OCR page runs); the tasks run in parallel and are
+    stitched back together in page order, after reconverting as one range any
+    shards a table or list runs across.
+    The pool is started on first use and keeps queue-depth and timing
+    counters for /conversion/stats/. If a worker process dies (e.g. Tesseract
+    OOM-killed) the executor is broken for good, so it is dropped and the next
+    task starts a fresh pool.
+    """
+
+    def __init__(self, max_workers: int, shard_pages: int = 0, shard_min_pages: int = 0, ocr_mode: str = "full"):
+        self.max_workers = max_workers
+        self.ocr_mode = ocr_mode
+        self.shard_pages = shard_pages
+        self.shard_min_pages = shard_min_pages
+        self.sharded_documents = 0
+        self.merged_shards = 0
+        self._executor = None
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.broken_pools = 0
+        self.pending = 0
+        self.total_queue_wait = 0.0
+        self.total_convert_time = 0.0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: never fork a process that already runs threads / an event loop
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.ocr_mode,),
+                )
+            return self._executor
+
+    def _discard_executor(self, executor: ProcessPoolExecutor) -> None:
+        """Drop a broken executor (once, however many of its tasks report it)."""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self.broken_pools += 1
+        logging.warning("Conversion process pool is broken (a worker died), starting a new one on the next task")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(
+        self, file_path: str, page_range: Optional[Tuple[int, int]] = None, force_ocr: bool = True, pages: int = 0
+    ) -> Future:
+        """
+        Queue a conversion task; the future resolves to (markdown, metadata).
+        pages (the task's page count, 0 if unknown) feeds the per-page timing metric.
+        """
+        executor = self._get_executor()
+        submitted_at = time.time()
+        task_span = start_span(
+            "docling.task", pages=pages, ocr=force_ocr,
+            page_range=f"{page_range[0]}-{page_range[1]}" if page_range else "all",
+        )
+        with self._lock:
+            self.submitted += 1
+            self.pending += 1
+
+        result: Future = Future()
+
+        def _done(worker_future: Future) -> None:
+            try:
+                markdown, metadata, started, finished = worker_future.result()
+            except BaseException as e:
+                if isinstance(e, BrokenProcessPool):
+                    self._discard_executor(executor)
+                with self._lock:
+                    self.pending -= 1
+                    self.failed += 1
+                if task_span is not None:
+                    task_span.finish(e)
+                result.set_exception(e)
+                return
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+                self.total_queue_wait += max(0.0, started - submitted_at)
+                self.total_convert_time += finished - started
+            QUEUE_WAIT_SECONDS.observe(max(0.0, started - submitted_at), "conversion")
+            if pages:
+                OCR_PAGE_SECONDS.observe((finished - started) / pages, str(force_ocr).lower())
+            if task_span is not None:
+                task_span.set(queue_wait_ms=round(max(0.0, started - submitted_at) * 1000, 1))
+                task_span.finish()
+            result.set_result((markdown, metadata))
+
+        try:
+            worker_future = executor.submit(_convert_in_worker, file_path, page_range, force_ocr)
+        except BrokenProcessPool:
+            # Broken before this task: retry once on a fresh pool
+            self._discard_executor(executor)
+            executor = self._get_executor()
+            try:
+                worker_future = executor.submit(_convert_in_worker, file_path, page_range, force_ocr)
+            except BaseException as e:
+                with self._lock:
+                    self.pending -= 1
+                    self.failed += 1
+                if task_span is not None:
+                    task_span.finish(e)
+                raise
+        worker_future.add_done_callback(_done)
+        return result
+
+    def plan(self, file_path: str) -> List[Tuple[Optional[Tuple[int, int]], bool, int]]:
+        """
+        plan_conversion with each task's page count: (page_range, force_ocr, pages).
+        Parses the PDF (page count, text layers in adaptive mode), so async callers
+        run it on a thread.
+        """
+        tasks = plan_conversion(file_path, self.ocr_mode, self.shard_pages, self.shard_min_pages)
+        return [(page_range, force_ocr, task_pages(file_path, page_range)) for page_range, force_ocr in tasks]
+
+    def submit_planned(self, file_path: str, tasks: List[Tuple[Optional[Tuple[int, int]], bool, int]]) -> List[Future]:
+        """Queue a planned document as one task per page range, in page order."""
+        if len(tasks) > 1:
+            with self._lock:
+                self.sharded_documents += 1
+        set_attributes(
+            pages=sum(pages for _, _, pages in tasks),
+            ocr_pages=sum(pages for _, force_ocr, pages in tasks if force_ocr),
+            tasks=len(tasks),
+        )
+        return [self.submit(file_path, page_range, force_ocr, pages) for page_range, force_ocr, pages in tasks]
+
+    def resubmit_split(
+        self,
+        file_path: str,
+        tasks: List[Tuple[Optional[Tuple[int, int]], bool, int]],
+        shards: List[Tuple[str, Dict[str, Any]]]
+    ) -> List[Future]:
+        """
+        Final shards of a document: the converted ones, except where a table or
+        list crosses a shard edge; those shards are reconverted as one page range
+        so the stitched output matches a serial conversion.
+        """
+        planned = [(page_range, force_ocr) for page_range, force_ocr, _ in tasks]
+        groups = merge_split_tasks(planned, split_element_edges(planned, shards))
+        finals: List[Future] = []
+        for shard in shards:
+            future: Future = Future()
+            future.set_result(shard)
+            finals.append(future)
+        if not groups:
+            return finals
+
+        with self._lock:
+            self.merged_shards += sum(last - first + 1 for first, last, _, _ in groups)
+        for first, last, page_range, force_ocr in reversed(groups):
+            logging.info(
+                f"Element crosses a shard edge in {file_path}, reconverting pages {page_range[0]}-{page_range[1]} as one task"
+            )
+            pages = page_range[1] - page_range[0] + 1
+            finals[first:last + 1] = [self.submit(file_path, page_range, force_ocr, pages)]
+        return finals
+
+    def convert(self, file_path: str) -> Tuple[str, Dict[str, Any]]:
+        tasks = self.plan(file_path)
+        shards = [future.result() for future in self.submit_planned(file_path, tasks)]
+        return stitch_shards([future.result() for future in self.resubmit_split(file_path, tasks, shards)])
+
+    async def aconvert(self, file_path: str) -> Tuple[str, Dict[str, Any]]:
+        # Planning opens the PDF (and reads every text layer in adaptive mode): keep it off the event loop
+        tasks = await run_in_executor(None, self.plan, file_path)
+        futures = self.submit_planned(file_path, tasks)
+        shards = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+        futures = self.resubmit_split(file_path, tasks, list(shards))
+        shards = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+        return stitch_shards(list(shards))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "shard_pages": self.shard_pages,
+                "ocr_mode": self.ocr_mode,
+                "sharded_documents": self.sharded_documents,
+                "merged_shards": self.merged_shards,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "broken_pools": self.broken_pools,
+                "in_flight": self.pending,
+                "queue_depth": max(0, self.pending - self.max_workers),
+                "avg_queue_wait_seconds": round(self.total_queue_wait / self.completed, 3) if self.completed else 0.0,
+                "avg_convert_seconds": round(self.total_convert_time / self.completed, 3) if self.completed else 0.0,
+            }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,289 @@
+import time
+import queue
+import sqlite3
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Tuple
+
+from metrics import DB_SECONDS, QUEUE_WAIT_SECONDS
+from tracing import run_in_executor, span, start_span
+
+
+class Database:
+    """
+    SQLite access for documents.db shared by all gunicorn workers.
+
+    Every connection runs in WAL mode with a busy timeout, so readers never
+    block the writer and a writer waits for another process' lock instead of
+    failing immediately. Reads borrow a connection from a bounded pool.
+    Writes are functions fn(conn, cursor) handed to one writer thread per
+    process: it groups whatever is queued (up to max_batch, waiting at most
+    batch_window seconds for more) into one BEGIN IMMEDIATE transaction, runs
+    each function inside its own SAVEPOINT so a failing write only rolls back
+    itself, and commits once. A write function can defer in-memory side effects
+    with after_commit() so they only happen once its rows are committed. Async
+    handlers use aread()/awrite() so neither waiting for a pooled connection nor
+    the query itself blocks the event loop. Time spent waiting for a read
+    connection, in the write queue and on the database lock is recorded for stats().
+    """
+
+    def __init__(
+        self,
+        path: str,
+        read_pool_size: int = 8,
+        busy_timeout_ms: int = 5000,
+        batch_window: float = 0.005,
+        max_batch: int = 64,
+        lock_retries: int = 5,
+    ):
+        self.path = path
+        self.read_pool_size = read_pool_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.lock_retries = lock_retries
+
+        self._read_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self._read_created = 0
+        self._read_lock = threading.Lock()
+
+        self._writes: "queue.Queue[Tuple[Callable, Future, float]]" = queue.Queue()
+        self._writer_thread = None
+        self._commit_callbacks: List[Callable[[], None]] = []
+        self._writer_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, float] = {
+            "reads": 0,
+            "read_wait_seconds": 0.0,
+            "max_read_wait_seconds": 0.0,
+            "writes": 0,
+            "write_errors": 0,
+            "batches": 0,
+            "max_batch_size": 0,
+            "write_queue_wait_seconds": 0.0,
+            "max_write_queue_wait_seconds": 0.0,
+            "lock_wait_seconds": 0.0,
+            "max_lock_wait_seconds": 0.0,
+            "lock_retries": 0,
+        }
+
+    # === Connections ===
+    def connect(self) -> sqlite3.Connection:
+        """A new autocommit connection with the WAL pragmas (transactions are explicit)."""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")  # ~16 MB page cache per connection
+        return conn
+
+    @contextmanager
+    def read(self):
+        """Borrow a pooled read connection: `with db.read() as (conn, cur): ...`."""
+        with span("db.read") as read_span:
+            wait_start = time.perf_counter()
+            conn = self._acquire_reader()
+            acquired = time.perf_counter()
+            self._record_wait("read", acquired - wait_start)
+            if read_span is not None:
+                read_span.set(pool_wait_ms=round((acquired - wait_start) * 1000, 3))
+            try:
+                yield conn, conn.cursor()
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._read_pool.put(conn)
+                DB_SECONDS.observe(time.perf_counter() - acquired, "read")
+
+    async def aread(self, fn: Callable[[sqlite3.Connection, sqlite3.Cursor], Any], executor=None) -> Any:
+        """Async counterpart of read(): runs fn(conn, cursor) on a pooled connection in executor."""
+        def _run():
+            with self.read() as (conn, cur):
+                return fn(conn, cur)
+
+        return await run_in_executor(executor, _run)
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        try:
+            return self._read_pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._read_lock:
+            if self._read_created < self.read_pool_size:
+                self._read_created += 1
+                return self.connect()
+        return self._read_pool.get()
+
+    # === Writes ===
+    def submit(self, fn: Callable[[sqlite3.Connection, sqlite3.Cursor], Any]) -> Future:
+        """Queue fn(conn, cursor) for the writer thread; the future holds its return value."""
+        self._ensure_writer()
+        future: Future = Future()
+        # Ends once the batch holding fn is committed (queue wait included)
+        write_span = start_span("db.write")
+        if write_span is not None:
+            future.add_done_callback(lambda done: write_span.finish(done.exception()))
+        self._writes.put((fn, future, time.perf_counter()))
+        return future
+
+    def write(self, fn: Callable[[sqlite3.Connection, sqlite3.Cursor], Any]) -> Any:
+        """Run fn(conn, cursor) in the next write batch and return its result once committed."""
+        if threading.current_thread() is self._writer_thread:
+            # Nested write from inside a batch: already in the transaction
+            return fn(self._writer_conn, self._writer_conn.cursor())
+        return self.submit(fn).result()
+
+    async def awrite(self, fn: Callable[[sqlite3.Connection, sqlite3.Cursor], Any]) -> Any:
+        """Async counterpart of write(): awaits the commit without holding a thread."""
+        return await asyncio.wrap_future(self.submit(fn))
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """
+        Run callback() once the write function calling this has been committed;
+        it is dropped if the function fails or the batch does not commit. Outside
+        a write function it runs immediately.
+        """
+        if threading.current_thread() is self._writer_thread:
+            self._commit_callbacks.append(callback)
+        else:
+            callback()
+
+    def _ensure_writer(self) -> None:
+        if self._writer_thread is not None:
+            return
+        with self._writer_lock:
+            if self._writer_thread is None:
+                self._writer_conn = self.connect()
+                thread = threading.Thread(target=self._writer_loop, name="sqlite-writer", daemon=True)
+                self._writer_thread = thread
+                thread.start()
+
+    def _next_batch(self) -> List[Tuple[Callable, Future, float]]:
+        batch = [self._writes.get()]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._writes.get(timeout=remaining) if remaining > 0 else self._writes.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _begin_immediate(self, cursor: sqlite3.Cursor) -> None:
+        """BEGIN IMMEDIATE, retrying when another process holds the lock past busy_timeout."""
+        lock_start = time.perf_counter()
+        for attempt in range(self.lock_retries + 1):
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or attempt == self.lock_retries:
+                    raise
+                with self._stats_lock:
+                    self._stats["lock_retries"] += 1
+                time.sleep(min(0.05 * 2 ** attempt, 1.0))
+        self._record_wait("lock", time.perf_counter() - lock_start)
+
+    def _writer_loop(self) -> None:
+        conn = self._writer_conn
+        cursor = conn.cursor()
+        while True:
+            batch = self._next_batch()
+            try:
+                self._run_batch(conn, cursor, batch)
+            except Exception as e:
+                # e.g. ROLLBACK TO failing: fail this batch but keep the thread serving writes
+                logging.exception("SQLite write batch failed")
+                try:
+                    if conn.in_transaction:
+                        cursor.execute("ROLLBACK")
+                except sqlite3.Error:
+                    logging.exception("SQLite write batch failed to roll back")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _run_batch(self, conn: sqlite3.Connection, cursor: sqlite3.Cursor, batch: List[Tuple[Callable, Future, float]]) -> None:
+        started = time.perf_counter()
+        for _, _, queued_at in batch:
+            self._record_wait("write_queue", started - queued_at)
+
+        try:
+            self._begin_immediate(cursor)
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        results = []
+        for index, (fn, future, _) in enumerate(batch):
+            savepoint = f"w{index}"
+            cursor.execute(f"SAVEPOINT {savepoint}")
+            self._commit_callbacks = []
+            fn_start = time.perf_counter()
+            try:
+                results.append((future, fn(conn, conn.cursor()), None, self._commit_callbacks))
+                cursor.execute(f"RELEASE {savepoint}")
+            except Exception as e:
+                cursor.execute(f"ROLLBACK TO {savepoint}")
+                cursor.execute(f"RELEASE {savepoint}")
+                results.append((future, None, e, []))
+            finally:
+                self._commit_callbacks = []
+            DB_SECONDS.observe(time.perf_counter() - fn_start, "write")
+
+        commit_start = time.perf_counter()
+        try:
+            cursor.execute("COMMIT")
+        except Exception as e:
+            logging.exception("SQLite write batch failed to commit")
+            if conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            results = [(future, None, e, []) for future, _, _, _ in results]
+        DB_SECONDS.observe(time.perf_counter() - commit_start, "commit")
+
+        errors = 0
+        for future, result, error, callbacks in results:
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logging.exception("SQLite after-commit callback failed")
+            if error is not None:
+                errors += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        with self._stats_lock:
+            self._stats["writes"] += len(batch)
+            self._stats["write_errors"] += errors
+            self._stats["batches"] += 1
+            self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(batch))
+
+    # === Metrics ===
+    def _record_wait(self, kind: str, seconds: float) -> None:
+        QUEUE_WAIT_SECONDS.observe(seconds, f"db_{kind}")
+        with self._stats_lock:
+            if kind == "read":
+                self._stats["reads"] += 1
+            self._stats[f"{kind}_wait_seconds"] += seconds
+            self._stats[f"max_{kind}_wait_seconds"] = max(self._stats[f"max_{kind}_wait_seconds"], seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["read_pool_size"] = self.read_pool_size
+        stats["read_connections_open"] = self._read_created
+        stats["write_queue_depth"] = self._writes.qsize()
+        stats["avg_batch_size"] = stats["writes"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
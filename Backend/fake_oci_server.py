@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the OCI Generative AI chat action, for benchmarks.
+
+Serves POST /20231130/actions/chat with the same JSON shape as OCI (and the
+server-sent event stream when chatRequest.isStream is set), without checking
+request signatures. Answers are shaped after the prompt: metadata prompts get
+a metadata object, schema prompts get an object with the schema's keys, the
+combined prompt gets {"metadata", "data"}. Latency = --latency-ms (+/- jitter)
+plus --ms-per-token for each output token.
+
+Point the backend at it with:
+    OCI_GENAI_ENDPOINT=http://127.0.0.1:8090 ./start_server.sh
+"""
+
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHAT_PATH = "/20231130/actions/chat"
+
+
+class FakeOCIConfig:
+    def __init__(self, latency_ms=800.0, jitter_ms=200.0, ms_per_token=5.0, output_tokens=300, error_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.ms_per_token = ms_per_token
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def delay(self, tokens: int) -> float:
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0.0, self.latency_ms + jitter + self.ms_per_token * tokens) / 1000
+
+    def should_fail(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            return self.random.random() < self.error_rate
+
+
+def _schema_keys(prompt: str):
+    match = re.search(r"Expected output format:\s*(\{.*?\n\s*\})", prompt, re.DOTALL)
+    if match:
+        try:
+            return list(json.loads(match.group(1)).keys())
+        except json.JSONDecodeError:
+            pass
+    match = re.search(r"with this schema:\s*(\{.*\})", prompt, re.DOTALL)
+    if match:
+        try:
+            return list(json.loads(match.group(1)).keys())
+        except json.JSONDecodeError:
+            pass
+    return ["Field"]
+
+
+def fake_answer(prompt: str, output_tokens: int) -> str:
+    """An answer of roughly output_tokens tokens in the shape the prompt asks for."""
+    metadata = {"language": "English", "client_name": "Benchmark Client Ltd", "layout": ["Item", "Description", "Quantity", "Price"]}
+    if "Compare these two document layouts" in prompt:
+        return "85"
+    if "You are a metadata extractor" in prompt and '"layout"' not in prompt:
+        return json.dumps({"client_name": metadata["client_name"]})
+    if "You are a metadata extractor" in prompt:
+        return json.dumps(metadata)
+
+    # Schema extraction: fill every key; pad the first one to the requested size
+    data = {key: f"value {index}" for index, key in enumerate(_schema_keys(prompt))}
+    first_key = next(iter(data))
+    data[first_key] = " ".join(["lorem"] * max(1, output_tokens - 10 * len(data)))
+    if "Wrap everything in ONE JSON object" in prompt:
+        return json.dumps({"metadata": metadata, "data": data})
+    return json.dumps(data)
+
+
+class FakeOCIHandler(BaseHTTPRequestHandler):
+    config: FakeOCIConfig = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict) -> None:
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("opc-request-id", f"fake-{time.time_ns()}")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        if self.path.split("?")[0] != CHAT_PATH:
+            self._send_json(404, {"code": "NotFound", "message": self.path})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        details = json.loads(self.rfile.read(length) or b"{}")
+        chat_request = details.get("chatRequest") or {}
+        prompt = "".join(
+            item.get("text", "")
+            for message in chat_request.get("messages") or []
+            for item in message.get("content") or []
+        )
+
+        if self.config.should_fail():
+            time.sleep(self.config.delay(0))
+            self._send_json(429, {"code": "TooManyRequests", "message": "Fake throttle"})
+            return
+
+        answer = fake_answer(prompt, self.config.output_tokens)
+        output_tokens = max(1, len(answer) // 4)
+        prompt_tokens = len(prompt) // 4 + 1
+        usage = {"promptTokens": prompt_tokens, "completionTokens": output_tokens, "totalTokens": prompt_tokens + output_tokens}
+
+        if chat_request.get("isStream"):
+            self._stream(answer, usage)
+            return
+
+        time.sleep(self.config.delay(output_tokens))
+        self._send_json(200, {
+            "modelId": (details.get("servingMode") or {}).get("modelId", "fake-model"),
+            "modelVersion": "1.0",
+            "chatResponse": {
+                "apiFormat": "GENERIC",
+                "timeCreated": datetime.now(timezone.utc).isoformat(),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "ASSISTANT", "content": [{"type": "TEXT", "text": answer}]},
+                    "finishReason": "stop",
+                }],
+                "usage": usage,
+            },
+        })
+
+    def _stream(self, answer: str, usage: dict) -> None:
+        # Time to first token is the base latency; the rest arrives at ms_per_token
+        time.sleep(self.config.delay(0))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(event: dict) -> None:
+            frame = f"data: {json.dumps(event)}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(frame):X}\r\n".encode("ascii") + frame + b"\r\n")
+            self.wfile.flush()
+
+        pieces = [answer[i:i + 16] for i in range(0, len(answer), 16)]
+        for piece in pieces:
+            send({"index": 0, "message": {"role": "ASSISTANT", "content": [{"type": "TEXT", "text": piece}]}})
+            time.sleep(self.config.ms_per_token * 4 / 1000)
+        send({"index": 0, "finishReason": "stop"})
+        send({"usage": usage})
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def serve(host: str, port: int, config: FakeOCIConfig) -> ThreadingHTTPServer:
+    """Start the fake server on a background thread and return it (call .shutdown() to stop)."""
+    handler = type("ConfiguredFakeOCIHandler", (FakeOCIHandler,), {"config": config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=800.0, help="base latency per call")
+    parser.add_argument("--jitter-ms", type=float, default=200.0)
+    parser.add_argument("--ms-per-token", type=float, default=5.0, help="extra latency per output token")
+    parser.add_argument("--output-tokens", type=int, default=300, help="approximate size of schema answers")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = FakeOCIConfig(args.latency_ms, args.jitter_ms, args.ms_per_token, args.output_tokens, args.error_rate, args.seed)
+    server = serve(args.host, args.port, config)
+    print(f"Fake OCI chat endpoint on http://{args.host}:{args.port}{CHAT_PATH}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,361 @@
+import os
+import json
+import shutil
+import time
+import uuid
+import sqlite3
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from metrics import QUEUE_WAIT_SECONDS
+from tracing import run_in_executor
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue already holds max_pending queued jobs."""
+
+
+class JobQueue:
+    """
+    Document-processing jobs persisted in SQLite.
+
+    POST /jobs/ stores the upload under upload_dir and inserts a queued row;
+    each gunicorn worker runs `concurrency` asyncio workers that claim queued
+    rows atomically (BEGIN IMMEDIATE), run the upload pipeline and store the
+    result. Running jobs refresh a heartbeat, and jobs whose heartbeat is
+    older than stale_after seconds (their worker died) are put back in the
+    queue, so jobs survive worker restarts; a job claimed max_attempts times
+    (e.g. a document that keeps killing its worker) is failed instead.
+    The SQLite calls of both sides run on one dedicated thread, which keeps
+    them off the event loop and in order (a stage update never lands after
+    the job's result); handlers use the async wrappers asubmit/aget/alist.
+    """
+
+    STAGES = ("queued", "docling", "metadata", "extraction", "saving", "done")
+
+    def __init__(
+        self,
+        db_path: str = "jobs.db",
+        upload_dir: str = "uploads",
+        concurrency: int = 2,
+        max_pending: int = 500,
+        stale_after: float = 120.0,
+        poll_interval: float = 1.0,
+        max_attempts: int = 3,
+    ):
+        self.db_path = db_path
+        self.upload_dir = upload_dir
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._local = threading.local()
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs")
+        os.makedirs(self.upload_dir, exist_ok=True)
+
+        conn = self._conn()
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,           -- process | inference
+            status TEXT NOT NULL,         -- queued | running | succeeded | failed
+            stage TEXT NOT NULL,
+            filename TEXT,
+            file_path TEXT,
+            schema_json TEXT,
+            use_cache INTEGER DEFAULT 1,
+            result TEXT,                  -- JSON response body once finished
+            error TEXT,
+            attempts INTEGER DEFAULT 0,
+            worker TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            heartbeat_at REAL
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        if not hasattr(self._local, "connection"):
+            # Autocommit; claim() opens its own IMMEDIATE transaction
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = conn
+        return self._local.connection
+
+    # === Producer side ===
+    def pending_count(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def submit(self, kind: str, filename: str, source_path: str, schema_json: str, use_cache: bool = True) -> str:
+        """
+        Move the spooled upload at source_path into upload_dir and queue a job.
+        Raises QueueFullError when the queue is full (the file is left in place).
+        """
+        if self.pending_count() >= self.max_pending:
+            raise QueueFullError(f"Job queue is full ({self.max_pending} jobs waiting)")
+
+        job_id = uuid.uuid4().hex
+        file_path = os.path.join(self.upload_dir, job_id)
+        shutil.move(source_path, file_path)
+
+        self._conn().execute(
+            """
+            INSERT INTO jobs (id, kind, status, stage, filename, file_path, schema_json, use_cache, created_at)
+            VALUES (?, ?, 'queued', 'queued', ?, ?, ?, ?, ?)
+            """,
+            (job_id, kind, filename, file_path, schema_json, int(use_cache), time.time()),
+        )
+        return job_id
+
+    async def asubmit(self, kind: str, filename: str, source_path: str, schema_json: str, use_cache: bool = True) -> str:
+        """submit() on the jobs thread, so the move and the insert do not block the event loop."""
+        job_id = await run_in_executor(self._executor, self.submit, kind, filename, source_path, schema_json, use_cache)
+        if self._wakeup is not None:
+            self._wakeup.set()  # asyncio.Event: set from the loop, not the jobs thread
+        return job_id
+
+    async def aget(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await run_in_executor(self._executor, self.get, job_id)
+
+    async def alist(self, status: str = None, limit: int = 50) -> List[Dict[str, Any]]:
+        return await run_in_executor(self._executor, self.list, status, limit)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            """
+            SELECT id, kind, status, stage, filename, result, error, attempts,
+                   created_at, started_at, finished_at
+            FROM jobs WHERE id = ?
+            """,
+            (job_id,),
+        ).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def list(self, status: str = None, limit: int = 50) -> List[Dict[str, Any]]:
+        query = """
+            SELECT id, kind, status, stage, filename, NULL, error, attempts,
+                   created_at, started_at, finished_at
+            FROM jobs
+        """
+        params: list = []
+        if status:
+            query += " WHERE status = ?"
+            params.append(status)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        return [self._row_to_dict(row) for row in self._conn().execute(query, params).fetchall()]
+
+    @staticmethod
+    def _row_to_dict(row) -> Dict[str, Any]:
+        job_id, kind, status, stage, filename, result, error, attempts, created_at, started_at, finished_at = row
+        return {
+            "job_id": job_id,
+            "kind": kind,
+            "job_status": status,
+            "stage": stage,
+            "progress": JobQueue.STAGES.index(stage) / (len(JobQueue.STAGES) - 1) if stage in JobQueue.STAGES else None,
+            "filename": filename,
+            "result": json.loads(result) if result else None,
+            "error": error,
+            "attempts": attempts,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+        }
+
+    # === Worker side ===
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """Atomically move the oldest queued job to running for this worker."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """
+                SELECT id, kind, filename, file_path, schema_json, use_cache, created_at
+                FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1
+                """
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    """
+                    UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1,
+                                    started_at = ?, heartbeat_at = ?
+                    WHERE id = ?
+                    """,
+                    (self.worker_id, now, now, row[0]),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        job_id, kind, filename, file_path, schema_json, use_cache, created_at = row
+        QUEUE_WAIT_SECONDS.observe(max(0.0, now - created_at), "jobs")
+        return {
+            "job_id": job_id,
+            "kind": kind,
+            "filename": filename,
+            "file_path": file_path,
+            "schema_json": schema_json,
+            "use_cache": bool(use_cache),
+        }
+
+    def set_stage(self, job_id: str, stage: str) -> None:
+        self._conn().execute(
+            "UPDATE jobs SET stage = ?, heartbeat_at = ? WHERE id = ?",
+            (stage, time.time(), job_id),
+        )
+
+    def heartbeat(self, job_id: str) -> None:
+        self._conn().execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def finish(self, job_id: str, result: Dict[str, Any]) -> None:
+        succeeded = result.get("status") == "success"
+        self._conn().execute(
+            """
+            UPDATE jobs SET status = ?, stage = ?, result = ?, error = ?, finished_at = ?
+            WHERE id = ?
+            """,
+            (
+                "succeeded" if succeeded else "failed",
+                "done" if succeeded else "failed",
+                json.dumps(result),
+                None if succeeded else result.get("message"),
+                time.time(),
+                job_id,
+            ),
+        )
+
+    def requeue_stale(self) -> int:
+        """
+        Put running jobs whose worker stopped heartbeating back in the queue, or
+        fail them once they have been claimed max_attempts times.
+        """
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            exhausted = conn.execute(
+                """
+                SELECT id, file_path, attempts FROM jobs
+                WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?
+                """,
+                (now - self.stale_after, self.max_attempts),
+            ).fetchall()
+            for job_id, _, attempts in exhausted:
+                message = f"Job failed after {attempts} attempts: its worker stopped while processing it"
+                conn.execute(
+                    """
+                    UPDATE jobs SET status = 'failed', stage = 'failed', result = ?, error = ?,
+                                    worker = NULL, finished_at = ?
+                    WHERE id = ?
+                    """,
+                    (json.dumps({"status": "error", "message": message}), message, now, job_id),
+                )
+            requeued = conn.execute(
+                """
+                UPDATE jobs SET status = 'queued', stage = 'queued', worker = NULL
+                WHERE status = 'running' AND heartbeat_at < ?
+                """,
+                (now - self.stale_after,),
+            ).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        for job_id, file_path, attempts in exhausted:
+            logging.warning(f"Job {job_id} failed after {attempts} attempts")
+            try:
+                os.unlink(file_path)
+            except OSError:
+                pass
+        if requeued:
+            logging.warning(f"Requeued {requeued} stale job(s)")
+        return requeued
+
+    def start(self, handler: Callable[[Dict[str, Any], Callable[[str], None]], Awaitable[Dict[str, Any]]]) -> None:
+        """Start the worker tasks on the running event loop."""
+        self._wakeup = asyncio.Event()
+        self.requeue_stale()
+        for _ in range(self.concurrency):
+            self._tasks.append(asyncio.create_task(self._worker(handler)))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self, handler) -> None:
+        while True:
+            try:
+                job = await run_in_executor(self._executor, self.claim)
+            except sqlite3.OperationalError as e:
+                logging.warning(f"Job claim failed: {e}")
+                job = None
+
+            if job is None:
+                # Idle: wait for a local submit or poll for jobs queued by other workers
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                try:
+                    await run_in_executor(self._executor, self.requeue_stale)
+                except sqlite3.OperationalError as e:
+                    logging.warning(f"Requeueing stale jobs failed: {e}")
+                continue
+
+            await self._run(job, handler)
+
+    async def _run(self, job: Dict[str, Any], handler) -> None:
+        job_id = job["job_id"]
+
+        async def _keep_alive():
+            while True:
+                await asyncio.sleep(self.stale_after / 4)
+                try:
+                    await run_in_executor(self._executor, self.heartbeat, job_id)
+                except sqlite3.OperationalError as e:
+                    # e.g. database locked: the next beat still lands well within stale_after
+                    logging.warning(f"Heartbeat of job {job_id} failed: {e}")
+
+        def _on_stage(stage: str) -> None:
+            # Progress only: queued behind earlier writes, not awaited
+            run_in_executor(self._executor, self.set_stage, job_id, stage).add_done_callback(_log_stage_error)
+
+        def _log_stage_error(future: asyncio.Future) -> None:
+            if not future.cancelled() and future.exception() is not None:
+                logging.warning(f"Failed to record stage of job {job_id}: {future.exception()}")
+
+        keep_alive = asyncio.create_task(_keep_alive())
+        try:
+            result = await handler(job, _on_stage)
+        except asyncio.CancelledError:
+            # Shutting down: leave the job running so another worker requeues it
+            raise
+        except Exception as e:
+            logging.exception(f"Job {job_id} failed")
+            result = {"status": "error", "message": str(e)}
+        finally:
+            keep_alive.cancel()
+
+        await run_in_executor(self._executor, self.finish, job_id, result)
+        try:
+            os.unlink(job["file_path"])
+        except OSError:
+            pass
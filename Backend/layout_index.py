@@ -0,0 +1,207 @@
+import re
+import json
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from prompt_history import history_json, load_histories, parse_layout
+
+
+def normalize_header(header: Any) -> str:
+    """Lowercase a column header and strip punctuation/currency so 'Unit Price (£)' == 'unit price'."""
+    text = str(header).lower()
+    text = re.sub(r"[^\w\s]|_", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def layout_features(layout: Any) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """Return (normalized header set, header token set) for a layout."""
+    headers = frozenset(h for h in (normalize_header(c) for c in parse_layout(layout)) if h)
+    tokens = frozenset(t for h in headers for t in h.split())
+    return headers, tokens
+
+
+def _jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def layout_similarity(a: Any, b: Any) -> float:
+    """
+    Similarity score from 0 to 100 between two layouts: the mean of the Jaccard
+    index over whole headers and over header tokens (so 'Item code' and
+    'Item No' still count as partially similar).
+    """
+    headers_a, tokens_a = layout_features(a)
+    headers_b, tokens_b = layout_features(b)
+    return 100 * (_jaccard(headers_a, headers_b) + _jaccard(tokens_a, tokens_b)) / 2
+
+
+class LayoutIndex:
+    """
+    In-memory index of layouts that have a saved user prompt.
+
+    One entry is kept per distinct layout (the prompt of the most recent
+    document with that layout) with an inverted index from header token to
+    layouts, so a lookup only scores layouts sharing at least one token.
+    The index is filled incrementally from the documents table: sync() reads
+    the rows above the highest id it has read so far. Rows this worker inserted
+    itself (add()) are remembered by id instead of moving that mark, so rows
+    other workers inserted below them are still picked up. A background thread
+    (start()) rebuilds the whole index every rebuild_interval seconds to pick
+    up prompt changes made by other workers.
+    """
+
+    def __init__(self, rebuild_interval: float = 300.0):
+        self.rebuild_interval = rebuild_interval
+        self._lock = threading.Lock()
+        self._rebuilder = None
+        self._generation = 0
+        self._replay: Optional[List[Tuple[int, Any, Optional[str]]]] = None
+        self._clear()
+
+    def _clear(self) -> None:
+        # layout text -> (doc_id, prompt, headers, tokens)
+        self._entries: Dict[str, Tuple[int, str, FrozenSet[str], FrozenSet[str]]] = {}
+        self._postings: Dict[str, set] = {}
+        self._synced_id = 0           # every row up to this id has been read by sync()
+        self._added_ids: set = set()  # ids above _synced_id already added by add()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+            self._generation += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _add_locked(self, doc_id: int, layout: Any, prompt: Optional[str]) -> None:
+        key = layout if isinstance(layout, str) else json.dumps(layout)
+        existing = self._entries.get(key)
+        if existing is not None and existing[0] > doc_id:
+            return  # keep the prompt of the most recent document
+        if not prompt:
+            if existing is not None and existing[0] == doc_id:
+                self._remove_locked(key)
+            return
+
+        headers, tokens = layout_features(key)
+        if not tokens:
+            return
+        self._entries[key] = (doc_id, prompt, headers, tokens)
+        for token in tokens:
+            self._postings.setdefault(token, set()).add(key)
+
+    def _remove_locked(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for token in entry[3]:
+            keys = self._postings.get(token)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[token]
+
+    def add(self, doc_id: int, layout: Any, prompt: Optional[str]) -> None:
+        """Register (or refresh) the prompt saved for a document's layout."""
+        with self._lock:
+            self._add_locked(doc_id, layout, prompt)
+            if doc_id > self._synced_id:
+                self._added_ids.add(doc_id)
+            if self._replay is not None:
+                self._replay.append((doc_id, layout, prompt))
+
+    def sync(self, cursor) -> None:
+        """Load the rows inserted since the last sync."""
+        with self._lock:
+            synced_id, generation = self._synced_id, self._generation
+        cursor.execute("SELECT id, layout FROM documents WHERE id > ? ORDER BY id", (synced_id,))
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        with self._lock:
+            new_rows = [(doc_id, layout) for doc_id, layout in rows if layout and doc_id not in self._added_ids]
+        histories = load_histories(cursor, [doc_id for doc_id, _ in new_rows])
+        with self._lock:
+            if self._synced_id != synced_id or self._generation != generation:
+                return  # another sync, a rebuild or a clear changed the index meanwhile
+            for doc_id, layout in new_rows:
+                self._add_locked(doc_id, layout, history_json(histories.get(doc_id, [])))
+            self._synced_id = rows[-1][0]
+            self._added_ids = {doc_id for doc_id in self._added_ids if doc_id > self._synced_id}
+
+    def rebuild(self, cursor) -> None:
+        """Re-read every row into a fresh index and swap it in; lookups keep using the old one meanwhile."""
+        with self._lock:
+            generation = self._generation
+            self._replay = []
+        try:
+            fresh = LayoutIndex(self.rebuild_interval)
+            fresh.sync(cursor)
+            with self._lock:
+                if self._generation != generation:
+                    return  # cleared while rebuilding
+                # Prompts added while the rows were read may not have been committed yet
+                for doc_id, layout, prompt in self._replay:
+                    fresh.add(doc_id, layout, prompt)
+                self._entries, self._postings = fresh._entries, fresh._postings
+                self._synced_id, self._added_ids = fresh._synced_id, fresh._added_ids
+                self._generation += 1
+        finally:
+            with self._lock:
+                self._replay = None
+
+    def start(self, read: Callable) -> None:
+        """
+        Rebuild every rebuild_interval seconds on a background thread; read() is a
+        context manager yielding (conn, cursor), as Database.read.
+        """
+        if self.rebuild_interval <= 0 or self._rebuilder is not None:
+            return
+        self._rebuilder = threading.Thread(target=self._rebuild_loop, args=(read,), name="layout-index-rebuild", daemon=True)
+        self._rebuilder.start()
+
+    def _rebuild_loop(self, read: Callable) -> None:
+        while True:
+            time.sleep(self.rebuild_interval)
+            try:
+                with read() as (conn, cursor):
+                    self.rebuild(cursor)
+            except Exception as e:
+                logging.warning(f"Layout index rebuild failed: {e}")
+
+    def search(self, layout: Any, threshold: float = 70, top_k: int = 1) -> List[Tuple[float, str, str]]:
+        """
+        Return up to top_k (score, layout, prompt) tuples scoring at least
+        threshold, best first. Ties keep the older document, as the previous
+        sequential comparison did.
+        """
+        headers, tokens = layout_features(layout)
+        if not tokens:
+            return []
+
+        # score <= 100 * (1 + token_jaccard) / 2, so candidates below this
+        # token overlap can be skipped without comparing whole headers
+        min_token_jaccard = 2 * threshold / 100 - 1
+
+        with self._lock:
+            overlap: Dict[str, int] = {}
+            for token in tokens:
+                for key in self._postings.get(token, ()):
+                    overlap[key] = overlap.get(key, 0) + 1
+
+            scored = []
+            for key, shared in overlap.items():
+                doc_id, prompt, cand_headers, cand_tokens = self._entries[key]
+                token_jaccard = shared / (len(tokens) + len(cand_tokens) - shared)
+                if token_jaccard < min_token_jaccard:
+                    continue
+                score = 100 * (_jaccard(headers, cand_headers) + token_jaccard) / 2
+                if score >= threshold:
+                    scored.append((score, -doc_id, key, prompt))
+
+        scored.sort(reverse=True)
+        return [(score, key, prompt) for score, _, key, prompt in scored[:top_k]]
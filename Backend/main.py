@@ -1,23 +1,40 @@
 import os
 import json
-import tempfile
-import sqlite3
+import logging
+import base64
 import re
-from contextlib import contextmanager
+import time
+import datetime
 from concurrent.futures import ThreadPoolExecutor
 import asyncio
-from fastapi import FastAPI, UploadFile, File, Form, Body, Depends
+from fastapi import FastAPI, UploadFile, File, Form, Body, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from processor import DocumentProcessor, sanitize_for_json
-from typing import List, Dict, Any, Tuple
-import threading
+from jobs import JobQueue, QueueFullError
+from uploads import UploadLimitMiddleware, UploadSpool, UploadTooLargeError
+from migrations import migrate
+from db import Database
+from ratelimit import INTERACTIVE
+from metrics import JSON_PARSE_FAILURES, REGISTRY, STAGE_SECONDS
+from tracing import TRACER, current_request_id, run_in_executor, set_attributes, span, traced
+from usage import GROUP_COLUMNS, collect_usage, current_usage, insert_usage, usage_summary
+from prompt_history import BRANCH_POINT_SQL, append_layout_version, history_json, layout_hash, load_histories
+from typing import List, Dict, Any, Optional, Tuple, Callable
 
 load_dotenv()
 
 # === Initialize FastAPI ===
 app = FastAPI()
 
+# === Refuse oversized request bodies before they are parsed (one request may carry several files) ===
+# Registered before CORS so the 413 still carries the CORS headers
+app.add_middleware(
+    UploadLimitMiddleware,
+    max_bytes=int(os.getenv("UPLOAD_MAX_REQUEST_MB", "1024")) * 1024 * 1024,
+)
+
 # === Enable CORS (Next.js frontend can call this API) ===
 app.add_middleware(
     CORSMiddleware,
@@ -25,53 +42,98 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """
+    Root span of every request. The client's X-Request-ID is reused when it looks
+    sane (otherwise one is generated) and returned on the response; log lines of
+    the request carry it. The span ends once a streamed body has been sent.
+    """
+    request_id = request.headers.get("x-request-id")
+    if request_id is not None and not re.fullmatch(r"[A-Za-z0-9._-]{1,64}", request_id):
+        request_id = None
+    root = TRACER.start_trace(f"{request.method} {request.url.path}", request_id)
+    try:
+        response = await call_next(request)
+    except Exception as e:
+        if root is not None:
+            root.finish(e)
+        raise
+    response.headers["X-Request-ID"] = current_request_id()
+    if root is None:
+        return response
+
+    root.set(status_code=response.status_code)
+    body = response.body_iterator
+
+    async def _finish_after_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            root.finish()
+
+    response.body_iterator = _finish_after_body()
+    return response
+
 # === Initialize OCI-powered DocumentProcessor ===
 processor = DocumentProcessor(config_file="config.ini", profile="DEFAULT")
 
-# === Thread pool for CPU-bound operations ===
-# This allows multiple document processing tasks to run concurrently
-executor = ThreadPoolExecutor(max_workers=4)
+# === Thread pool for blocking I/O (file hashing, cache reads/writes) ===
+# Docling/Tesseract conversion runs in processor.conversion_pool (separate processes)
+executor = ThreadPoolExecutor(max_workers=int(os.getenv("IO_EXECUTOR_WORKERS", "4")))
 
-# === SQLite setup with thread-safe connection management ===
-DB_PATH = "documents.db"
 
-# Thread-local storage for database connections
-_thread_local = threading.local()
+@app.on_event("shutdown")
+async def close_oci_client():
+    await processor.async_client.aclose()
+    if processor.conversion_pool is not None:
+        processor.conversion_pool.shutdown()
 
-def get_db_connection():
-    """Get a thread-safe database connection."""
-    if not hasattr(_thread_local, 'connection'):
-        _thread_local.connection = sqlite3.connect(DB_PATH, check_same_thread=True)
-    return _thread_local.connection
+# === Upload spooling: chunked writes to disk, md5 computed while streaming ===
+upload_spool = UploadSpool(
+    spool_dir=os.getenv("UPLOAD_SPOOL_DIR") or None,
+    max_bytes=int(os.getenv("UPLOAD_MAX_MB", "100")) * 1024 * 1024,
+    max_age=float(os.getenv("UPLOAD_SPOOL_MAX_AGE_SECONDS", str(6 * 3600))),
+)
 
-@contextmanager
-def get_db():
-    """Context manager for database connections and cursors."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        yield conn, cur
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
+
+def _upload_too_large(e: UploadTooLargeError) -> JSONResponse:
+    return JSONResponse(status_code=413, content={"status": "error", "message": str(e)})
+
+# === SQLite: WAL, pooled read connections and one batching writer thread per worker ===
+DB_PATH = "documents.db"
+
+database = Database(
+    DB_PATH,
+    read_pool_size=int(os.getenv("DB_READ_POOL_SIZE", "8")),
+    busy_timeout_ms=int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000")),
+    batch_window=float(os.getenv("DB_WRITE_BATCH_MS", "5")) / 1000,
+    max_batch=int(os.getenv("DB_WRITE_MAX_BATCH", "64")),
+)
 
 # Initialize database schema
-with get_db() as (conn, cur):
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS documents (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        filename TEXT,
-        file_type TEXT,
-        client_name TEXT,
-        language TEXT,
-        layout TEXT,       -- JSON array of columns
-        user_prompt TEXT,  -- saved prompt if any
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
+_schema_conn = database.connect()
+_schema_conn.execute("""
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT,
+    file_type TEXT,
+    client_name TEXT,
+    language TEXT,
+    layout TEXT,       -- JSON array of columns
+    user_prompt TEXT,  -- legacy; prompts now live in layout_prompt_versions / prompt_versions
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+""")
+
+# Indexes, layout_hash column and the prompt version tables (PRAGMA user_version)
+migrate(_schema_conn)
+_schema_conn.close()
 
 
 
@@ -81,248 +143,592 @@ def get_file_type(filename):
     return match.group(1).lower() if match else None
 
 
+# === LLM usage records ===
+async def _save_usage(usage: List[Dict[str, Any]], document_id: int = None) -> None:
+    """Persist usage records that were not stored with a document (try-prompt, failed uploads)."""
+    if not usage:
+        return
+    try:
+        await database.awrite(lambda conn, cur: insert_usage(cur, document_id, usage))
+    except Exception as e:
+        # Accounting must never fail the request it accounts for
+        logging.warning(f"Failed to store {len(usage)} LLM usage records: {e}")
+
+
+# === Shared upload pipeline ===
+@traced("pipeline")
+async def run_document_pipeline(
+    tmp_path: str,
+    filename: str,
+    schema: Dict[str, Any],
+    use_cache: bool = True,
+    require_known_client: bool = False,
+    on_stage: Callable[[str], None] = None,
+    on_event: Callable[[str, Any], None] = None,
+    content_hash: str = None,
+) -> Dict[str, Any]:
+    """
+    Docling + metadata, suggested prompt lookup, schema extraction and the documents
+    insert for one uploaded file. Returns the /process-document/ response body.
+    on_stage(name) is called as each stage starts: docling, metadata, extraction, saving.
+    on_event(name, payload) receives intermediate results for streaming clients:
+    docling (markdown), metadata, suggested_prompt and the extraction answer as tokens.
+    content_hash is the upload's md5 when it was computed while spooling.
+    Every LLM call is recorded in llm_usage, with the new document's id once saved.
+    """
+    with collect_usage() as usage:
+        try:
+            return await _run_document_pipeline(
+                tmp_path, filename, schema, use_cache, require_known_client, on_stage, on_event, content_hash
+            )
+        finally:
+            # Records left over were not saved with a document (error or unknown client)
+            await _save_usage(usage)
+
+
+async def _run_document_pipeline(
+    tmp_path: str,
+    filename: str,
+    schema: Dict[str, Any],
+    use_cache: bool,
+    require_known_client: bool,
+    on_stage: Callable[[str], None],
+    on_event: Callable[[str, Any], None],
+    content_hash: str,
+) -> Dict[str, Any]:
+    pipeline_start = time.perf_counter()
+    set_attributes(filename=filename)
+    if on_stage is not None:
+        on_stage("docling")
+
+    known_clients = None
+    if processor.metadata_mode == "local" or processor.combined_extraction:
+        def _read_known(conn, cur):
+            # Local metadata reuses saved layouts with the same columns: bring the index up to date
+            processor.layout_index.sync(cur)
+            return processor.get_known_clients(cur)
+
+        known_clients = await database.aread(_read_known, executor)
+
+    if processor.combined_extraction:
+        async def find_prompt(client_name, layout):
+            return await processor.afind_suggested_prompt(client_name, layout, database.read, executor)
+
+        # One LLM call for metadata + schema fields (generated_json is None if it fell back)
+        result = await processor.aprocess_document_combined(
+            tmp_path, schema, find_prompt, content_hash, use_cache,
+            executor=executor, on_stage=on_stage, known_clients=known_clients, on_event=on_event,
+            filename=filename
+        )
+    else:
+        # Docling runs on the conversion pool; the metadata LLM call is awaited on the async OCI client
+        result = await processor.aprocess_document(
+            tmp_path, content_hash, use_cache, executor=executor, on_stage=on_stage,
+            known_clients=known_clients, on_event=on_event, filename=filename
+        )
+    structured_markdown = result["structured_markdown"]
+    metadata = result["metadata"]
+    generated_json = result.get("generated_json")
+
+    if require_known_client:
+        # Check if client name exists in database
+        def _client_exists(conn, cur):
+            cur.execute("SELECT 1 FROM documents WHERE client_name = ? LIMIT 1", (metadata["client_name"],))
+            return cur.fetchone() is not None
+
+        client_exists = await database.aread(_client_exists, executor)
+
+        if not client_exists:
+            return {
+                "status": "error",
+                "message": "We don't have configurations setup for this type of layout. Please Configure it"
+            }
+
+    if generated_json is None:
+        # Get suggested prompt before extraction (database work in the executor)
+        with STAGE_SECONDS.time("prompt_lookup"), span("prompt_lookup"):
+            suggested_prompt = await processor.afind_suggested_prompt(
+                metadata["client_name"], metadata["layout"], database.read, executor
+            )
+        if on_event is not None:
+            on_event("suggested_prompt", {"suggested_prompt": suggested_prompt})
+        if on_stage is not None:
+            on_stage("extraction")
+
+        # Schema extraction waits on OCI without holding a thread
+        generated_json, output_tokens = await processor.aextract_json_with_schema(
+            structured_markdown,
+            schema,
+            suggested_prompt,
+            use_cache,
+            on_token=(lambda text: on_event("token", {"text": text})) if on_event is not None else None
+        )
+    else:
+        output_tokens = result["output_tokens"]
+        suggested_prompt = result["suggested_prompt"]
+        if on_event is not None:
+            on_event("suggested_prompt", {"suggested_prompt": suggested_prompt})
+    # Add filename to generated JSON
+    generated_json["FileName"] = filename
+
+    if on_stage is not None:
+        on_stage("saving")
+    usage = current_usage()
+
+    def _save_document(conn, cur):
+        # Prompts already saved for this layout
+        layout_json = json.dumps(metadata["layout"])
+        layout_key = layout_hash(layout_json)
+        existing_prompts = processor.get_latest_prompt_for_layout(layout_json, cur) or []
+
+        # If a suggested prompt was used and is not in the layout's history yet, it
+        # becomes the layout's next version: seen by this new document and later ones,
+        # not by the existing documents (their branch points are older)
+        prompt_to_save = existing_prompts
+        if suggested_prompt and suggested_prompt not in [p.get("prompt", "") for p in existing_prompts]:
+            timestamp = datetime.datetime.now().isoformat()
+            append_layout_version(cur, layout_key, suggested_prompt, timestamp)
+            prompt_to_save = existing_prompts + [{"prompt": suggested_prompt, "timestamp": timestamp}]
+
+        # Store document in SQLite; it inherits the layout's prompts
+        file_type = get_file_type(filename)
+        cur.execute(
+            f"""
+            INSERT INTO documents (filename, file_type, client_name, language, layout, layout_hash, layout_versions)
+            VALUES (?, ?, ?, ?, ?, ?, {BRANCH_POINT_SQL})
+            """,
+            (
+                filename,
+                file_type,
+                metadata["client_name"],
+                metadata["language"],
+                layout_json,
+                layout_key,
+                layout_key
+            ),
+        )
+        doc_id = cur.lastrowid
+        saved_prompt = history_json(prompt_to_save)
+        database.after_commit(lambda: processor.layout_index.add(doc_id, layout_json, saved_prompt))
+        insert_usage(cur, doc_id, usage)
+
+        # Calculate inherited version
+        return doc_id, len(prompt_to_save)
+
+    # Read-check-insert runs as one transaction on the writer thread
+    with STAGE_SECONDS.time("saving"), span("saving"):
+        doc_id, inherited_version = await database.awrite(_save_document)
+    usage.clear()
+    STAGE_SECONDS.observe(time.perf_counter() - pipeline_start, "pipeline")
+
+    return {
+        "status": "success",
+        "document_id": doc_id,
+        "filename": filename,
+        "structured_markdown": structured_markdown,
+        "generated_json": sanitize_for_json(generated_json),
+        "suggested_prompt": suggested_prompt,
+        "oci_output_tokens": output_tokens,
+        "inherited_version": inherited_version,
+        "message": f"Document created with version {inherited_version} (inherited from layout)" if inherited_version > 0 else "Document created with version 0"
+    }
+
+
 # === Upload + Process Document ===
 @app.post("/process-document/")
-async def process_document(file: UploadFile = File(...), schema_json: str = Form(...)):
+async def process_document(
+    file: UploadFile = File(...),
+    schema_json: str = Form(...),
+    use_cache: bool = Form(True)
+):
     try:
         schema = json.loads(schema_json)
         # Add FileName to schema
         schema["FileName"] = ""
 
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp.write(await file.read())
-            tmp_path = tmp.name
-
-        # Run CPU-bound processor in thread pool to avoid blocking event loop
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(executor, processor.process_document, tmp_path)
-        structured_markdown = result["structured_markdown"]
-        metadata = result["metadata"]
-
-        # Use thread-safe database connection
-        with get_db() as (conn, cur):
-            # Get suggested prompt before extraction
-            suggested_prompt = processor.find_suggested_prompt(
-                current_client=metadata["client_name"],
-                current_layout=metadata["layout"],
-                cursor=cur
-            )
-
-            # Run CPU-bound extraction in thread pool
-            def extract_with_schema():
-                return processor.extract_json_with_schema(
-                    structured_markdown,
-                    schema,
-                    suggested_prompt
-                )
-            
-            generated_json, output_tokens = await loop.run_in_executor(executor, extract_with_schema)
-            # Add filename to generated JSON
-            generated_json["FileName"] = file.filename
-
-            # Check if there are existing prompts for this layout
-            layout_json = json.dumps(metadata["layout"])
-            existing_prompts = processor.get_latest_prompt_for_layout(layout_json, cur)
-            
-            # If a suggested prompt was used, add it to the prompt history
-            prompt_to_save = existing_prompts
-            if suggested_prompt and not existing_prompts:
-                # First document with this layout - save the suggested prompt as version 1
-                import datetime
-                prompt_to_save = [{
-                    "prompt": suggested_prompt,
-                    "timestamp": datetime.datetime.now().isoformat()
-                }]
-            elif suggested_prompt and existing_prompts:
-                # Check if the suggested prompt is already in the history
-                # If not, it means a new prompt was applied, add it
-                prompt_texts = [p.get("prompt", "") for p in existing_prompts]
-                if suggested_prompt not in prompt_texts:
-                    import datetime
-                    prompt_to_save = existing_prompts + [{
-                        "prompt": suggested_prompt,
-                        "timestamp": datetime.datetime.now().isoformat()
-                    }]
-            
-            # Store document in SQLite with inherited/applied prompts
-            file_type = get_file_type(file.filename)
-            cur.execute(
-                """
-                INSERT INTO documents (filename, file_type, client_name, language, layout, user_prompt)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    file.filename,
-                    file_type,
-                    metadata["client_name"],
-                    metadata["language"],
-                    layout_json,
-                    json.dumps(prompt_to_save) if prompt_to_save else None
-                ),
+        tmp_path, content_hash, _ = await upload_spool.spool(file)
+        try:
+            response = await run_document_pipeline(
+                tmp_path, file.filename, schema, use_cache, content_hash=content_hash
             )
-            doc_id = cur.lastrowid
-            print(generated_json)
-            
-            # Calculate inherited version
-            inherited_version = len(prompt_to_save) if prompt_to_save else 0
-
-        return {
-            "status": "success",
-            "document_id": doc_id,
-            "filename": file.filename,
-            "structured_markdown": structured_markdown,
-            "generated_json": sanitize_for_json(generated_json),
-            "suggested_prompt": suggested_prompt,
-            "oci_output_tokens": output_tokens,
-            "inherited_version": inherited_version,
-            "message": f"Document created with version {inherited_version} (inherited from layout)" if inherited_version > 0 else "Document created with version 0"
-        }
+        finally:
+            upload_spool.discard(tmp_path)
+        return response
 
     except json.JSONDecodeError:
         return {"status": "error", "message": "Invalid schema JSON format."}
+    except UploadTooLargeError as e:
+        return _upload_too_large(e)
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 @app.post("/inference-document/")
-async def process_document(file: UploadFile = File(...), schema_json: str = Form(...)):
+async def process_document(
+    file: UploadFile = File(...),
+    schema_json: str = Form(...),
+    use_cache: bool = Form(True)
+):
     try:
         schema = json.loads(schema_json)
         # Add FileName to schema
         schema["FileName"] = ""
 
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp.write(await file.read())
-            tmp_path = tmp.name
-
-        # Run CPU-bound processor in thread pool
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(executor, processor.process_document, tmp_path)
-        structured_markdown = result["structured_markdown"]
-        metadata = result["metadata"]
-
-        # Use thread-safe database connection
-        with get_db() as (conn, cur):
-            # Check if client name exists in database
-            cur.execute("SELECT COUNT(*) FROM documents WHERE client_name = ?", (metadata["client_name"],))
-            client_exists = cur.fetchone()[0] > 0
-        
-            if not client_exists:
-                return {
-                    "status": "error", 
-                    "message": "We don't have configurations setup for this type of layout. Please Configure it"
-                }
-
-            # Get suggested prompt before extraction
-            suggested_prompt = processor.find_suggested_prompt(
-                current_client=metadata["client_name"],
-                current_layout=metadata["layout"],
-                cursor=cur
+        tmp_path, content_hash, _ = await upload_spool.spool(file)
+        try:
+            response = await run_document_pipeline(
+                tmp_path, file.filename, schema, use_cache,
+                require_known_client=True, content_hash=content_hash
             )
+        finally:
+            upload_spool.discard(tmp_path)
+        return _as_inference_response(response)
+
+    except json.JSONDecodeError:
+        return {"status": "error", "message": "Invalid schema JSON format."}
+    except UploadTooLargeError as e:
+        return _upload_too_large(e)
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+def _as_inference_response(response: Dict[str, Any]) -> Dict[str, Any]:
+    """/inference-document/ returns the extraction under "extracted_data"."""
+    if response.get("status") != "success":
+        return response
+    return {
+        key if key != "generated_json" else "extracted_data": value
+        for key, value in response.items()
+    }
+
+# === Server-sent events (streaming variants of /process-document/ and /try-prompt/) ===
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(sanitize_for_json(data))}\n\n"
+
+
+async def _sse_from_task(run: Callable[[Callable[[str, Any], None]], Any], cleanup: Callable[[], None] = None):
+    """
+    Run `run(emit)` as a task and yield every emit(event, payload) as an SSE frame as
+    soon as it happens, then a final "result" (or "error") frame with the return value.
+    """
+    events: asyncio.Queue = asyncio.Queue()
+    task = asyncio.create_task(run(lambda event, payload: events.put_nowait((event, payload))))
+    task.add_done_callback(lambda _: events.put_nowait(None))
+    try:
+        while True:
+            item = await events.get()
+            if item is None:
+                break
+            yield _sse(*item)
+        try:
+            result = task.result()
+            yield _sse("result" if result.get("status") == "success" else "error", result)
+        except Exception as e:
+            yield _sse("error", {"status": "error", "message": str(e)})
+    finally:
+        if not task.done():
+            # Client went away mid-stream
+            task.cancel()
+        if cleanup is not None:
+            cleanup()
+
+
+@app.post("/process-document/stream/")
+async def process_document_stream(
+    file: UploadFile = File(...),
+    schema_json: str = Form(...),
+    use_cache: bool = Form(True)
+):
+    """
+    /process-document/ as a text/event-stream: "stage" events as each stage starts,
+    then "docling" (markdown), "metadata", "suggested_prompt", "token" (extraction
+    answer deltas streamed from OCI) and finally "result" with the usual response body.
+    """
+    try:
+        schema = json.loads(schema_json)
+        # Add FileName to schema
+        schema["FileName"] = ""
+    except json.JSONDecodeError:
+        return {"status": "error", "message": "Invalid schema JSON format."}
+
+    try:
+        tmp_path, content_hash, _ = await upload_spool.spool(file)
+    except UploadTooLargeError as e:
+        return _upload_too_large(e)
+
+    async def _run(emit):
+        return await run_document_pipeline(
+            tmp_path,
+            file.filename,
+            schema,
+            use_cache,
+            on_stage=lambda stage: emit("stage", {"stage": stage}),
+            on_event=emit,
+            content_hash=content_hash,
+        )
+
+    return StreamingResponse(
+        _sse_from_task(_run, lambda: upload_spool.discard(tmp_path)),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
 
-            # Run CPU-bound extraction in thread pool
-            def extract_with_schema():
-                return processor.extract_json_with_schema(
-                    structured_markdown,
-                    schema,
-                    suggested_prompt
+# === Batch upload (NDJSON stream of per-file results) ===
+@app.post("/batch-process/")
+async def batch_process(
+    files: List[UploadFile] = File(...),
+    schema_json: str = Form(...),
+    mode: str = Form("process"),
+    use_cache: bool = Form(True),
+    concurrency: int = Form(4)
+):
+    """
+    Process many files against one schema. Files go through the same pipeline as
+    /process-document/ (or /inference-document/ with mode="inference"), at most
+    `concurrency` at a time, so conversion of one file overlaps extraction of another.
+    Each result is streamed as one NDJSON line as soon as it finishes, followed by a
+    summary line.
+    """
+    try:
+        if mode not in ("process", "inference"):
+            return {"status": "error", "message": "mode must be 'process' or 'inference'"}
+        schema = json.loads(schema_json)
+        # Add FileName to schema
+        schema["FileName"] = ""
+    except json.JSONDecodeError:
+        return {"status": "error", "message": "Invalid schema JSON format."}
+
+    # Spool every upload before streaming starts; the request body is gone afterwards
+    uploads = []
+    try:
+        for index, file in enumerate(files):
+            tmp_path, content_hash, _ = await upload_spool.spool(file)
+            uploads.append((index, file.filename, tmp_path, content_hash))
+    except UploadTooLargeError as e:
+        for _, _, tmp_path, _ in uploads:
+            upload_spool.discard(tmp_path)
+        return _upload_too_large(e)
+
+    semaphore = asyncio.Semaphore(max(1, min(concurrency, 32)))
+
+    async def _process_one(index: int, filename: str, tmp_path: str, content_hash: str) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                response = await run_document_pipeline(
+                    tmp_path,
+                    filename,
+                    dict(schema),
+                    use_cache,
+                    require_known_client=mode == "inference",
+                    content_hash=content_hash,
                 )
-            
-            generated_json, output_tokens = await loop.run_in_executor(executor, extract_with_schema)
-            # Add filename to generated JSON
-            generated_json["FileName"] = file.filename
-
-            # Check if there are existing prompts for this layout
-            layout_json = json.dumps(metadata["layout"])
-            existing_prompts = processor.get_latest_prompt_for_layout(layout_json, cur)
-            
-            # If a suggested prompt was used, add it to the prompt history
-            prompt_to_save = existing_prompts
-            if suggested_prompt and not existing_prompts:
-                # First document with this layout - save the suggested prompt as version 1
-                import datetime
-                prompt_to_save = [{
-                    "prompt": suggested_prompt,
-                    "timestamp": datetime.datetime.now().isoformat()
-                }]
-            elif suggested_prompt and existing_prompts:
-                # Check if the suggested prompt is already in the history
-                # If not, it means a new prompt was applied, add it
-                prompt_texts = [p.get("prompt", "") for p in existing_prompts]
-                if suggested_prompt not in prompt_texts:
-                    import datetime
-                    prompt_to_save = existing_prompts + [{
-                        "prompt": suggested_prompt,
-                        "timestamp": datetime.datetime.now().isoformat()
-                    }]
-            
-            # Store document in SQLite with inherited/applied prompts
-            file_type = get_file_type(file.filename)
-            cur.execute(
-                """
-                INSERT INTO documents (filename, file_type, client_name, language, layout, user_prompt)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    file.filename,
-                    file_type,
-                    metadata["client_name"],
-                    metadata["language"],
-                    layout_json,
-                    json.dumps(prompt_to_save) if prompt_to_save else None
-                ),
-            )
-            doc_id = cur.lastrowid
-            
-            # Calculate inherited version
-            inherited_version = len(prompt_to_save) if prompt_to_save else 0
+                if mode == "inference":
+                    response = _as_inference_response(response)
+            except Exception as e:
+                response = {"status": "error", "message": str(e)}
+            finally:
+                upload_spool.discard(tmp_path)
+        return {"index": index, "filename": filename, **response}
+
+    async def _stream():
+        tasks = [asyncio.create_task(_process_one(*upload)) for upload in uploads]
+        succeeded = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                if result.get("status") == "success":
+                    succeeded += 1
+                yield json.dumps(sanitize_for_json(result)) + "\n"
+            yield json.dumps({
+                "status": "done",
+                "total": len(tasks),
+                "succeeded": succeeded,
+                "failed": len(tasks) - succeeded,
+            }) + "\n"
+        finally:
+            # Client went away: stop the remaining files and drop their uploads
+            for task in tasks:
+                task.cancel()
+            for _, _, tmp_path, _ in uploads:
+                upload_spool.discard(tmp_path)
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
+
+# === Asynchronous job API ===
+job_queue = JobQueue(
+    db_path=os.getenv("JOBS_DB", "jobs.db"),
+    upload_dir=os.getenv("JOBS_UPLOAD_DIR", "uploads"),
+    concurrency=int(os.getenv("JOB_WORKERS", "2")),
+    max_pending=int(os.getenv("JOB_MAX_PENDING", "500")),
+    max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "3")),
+)
 
-        return {
-            "status": "success",
-            "document_id": doc_id,
-            "filename": file.filename,
-            "structured_markdown": structured_markdown,
-            "extracted_data": sanitize_for_json(generated_json),
-            "suggested_prompt": suggested_prompt,
-            "oci_output_tokens": output_tokens,
-            "inherited_version": inherited_version,
-            "message": f"Document created with version {inherited_version} (inherited from layout)" if inherited_version > 0 else "Document created with version 0"
-        }
 
+async def _run_job(job: Dict[str, Any], on_stage: Callable[[str], None]) -> Dict[str, Any]:
+    """Job handler: run the shared upload pipeline on the persisted upload."""
+    try:
+        schema = json.loads(job["schema_json"])
     except json.JSONDecodeError:
         return {"status": "error", "message": "Invalid schema JSON format."}
+    schema["FileName"] = ""
+
+    # Each job is its own trace; the job id doubles as its request id in logs
+    with TRACER.trace(f"job {job['kind']}", job["job_id"], filename=job["filename"]):
+        response = await run_document_pipeline(
+            job["file_path"],
+            job["filename"],
+            schema,
+            job["use_cache"],
+            require_known_client=job["kind"] == "inference",
+            on_stage=on_stage,
+        )
+    return _as_inference_response(response) if job["kind"] == "inference" else response
+
+
+@app.on_event("startup")
+async def start_job_workers():
+    upload_spool.sweep()
+    job_queue.start(_run_job)
+    REGISTRY.start()
+    processor.layout_index.start(database.read)
+
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    await job_queue.stop()
+
+
+@app.post("/jobs/")
+async def submit_job(
+    file: UploadFile = File(...),
+    schema_json: str = Form(...),
+    mode: str = Form("process"),
+    use_cache: bool = Form(True)
+):
+    """
+    Queue a document for processing and return its job id immediately.
+    mode is "process" (like /process-document/) or "inference" (like /inference-document/).
+    """
+    try:
+        if mode not in ("process", "inference"):
+            return {"status": "error", "message": "mode must be 'process' or 'inference'"}
+        json.loads(schema_json)
+
+        tmp_path, _, _ = await upload_spool.spool(file)
+        try:
+            job_id = await job_queue.asubmit(mode, file.filename, tmp_path, schema_json, use_cache)
+        finally:
+            # submit() moves the file into the job upload dir; this only removes it on failure
+            upload_spool.discard(tmp_path)
+        return {"status": "success", "job_id": job_id, "job_status": "queued"}
+
+    except json.JSONDecodeError:
+        return {"status": "error", "message": "Invalid schema JSON format."}
+    except UploadTooLargeError as e:
+        return _upload_too_large(e)
+    except QueueFullError as e:
+        return JSONResponse(status_code=429, content={"status": "error", "message": str(e)})
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+
+@app.get("/jobs/")
+async def list_jobs(status: str = None, limit: int = 50):
+    try:
+        return {"status": "success", "jobs": await job_queue.alist(status, min(limit, 500))}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status, current stage and (once finished) the result of a job."""
+    try:
+        job = await job_queue.aget(job_id)
+        if job is None:
+            return {"status": "error", "message": "Job not found"}
+        return {"status": "success", **job}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
 # === Try Prompt (no save) ===
 @app.post("/try-prompt/")
 async def try_prompt(
     document: str = Body(...),
     user_prompt: str = Body(...),
-    schema_json: str = Body(...)
+    schema_json: str = Body(...),
+    use_cache: bool = Body(True)
 ):
     try:
         schema = json.loads(schema_json)
+        custom_prompt = _build_try_prompt(document, user_prompt, schema)
+        with collect_usage() as usage:
+            try:
+                raw_json, output_tokens = await processor._acall_oci_llm(
+                    custom_prompt, use_cache=use_cache, priority=INTERACTIVE, purpose="try_prompt"
+                )
+            finally:
+                await _save_usage(usage)
+        return _try_prompt_response(raw_json, output_tokens)
+
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
 
-        custom_prompt = f"""
+def _build_try_prompt(document: str, user_prompt: str, schema: Dict[str, Any]) -> str:
+    return f"""
         Instruction: {user_prompt}
         Document: {document}
         Extract data into JSON with this schema:
         {json.dumps(schema, indent=2)}
         """
-        raw_json, output_tokens = processor._call_oci_llm(custom_prompt)
-        try:
-            parsed_json = json.loads(raw_json)
-        except:
-            parsed_json = {"error": "Failed to parse JSON", "raw": raw_json}
 
-        return {
-            "status": "success",
-            "generated_json": sanitize_for_json(parsed_json),
-            "oci_output_tokens": output_tokens,
-        }
 
+def _try_prompt_response(raw_json: str, output_tokens) -> Dict[str, Any]:
+    try:
+        parsed_json = json.loads(raw_json)
+    except:
+        JSON_PARSE_FAILURES.inc(1, "try_prompt")
+        parsed_json = {"error": "Failed to parse JSON", "raw": raw_json}
+
+    return {
+        "status": "success",
+        "generated_json": sanitize_for_json(parsed_json),
+        "oci_output_tokens": output_tokens,
+    }
+
+
+@app.post("/try-prompt/stream/")
+async def try_prompt_stream(
+    document: str = Body(...),
+    user_prompt: str = Body(...),
+    schema_json: str = Body(...),
+    use_cache: bool = Body(True)
+):
+    """/try-prompt/ as a text/event-stream: "token" events as OCI streams the answer, then "result"."""
+    try:
+        schema = json.loads(schema_json)
     except Exception as e:
         return {"status": "error", "message": str(e)}
+    custom_prompt = _build_try_prompt(document, user_prompt, schema)
+
+    async def _run(emit):
+        with collect_usage() as usage:
+            try:
+                raw_json, output_tokens = await processor._astream_oci_llm(
+                    custom_prompt, lambda text: emit("token", {"text": text}),
+                    use_cache=use_cache, priority=INTERACTIVE, purpose="try_prompt"
+                )
+            finally:
+                await _save_usage(usage)
+        return _try_prompt_response(raw_json, output_tokens)
+
+    return StreamingResponse(_sse_from_task(_run), media_type="text/event-stream", headers=SSE_HEADERS)
 
 
 # === Save Prompt (persist and create new version) ===
@@ -336,24 +742,25 @@ async def save_prompt(
     This applies the prompt to all documents with the same layout.
     """
     try:
-        with get_db() as (conn, cur):
+        def _save(conn, cur):
             # Get the document's layout
             cur.execute("SELECT layout FROM documents WHERE id = ?", (document_id,))
-        row = cur.fetchone()
-        
-        if not row:
-            return {"status": "error", "message": "Document not found"}
-        
-            layout = row[0]
-            
+            row = cur.fetchone()
+            if not row:
+                return None
+
             # Apply prompt to all documents with the same layout
-            updated_count = processor.update_prompt_for_layout(layout, user_prompt, cur, conn)
-            
-            return {
-                "status": "success", 
-                "message": f"Prompt saved and applied to {updated_count} document(s) with the same layout",
-                "updated_count": updated_count
-            }
+            return processor.update_prompt_for_layout(row[0], user_prompt, cur, database.after_commit)
+
+        updated_count = await database.awrite(_save)
+        if updated_count is None:
+            return {"status": "error", "message": "Document not found"}
+
+        return {
+            "status": "success", 
+            "message": f"Prompt saved and applied to {updated_count} document(s) with the same layout",
+            "updated_count": updated_count
+        }
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
@@ -364,78 +771,217 @@ def _normalize_value(value: Any):
         return None
     return value
 
+# === Document listings: filters + keyset pagination over (created_at, id) ===
+DOCUMENT_COLUMNS = "id, filename, file_type, client_name, language, created_at"
+MAX_PAGE_SIZE = 1000
+# Page size when the request pages with `cursor` but gives no `limit`
+DEFAULT_PAGE_SIZE = int(os.getenv("DOCUMENTS_PAGE_SIZE", "200"))
+EXPORT_PAGE_SIZE = 500
+
+
+def _encode_cursor(key: Tuple[str, int]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(token: str) -> Tuple[str, int]:
+    created_at, doc_id = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    return created_at, int(doc_id)
+
+
+def _document_filters(
+    client_name: Optional[str],
+    file_type: Optional[str],
+    created_from: Optional[str],
+    created_to: Optional[str],
+) -> Tuple[List[str], List[Any]]:
+    """WHERE clauses for the listing filters (dates as "YYYY-MM-DD[ HH:MM:SS]", inclusive)."""
+    clauses, params = [], []
+    if client_name:
+        clauses.append("client_name = ?")
+        params.append(client_name)
+    if file_type:
+        clauses.append("file_type = ?")
+        params.append(file_type.lower().lstrip("."))
+    if created_from:
+        clauses.append("created_at >= ?")
+        params.append(created_from)
+    if created_to:
+        # A bare date includes the whole day
+        clauses.append("created_at <= ?")
+        params.append(created_to if len(created_to) > 10 else f"{created_to} 23:59:59")
+    return clauses, params
+
+
+def _page_limit(limit: Optional[int], cursor: Optional[str]) -> Optional[int]:
+    """Rows per page, or None (the whole listing) when the request asks for no paging."""
+    if limit is None and not cursor:
+        return None
+    return max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+
+
+def _count_documents(cur, filters: Tuple[List[str], List[Any]]) -> int:
+    clauses, params = filters
+    query = "SELECT COUNT(*) FROM documents"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    cur.execute(query, params)
+    return cur.fetchone()[0]
+
+
+def _document_page(
+    cur,
+    filters: Tuple[List[str], List[Any]],
+    after: Optional[Tuple[str, int]],
+    limit: Optional[int],
+    to_dict: Callable[[tuple, List[Dict[str, Any]]], Dict[str, Any]],
+) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, int]]]:
+    """
+    One page of documents, newest first, starting after the keyset `after`.
+    Prompt histories for the whole page are loaded in one batch. Returns
+    (documents, key of the last row when more rows follow, else None).
+    """
+    clauses, params = list(filters[0]), list(filters[1])
+    if after is not None:
+        # Row-value comparison walks the (created_at, id) index from the cursor
+        clauses.append("(created_at, id) < (?, ?)")
+        params.extend(after)
+    # created_at is stored as "YYYY-MM-DD HH:MM:SS", so text order is time order (indexed)
+    query = f"SELECT {DOCUMENT_COLUMNS} FROM documents"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY created_at DESC, id DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit + 1)
+    cur.execute(query, params)
+    rows = cur.fetchall()
+
+    next_key = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_key = (rows[-1][5], rows[-1][0])
+    histories = load_histories(cur, [row[0] for row in rows])
+    return [to_dict(row, histories.get(row[0], [])) for row in rows], next_key
+
+
+def _stream_document_export(filters, to_dict) -> StreamingResponse:
+    """The full filtered listing as one JSON document, written page by page."""
+    async def _stream():
+        def _read_page(after):
+            with database.read() as (conn, cur):
+                return _document_page(cur, filters, after, EXPORT_PAGE_SIZE, to_dict)
+
+        yield '{"status": "success", "documents": ['
+        after, total = None, 0
+        while True:
+            documents, after = await run_in_executor(executor, _read_page, after)
+            for document in documents:
+                yield ("," if total else "") + json.dumps(sanitize_for_json(document))
+                total += 1
+            if after is None:
+                break
+        yield f'], "total_processed": {total}}}'
+
+    return StreamingResponse(_stream(), media_type="application/json")
+
+
+def _listing_response(documents: List[Dict[str, Any]], next_key, limit: Optional[int], **extra) -> Dict[str, Any]:
+    response = {"status": "success", **extra, "documents": documents}
+    if limit is not None:
+        response["next_cursor"] = _encode_cursor(next_key) if next_key else None
+        response["has_more"] = next_key is not None
+    return response
+
+
+def _document_summary(row: tuple, history: List[Dict[str, Any]]) -> Dict[str, Any]:
+    doc_id, filename, file_type, client_name, language, created_at = row
+    return {
+        "filename": _normalize_value(filename),
+        "file_type": _normalize_value(file_type),
+        "created_at": _normalize_value(created_at),
+        "user_prompt": _normalize_value(history_json(history)),
+        "client_name": _normalize_value(client_name),
+        "language": _normalize_value(language),
+    }
+
+
+def _document_with_versions(row: tuple, history: List[Dict[str, Any]]) -> Dict[str, Any]:
+    doc_id, filename, file_type, client_name, language, created_at = row
+    versions = processor.versions_from_history(history, created_at)
+    return {
+        "id": f"doc-{doc_id}",
+        "filename": _normalize_value(filename),
+        "file_type": _normalize_value(file_type),
+        "client_name": _normalize_value(client_name),
+        "language": _normalize_value(language),
+        "created_at": _normalize_value(created_at),
+        "versions": versions,
+        # Determine current version (latest version number)
+        "current_version": len(versions) - 1 if versions else 0
+    }
+
+
 # === Documents listing (filename, file_type, created_at, user_prompt) ===
 @app.get("/documents/")
-async def list_documents():
+async def list_documents(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    client_name: Optional[str] = None,
+    file_type: Optional[str] = None,
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
+    stream: bool = False
+):
+    """
+    Documents, newest first. Without `limit` or `cursor` the whole listing is returned;
+    with either, `limit` (default DOCUMENTS_PAGE_SIZE, max 1000) rows per page and the
+    response carries `next_cursor` to pass as `cursor` for the next page.
+    `total_processed` is always the number of documents matching the filters.
+    stream=true streams the full listing for exports.
+    """
     try:
-        with get_db() as (conn, cur):
-            cur.execute("""
-                SELECT filename, file_type, created_at, user_prompt, client_name, language
-                FROM documents
-                ORDER BY datetime(created_at) DESC, id DESC
-            """)
-            rows = cur.fetchall()
-            documents: List[Dict[str, Any]] = []
-            for row in rows:
-                filename, file_type, created_at, user_prompt, client_name, language = row
-                documents.append({
-                    "filename": _normalize_value(filename),
-                    "file_type": _normalize_value(file_type),
-                    "created_at": _normalize_value(created_at),
-                    "user_prompt": _normalize_value(user_prompt),
-                    "client_name": _normalize_value(client_name),
-                    "language": _normalize_value(language),     
-                })
-            return {
-                "status": "success",
-                "total_processed": len(documents),
-                "documents": documents
-            }
+        filters = _document_filters(client_name, file_type, created_from, created_to)
+        if stream:
+            return _stream_document_export(filters, _document_summary)
+        limit = _page_limit(limit, cursor)
+        after = _decode_cursor(cursor) if cursor else None
+        def _read(conn, cur):
+            documents, next_key = _document_page(cur, filters, after, limit, _document_summary)
+            total = len(documents) if limit is None else _count_documents(cur, filters)
+            return documents, next_key, total
+
+        documents, next_key, total = await database.aread(_read, executor)
+        return _listing_response(documents, next_key, limit, total_processed=total)
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 # === Version Control Endpoints ===
 
 @app.get("/documents-with-versions/")
-async def get_documents_with_versions():
+async def get_documents_with_versions(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    client_name: Optional[str] = None,
+    file_type: Optional[str] = None,
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
+    stream: bool = False
+):
     """
-    Get all documents with their complete version history.
+    Get documents with their complete version history.
     Returns documents in the format expected by the frontend version control page.
+    Accepts the same filters, `limit`/`cursor` paging and `stream` export as /documents/.
     """
     try:
-        with get_db() as (conn, cur):
-            cur.execute("""
-                SELECT id, filename, file_type, client_name, language, layout, user_prompt, created_at
-                FROM documents
-                ORDER BY datetime(created_at) DESC, id DESC
-            """)
-            rows = cur.fetchall()
-            
-            documents = []
-            for row in rows:
-                doc_id, filename, file_type, client_name, language, layout, user_prompt, created_at = row
-                
-                # Get version history for this document
-                versions = processor.get_document_versions(doc_id, cur)
-                
-                # Determine current version (latest version number)
-                current_version = len(versions) - 1 if versions else 0
-                
-                documents.append({
-                    "id": f"doc-{doc_id}",
-                    "filename": _normalize_value(filename),
-                    "file_type": _normalize_value(file_type),
-                    "client_name": _normalize_value(client_name),
-                    "language": _normalize_value(language),
-                    "created_at": _normalize_value(created_at),
-                    "versions": versions,
-                    "current_version": current_version
-                })
-            
-            return {
-                "status": "success",
-                "documents": documents
-            }
+        filters = _document_filters(client_name, file_type, created_from, created_to)
+        if stream:
+            return _stream_document_export(filters, _document_with_versions)
+        limit = _page_limit(limit, cursor)
+        after = _decode_cursor(cursor) if cursor else None
+        documents, next_key = await database.aread(
+            lambda conn, cur: _document_page(cur, filters, after, limit, _document_with_versions), executor
+        )
+        return _listing_response(documents, next_key, limit)
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
@@ -446,17 +992,16 @@ async def get_document_versions(document_id: int):
     Get version history for a specific document.
     """
     try:
-        with get_db() as (conn, cur):
-            versions = processor.get_document_versions(document_id, cur)
-            
-            if not versions:
-                return {"status": "error", "message": "Document not found"}
-            
-            return {
-                "status": "success",
-                "versions": versions,
-                "current_version": len(versions) - 1
-            }
+        versions = await database.aread(lambda conn, cur: processor.get_document_versions(document_id, cur), executor)
+
+        if not versions:
+            return {"status": "error", "message": "Document not found"}
+
+        return {
+            "status": "success",
+            "versions": versions,
+            "current_version": len(versions) - 1
+        }
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
@@ -475,19 +1020,22 @@ async def update_document_version(
         if version == 0:
             return {"status": "error", "message": "Cannot edit system prompt (version 0)"}
         
-        with get_db() as (conn, cur):
-            success = processor.update_specific_version(document_id, version, new_prompt, cur, conn)
-            
-            if success:
-                # Get updated versions
-                versions = processor.get_document_versions(document_id, cur)
-                return {
-                    "status": "success",
-                    "message": "Prompt updated successfully",
-                    "versions": versions
-                }
-            else:
-                return {"status": "error", "message": "Failed to update prompt. Version may not exist."}
+        success = await database.awrite(
+            lambda conn, cur: processor.update_specific_version(document_id, version, new_prompt, cur, database.after_commit)
+        )
+        
+        if success:
+            # Get updated versions
+            versions = await database.aread(
+                lambda conn, cur: processor.get_document_versions(document_id, cur), executor
+            )
+            return {
+                "status": "success",
+                "message": "Prompt updated successfully",
+                "versions": versions
+            }
+        else:
+            return {"status": "error", "message": "Failed to update prompt. Version may not exist."}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
@@ -502,25 +1050,99 @@ async def apply_prompt_to_layout(
     This creates a new version for all matching documents.
     """
     try:
-        with get_db() as (conn, cur):
-            updated_count = processor.update_prompt_for_layout(layout, new_prompt, cur, conn)
-            
-            return {
-                "status": "success",
-                "message": f"Prompt applied to {updated_count} document(s)",
-                "updated_count": updated_count
-            }
+        updated_count = await database.awrite(
+            lambda conn, cur: processor.update_prompt_for_layout(layout, new_prompt, cur, database.after_commit)
+        )
+        
+        return {
+            "status": "success",
+            "message": f"Prompt applied to {updated_count} document(s)",
+            "updated_count": updated_count
+        }
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+# === Cache statistics (per worker process) ===
+@app.get("/cache/stats/")
+async def cache_stats():
+    return {
+        "status": "success",
+        "docling": processor.docling_cache.stats() if processor.docling_cache else None,
+        "llm": processor.llm_cache.stats() if processor.llm_cache else None,
+    }
+
+
+# === Docling process pool statistics (per worker process) ===
+@app.get("/conversion/stats/")
+async def conversion_stats():
+    return {
+        "status": "success",
+        "conversion": processor.conversion_pool.stats() if processor.conversion_pool else None,
+    }
+
+
+# === SQLite read pool / write batching statistics (per worker process) ===
+@app.get("/db/stats/")
+async def db_stats():
+    return {"status": "success", "db": database.stats()}
+
+
+# === OCI retry / hedging / circuit breaker / rate limit statistics (per worker process) ===
+@app.get("/oci/stats/")
+async def oci_stats():
+    return {
+        "status": "success",
+        "oci": processor.resilience.stats(),
+        "rate_limit": await run_in_executor(None, processor.rate_limiter.stats),
+        "in_flight": processor.async_client.in_flight,
+    }
+
+
+# === LLM usage: calls, tokens and latency per purpose (all workers, from SQLite) ===
+@app.get("/usage/summary/")
+async def get_usage_summary(
+    group_by: str = "purpose",
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
+    document_id: Optional[int] = None,
+):
+    """
+    Aggregated llm_usage records (calls, tokens, cost, latency), grouped by purpose,
+    mode, outcome, model or day.
+    created_from / created_to are UTC dates or timestamps; document_id narrows to one document.
+    """
+    if group_by not in GROUP_COLUMNS:
+        return {"status": "error", "message": f"group_by must be one of {', '.join(GROUP_COLUMNS)}"}
+    try:
+        summary = await database.aread(
+            lambda conn, cur: usage_summary(cur, group_by, created_from, created_to, document_id), executor
+        )
+        return {"status": "success", **summary}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 
+# === Prometheus metrics (merged across all worker processes) ===
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
 # === Delete all documents from the database ===
 @app.delete("/delete-all-documents/")
 async def delete_all_documents():
     try:
-        with get_db() as (conn, cur):
+        def _delete_all(conn, cur):
+            cur.execute("DELETE FROM prompt_versions")
+            cur.execute("DELETE FROM layout_prompt_versions")
             cur.execute("DELETE FROM documents")
-            return {"status": "success", "message": "All documents have been deleted successfully."}
+            # Keep the spend history, unlinked from the deleted documents
+            cur.execute("UPDATE llm_usage SET document_id = NULL WHERE document_id IS NOT NULL")
+
+        await database.awrite(_delete_all)
+        processor.layout_index.clear()
+        return {"status": "success", "message": "All documents have been deleted successfully."}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
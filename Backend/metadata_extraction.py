@@ -0,0 +1,253 @@
+import re
+import json
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+# Legal-form suffixes that mark a line as naming a company
+COMPANY_PATTERN = re.compile(
+    r"\b(ltd|limited|llc|l\.l\.c|inc|corp|corporation|gmbh|ag|plc|pty|s\.?a\.?s?|s\.?l\.?|s\.?r\.?l\.?|"
+    r"s\.?p\.?a\.?|b\.?v\.?|n\.?v\.?|oy|ab|a/s|company|co\.)(?=\W|$)",
+    re.IGNORECASE,
+)
+_TABLE_SEPARATOR = re.compile(r"^\s*\|[\s:|-]+\|\s*$")
+
+# Values the metadata LLM returns when it could not find a client
+_UNKNOWN_VALUES = {"", "unknown", "n/a", "na", "none", "null", "<company name or client name>"}
+
+
+def markdown_table_headers(markdown: str) -> List[List[str]]:
+    """Header rows of every markdown table (the row right above a |---| separator)."""
+    lines = markdown.splitlines()
+    headers = []
+    for index in range(1, len(lines)):
+        if _TABLE_SEPARATOR.match(lines[index]) and lines[index - 1].lstrip().startswith("|"):
+            cells = [cell.strip() for cell in lines[index - 1].strip().strip("|").split("|")]
+            headers.append(cells)
+    return headers
+
+
+def markdown_lead_blocks(markdown: str, max_blocks: int) -> List[str]:
+    """First non-table blocks of the markdown (used when no Docling structure is cached)."""
+    blocks = []
+    for block in re.split(r"\n\s*\n", markdown):
+        block = block.strip()
+        if block and not block.startswith("|"):
+            blocks.append(block)
+            if len(blocks) >= max_blocks:
+                break
+    return blocks
+
+
+def document_outline(markdown: str, doc_metadata: Dict[str, Any], max_blocks: int) -> Dict[str, List]:
+    """Lead blocks + table headers, from the Docling structure when available, else from markdown."""
+    structure = doc_metadata.get("structure") or {}
+    lead_blocks = structure.get("lead_blocks") or markdown_lead_blocks(markdown, max_blocks)
+    table_headers = structure.get("table_headers")
+    if table_headers is None:
+        table_headers = markdown_table_headers(markdown)
+    return {"lead_blocks": lead_blocks[:max_blocks], "table_headers": table_headers}
+
+
+def company_lines(markdown: str, limit: int = 10) -> List[str]:
+    """Lines that look like they name a company (legal-form suffix), in document order."""
+    found = []
+    for line in markdown.splitlines():
+        line = line.strip().strip("#|").strip()
+        if line and len(line) <= 200 and COMPANY_PATTERN.search(line) and line not in found:
+            found.append(line)
+            if len(found) >= limit:
+                break
+    return found
+
+
+def build_metadata_digest(markdown: str, doc_metadata: Dict[str, Any], max_blocks: int = 15) -> str:
+    """
+    Compact stand-in for the full document in the metadata prompt: the opening
+    blocks, the header row of each table and lines that name a company.
+    """
+    outline = document_outline(markdown, doc_metadata, max_blocks)
+    sections = ["Opening blocks:\n" + "\n".join(outline["lead_blocks"])]
+
+    if outline["table_headers"]:
+        rows = []
+        for header in outline["table_headers"]:
+            row = " | ".join(cell for cell in header if cell)
+            if row and row not in rows:
+                rows.append(row)
+        sections.append("Table header rows:\n" + "\n".join(rows))
+
+    lead_text = "\n".join(outline["lead_blocks"])
+    companies = [line for line in company_lines(markdown) if line not in lead_text]
+    if companies:
+        sections.append("Lines naming companies:\n" + "\n".join(companies))
+
+    return "\n\n".join(sections)
+
+
+def parse_metadata_answer(raw_meta: str) -> Optional[Dict[str, Any]]:
+    """The metadata LLM answer as a dict, or None if it is not a JSON object."""
+    try:
+        parsed = json.loads(raw_meta)
+    except (TypeError, ValueError):
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def metadata_is_confident(raw_meta: str, digest_has_tables: bool) -> bool:
+    """
+    Whether a metadata answer produced from the digest can be trusted: it must
+    parse, name a client, and report a layout when the digest contained tables.
+    """
+    parsed = parse_metadata_answer(raw_meta)
+    if parsed is None:
+        return False
+    client = str(parsed.get("client_name") or "").strip().lower()
+    if client in _UNKNOWN_VALUES:
+        return False
+    if digest_has_tables and not parsed.get("layout"):
+        return False
+    return True
+
+
+# === Local (LLM-free) metadata ===
+# Character trigram profiles per language, built from a short purchase-order style text
+# plus frequent function words and order vocabulary; a document is assigned the
+# language whose profile is closest (cosine) to the trigrams of its text.
+LANGUAGE_SAMPLES = {
+    "English": (
+        "Please deliver the goods listed in this purchase order to the address below. The total amount "
+        "includes shipping and is payable within thirty days of the invoice date. Item description, "
+        "quantity, unit price and delivery date are stated for each line of the order. Contact the buyer "
+        "with any questions about this order. "
+        "the and of to for in on with by is are this from please order purchase delivery date quantity "
+        "qty price total description item unit address invoice number ship shipping amount terms payment"
+    ),
+    "Spanish": (
+        "Por favor entreguen los artículos indicados en esta orden de compra en la dirección de entrega "
+        "que figura abajo. El importe total incluye el envío y se pagará dentro de los treinta días "
+        "siguientes a la fecha de la factura. La descripción, la cantidad, el precio unitario y la fecha "
+        "de entrega se indican para cada línea del pedido. Contacte con el comprador si tiene preguntas "
+        "sobre este pedido. "
+        "el la los las de del y en por para con que una un pedido orden compra entrega fecha cantidad "
+        "precio importe descripción artículo unidad dirección factura número envío pago proveedor"
+    ),
+    "French": (
+        "Veuillez livrer les articles indiqués dans ce bon de commande à l'adresse de livraison "
+        "ci-dessous. Le montant total comprend les frais d'expédition et est payable dans les trente "
+        "jours suivant la date de la facture. La désignation, la quantité, le prix unitaire et la date "
+        "de livraison sont indiqués pour chaque ligne de la commande. Contactez l'acheteur pour toute "
+        "question concernant cette commande. "
+        "le la les de des du et en pour avec par une un au aux commande achat livraison date quantité "
+        "prix montant désignation article unité adresse facture numéro expédition paiement fournisseur"
+    ),
+    "German": (
+        "Bitte liefern Sie die in dieser Bestellung aufgeführten Artikel an die unten angegebene "
+        "Lieferadresse. Der Gesamtbetrag enthält die Versandkosten und ist innerhalb von dreißig Tagen "
+        "nach dem Rechnungsdatum zu zahlen. Beschreibung, Menge, Einzelpreis und Liefertermin sind für "
+        "jede Position der Bestellung angegeben. Bei Fragen zu dieser Bestellung wenden Sie sich bitte "
+        "an den Einkäufer. "
+        "der die das und von zu für mit auf ist ein eine den dem bestellung auftrag lieferung "
+        "lieferdatum datum menge preis betrag beschreibung artikel einheit adresse rechnung nummer "
+        "versand zahlung"
+    ),
+    "Italian": (
+        "Si prega di consegnare gli articoli indicati in questo ordine di acquisto all'indirizzo di "
+        "consegna riportato sotto. L'importo totale comprende la spedizione ed è pagabile entro trenta "
+        "giorni dalla data della fattura. La descrizione, la quantità, il prezzo unitario e la data di "
+        "consegna sono indicati per ogni riga dell'ordine. Per qualsiasi domanda su questo ordine "
+        "contattare l'ufficio acquisti. "
+        "il lo la gli le di del della e in per con che una un ordine acquisto consegna data quantità "
+        "prezzo importo descrizione articolo unità indirizzo fattura numero spedizione pagamento fornitore"
+    ),
+    "Portuguese": (
+        "Por favor entreguem os artigos indicados nesta encomenda no endereço de entrega abaixo. O valor "
+        "total inclui o envio e deve ser pago no prazo de trinta dias a contar da data da fatura. A "
+        "descrição, a quantidade, o preço unitário e a data de entrega são indicados para cada linha do "
+        "pedido. Contacte o comprador se tiver dúvidas sobre esta encomenda. "
+        "o a os as de do da e em para com que uma um no na pedido encomenda compra entrega data "
+        "quantidade preço valor descrição artigo unidade endereço fatura número envio pagamento fornecedor"
+    ),
+    "Dutch": (
+        "Gelieve de artikelen uit deze bestelling te leveren op het onderstaande afleveradres. Het totale "
+        "bedrag is inclusief verzending en moet binnen dertig dagen na de factuurdatum worden betaald. "
+        "Omschrijving, aantal, prijs per eenheid en leverdatum staan bij elke regel van de bestelling "
+        "vermeld. Neem bij vragen over deze bestelling contact op met de inkoper. "
+        "de het een en van voor met op is aan bij te dit bestelling order levering leverdatum datum "
+        "aantal prijs bedrag omschrijving artikel eenheid adres factuur nummer verzending betaling"
+    ),
+}
+
+
+def char_trigrams(text: str) -> Dict[str, int]:
+    """Counts of the character trigrams of each word (letters only, lowercased, space-padded)."""
+    counts: Dict[str, int] = {}
+    for word in re.findall(r"[^\W\d_]+", text.lower()):
+        padded = f" {word} "
+        for index in range(len(padded) - 2):
+            gram = padded[index:index + 3]
+            counts[gram] = counts.get(gram, 0) + 1
+    return counts
+
+
+def _cosine(a: Dict[str, int], b: Dict[str, int]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    dot = sum(count * b.get(gram, 0) for gram, count in a.items())
+    if not dot:
+        return 0.0
+    norm = math.sqrt(sum(c * c for c in a.values())) * math.sqrt(sum(c * c for c in b.values()))
+    return dot / norm
+
+
+TRIGRAM_PROFILES = {language: char_trigrams(sample) for language, sample in LANGUAGE_SAMPLES.items()}
+
+
+def detect_language(text: str, min_letters: int = 40, min_score: float = 0.2) -> Tuple[str, float]:
+    """
+    (language name, cosine similarity of the text's character trigrams to that
+    language's profile). Returns ("Unknown", 0.0) for text too short to tell
+    (fewer than min_letters letters, e.g. a scan of numbers and codes) or when no
+    profile reaches min_score; callers then fall back to another source.
+    """
+    trigrams = char_trigrams(text)
+    # Every letter starts exactly one trigram of its padded word
+    if sum(trigrams.values()) < min_letters:
+        return "Unknown", 0.0
+    language, score = max(
+        ((language, _cosine(trigrams, profile)) for language, profile in TRIGRAM_PROFILES.items()),
+        key=lambda item: item[1],
+    )
+    if score < min_score:
+        return "Unknown", 0.0
+    return language, score
+
+
+def local_layout(table_headers: List[List[str]]) -> List[str]:
+    """Column headers of the widest table (usually the line-item table), in order."""
+    if not table_headers:
+        return []
+    widest = max(table_headers, key=lambda header: len([cell for cell in header if cell]))
+    layout = []
+    for cell in widest:
+        # Merged header cells are repeated once per spanned column
+        if cell and (not layout or layout[-1] != cell):
+            layout.append(cell)
+    return layout
+
+
+def _normalize_name(text: str) -> str:
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def match_known_client(text: str, known_clients: List[str]) -> Optional[str]:
+    """
+    The most specific (longest) known client name that appears in the text as a
+    whole-word match, ignoring case and punctuation.
+    """
+    haystack = f" {_normalize_name(text)} "
+    best = None
+    for client in known_clients:
+        name = _normalize_name(client or "")
+        if name and f" {name} " in haystack and (best is None or len(name) > len(_normalize_name(best))):
+            best = client
+    return best
@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import bisect
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Sequence, Tuple
+
+# Seconds; wide enough for OCR and LLM calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120, 240)
+# Seconds; for SQLite statements and queue waits
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    """Monotonic counter, one series per tuple of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def snapshot(self) -> List[Any]:
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._series.items()]
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram, one series per tuple of label values. observe() is a
+    bisect plus three additions under a lock, cheap enough for every call.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last slot is +Inf), sum, count]
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels: str):
+        """`with HISTOGRAM.time("label"):` observes the block's duration, even when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def snapshot(self) -> List[Any]:
+        with self._lock:
+            return [[list(labels), [list(counts), total, count]] for labels, (counts, total, count) in self._series.items()]
+
+
+class Registry:
+    """
+    The metrics of one worker process. Each gunicorn worker has its own registry
+    and writes a snapshot to directory/<pid>.json every flush_interval seconds;
+    render() merges the snapshots of all workers (summing the series), so a scrape
+    that lands on any worker sees the totals of the whole server.
+    """
+
+    def __init__(self, directory: str = None, flush_interval: float = 5.0, stale_after: float = 3600.0):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "dip-metrics")
+        self.flush_interval = flush_interval
+        self.stale_after = stale_after
+        self._metrics: Dict[str, Any] = {}
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    # === Cross-worker snapshots ===
+    def snapshot(self) -> Dict[str, Any]:
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def flush(self) -> None:
+        """Write this worker's snapshot atomically (readers never see a partial file)."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start(self) -> None:
+        """Start the background thread that flushes this worker's snapshot."""
+        with self._flusher_lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            try:
+                self.flush()
+            except Exception as e:
+                logging.warning(f"Failed to write metrics snapshot: {e}")
+            time.sleep(self.flush_interval)
+
+    def _load_snapshots(self) -> List[Dict[str, Any]]:
+        snapshots = []
+        cutoff = time.time() - self.stale_after
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")]
+        except OSError:
+            return snapshots
+        for entry in entries:
+            try:
+                # Workers that stopped flushing long ago (restarted with a new pid) drop out
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    continue
+                with open(entry.path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    # === Exposition ===
+    def render(self) -> str:
+        """All workers' metrics in the Prometheus text exposition format (0.0.4)."""
+        try:
+            self.flush()
+            snapshots = self._load_snapshots()
+        except OSError as e:
+            logging.warning(f"Metrics directory unavailable, serving this worker only: {e}")
+            snapshots = [self.snapshot()]
+
+        lines: List[str] = []
+        for name, metric in self._metrics.items():
+            merged: Dict[Tuple[str, ...], Any] = {}
+            for snapshot in snapshots:
+                for labels, value in snapshot.get(name, []):
+                    key = tuple(labels)
+                    if metric.kind == "counter":
+                        merged[key] = merged.get(key, 0) + value
+                    else:
+                        counts, total, count = merged.get(key) or ([0] * len(value[0]), 0.0, 0)
+                        merged[key] = ([a + b for a, b in zip(counts, value[0])], total + value[1], count + value[2])
+
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key in sorted(merged):
+                labels = list(zip(metric.labelnames, key))
+                if metric.kind == "counter":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(merged[key])}")
+                    continue
+                counts, total, count = merged[key]
+                cumulative = 0
+                for bound, bucket_count in zip(list(metric.buckets) + ["+Inf"], counts):
+                    cumulative += bucket_count
+                    le = bound if bound == "+Inf" else _format_value(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: List[Tuple[str, Any]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+REGISTRY = Registry(
+    directory=os.getenv("METRICS_DIR") or None,
+    flush_interval=float(os.getenv("METRICS_FLUSH_SECONDS", "5")),
+)
+
+# === Application metrics ===
+STAGE_SECONDS = REGISTRY.histogram(
+    "dip_stage_seconds", "Duration of document pipeline stages", ["stage"]
+)
+OCR_PAGE_SECONDS = REGISTRY.histogram(
+    "dip_ocr_page_seconds", "Docling conversion time per page (ocr=false: embedded text layer)", ["ocr"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60),
+)
+LLM_CALL_SECONDS = REGISTRY.histogram(
+    "dip_llm_call_seconds", "OCI chat calls including retries and rate-limit waits", ["mode", "outcome"]
+)
+LLM_TOKENS = REGISTRY.counter(
+    "dip_llm_tokens_total", "LLM tokens sent and received (input estimated from prompt length when OCI reports no usage)", ["direction"]
+)
+DB_SECONDS = REGISTRY.histogram(
+    "dip_db_seconds", "SQLite work: read = connection held by a reader, write = one write function, commit = batch commit", ["op"],
+    buckets=FAST_BUCKETS,
+)
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "dip_queue_wait_seconds", "Time spent waiting for a pool, queue, lock or rate budget", ["queue"],
+    buckets=FAST_BUCKETS + (30, 60, 120),
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    "dip_cache_requests_total", "Docling and LLM cache lookups", ["cache", "result"]
+)
+JSON_PARSE_FAILURES = REGISTRY.counter(
+    "dip_json_parse_failures_total", "LLM answers that were not the expected JSON", ["stage"]
+)
@@ -0,0 +1,230 @@
+import logging
+from typing import Callable, List
+
+from prompt_history import layout_hash, parse_prompt_history
+
+
+def _add_layout_hash_and_indexes(cursor) -> None:
+    """Hashed layout column plus indexes for client, layout and recency lookups."""
+    cursor.execute("PRAGMA table_info(documents)")
+    if "layout_hash" not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE documents ADD COLUMN layout_hash TEXT")
+
+    cursor.execute("SELECT id, layout FROM documents WHERE layout_hash IS NULL")
+    cursor.executemany(
+        "UPDATE documents SET layout_hash = ? WHERE id = ?",
+        [(layout_hash(layout), doc_id) for doc_id, layout in cursor.fetchall()],
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_client_name ON documents(client_name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_layout_hash ON documents(layout_hash, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_created_at ON documents(created_at, id)")
+
+
+def _move_prompt_history(cursor) -> None:
+    """Move the user_prompt JSON history into one prompt_versions row per version."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS prompt_versions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        document_id INTEGER NOT NULL,
+        version INTEGER NOT NULL,   -- 1-based; version 0 is the implicit system prompt
+        prompt TEXT,
+        timestamp TEXT,
+        UNIQUE (document_id, version)
+    )
+    """)
+    cursor.execute("SELECT id, user_prompt FROM documents WHERE user_prompt IS NOT NULL")
+    for doc_id, user_prompt in cursor.fetchall():
+        cursor.executemany(
+            "INSERT INTO prompt_versions (document_id, version, prompt, timestamp) VALUES (?, ?, ?, ?)",
+            [
+                (doc_id, version, entry["prompt"], entry["timestamp"])
+                for version, entry in enumerate(parse_prompt_history(user_prompt), start=1)
+            ],
+        )
+    cursor.execute("UPDATE documents SET user_prompt = NULL WHERE user_prompt IS NOT NULL")
+
+
+def _add_layout_versions_column(cursor) -> None:
+    """documents.layout_versions: how many of its layout's versions a document sees (NULL: all)."""
+    cursor.execute("PRAGMA table_info(documents)")
+    if "layout_versions" not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE documents ADD COLUMN layout_versions INTEGER")
+
+
+def _share_prompt_versions_per_layout(cursor) -> None:
+    """
+    Store prompt versions once per layout (layout_prompt_versions). The history of the
+    most recent document of each layout becomes the layout's history. Every other
+    document reads back exactly its own history: it is capped (layout_versions) at the
+    versions it shares with the layout, and prompt_versions keeps the rest of it.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS layout_prompt_versions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        layout_hash TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        prompt TEXT,
+        timestamp TEXT,
+        UNIQUE (layout_hash, version)
+    )
+    """)
+    _add_layout_versions_column(cursor)
+
+    # Documents without any version are listed too: they must not inherit the layout's
+    cursor.execute("""
+        SELECT d.layout_hash, d.id, p.version, p.prompt, p.timestamp
+        FROM documents d LEFT JOIN prompt_versions p ON p.document_id = d.id
+        ORDER BY d.layout_hash, d.created_at, d.id, p.version
+    """)
+    per_layout = {}
+    for key, doc_id, version, prompt, timestamp in cursor.fetchall():
+        history = per_layout.setdefault(key, {}).setdefault(doc_id, [])
+        if version is not None:
+            history.append((version, prompt, timestamp))
+
+    for key, documents in per_layout.items():
+        # Documents are in creation order, so the last one with a history is the most recent
+        histories = [history for history in documents.values() if history]
+        if not histories:
+            continue
+        layout_history = histories[-1]
+        cursor.executemany(
+            "INSERT INTO layout_prompt_versions (layout_hash, version, prompt, timestamp) VALUES (?, ?, ?, ?)",
+            [(key, version, prompt, timestamp) for version, prompt, timestamp in layout_history],
+        )
+        for doc_id, history in documents.items():
+            shared = 0
+            while (
+                shared < min(len(history), len(layout_history))
+                and history[shared][1:] == layout_history[shared][1:]
+            ):
+                shared += 1
+            # The shared prefix is read from the layout; later versions stay per document
+            cursor.execute(
+                "DELETE FROM prompt_versions WHERE document_id = ? AND version <= ?",
+                (doc_id, shared),
+            )
+            if not shared == len(history) == len(layout_history):
+                cursor.execute("UPDATE documents SET layout_versions = ? WHERE id = ?", (shared, doc_id))
+
+
+def _add_listing_indexes(cursor) -> None:
+    """(filter column, created_at, id) indexes so filtered listings page without sorting."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_client_created ON documents(client_name, created_at, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_file_type_created ON documents(file_type, created_at, id)")
+    # Covered by the composite index's leading column
+    cursor.execute("DROP INDEX IF EXISTS idx_documents_client_name")
+
+
+def _add_llm_usage(cursor) -> None:
+    """One row per LLM call (tokens, latency, purpose), linked to its document when there is one."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS llm_usage (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        document_id INTEGER,            -- NULL: try-prompt, an upload that was not saved, or a deleted document
+        request_id TEXT,
+        purpose TEXT NOT NULL,          -- metadata, extraction, combined, layout_compare, try_prompt, ...
+        mode TEXT NOT NULL,             -- sync | async | stream
+        outcome TEXT NOT NULL,          -- success | error
+        cached INTEGER NOT NULL DEFAULT 0,
+        input_tokens INTEGER NOT NULL DEFAULT 0,
+        output_tokens INTEGER NOT NULL DEFAULT 0,
+        total_tokens INTEGER NOT NULL DEFAULT 0,
+        tokens_estimated INTEGER NOT NULL DEFAULT 0,  -- 1: OCI reported no usage, tokens estimated from the prompt
+        latency_ms REAL NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_llm_usage_document ON llm_usage(document_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_llm_usage_created_at ON llm_usage(created_at)")
+
+
+def _branch_documents_from_layout_history(cursor) -> None:
+    """
+    Record each document's branch point instead of capping documents when a layout
+    gains a version: documents.layout_versions becomes the number of layout versions
+    a document saw when it was inserted, layout versions can be shared with every
+    document (all_documents) or belong to one document (document_id), and
+    prompt_versions rows edit a layout version rather than a history position.
+    Every document's history reads back unchanged.
+    """
+    cursor.execute("PRAGMA table_info(layout_prompt_versions)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if "document_id" not in columns:
+        cursor.execute("ALTER TABLE layout_prompt_versions ADD COLUMN document_id INTEGER")
+    if "all_documents" not in columns:
+        cursor.execute("ALTER TABLE layout_prompt_versions ADD COLUMN all_documents INTEGER NOT NULL DEFAULT 0")
+
+    cursor.execute("SELECT layout_hash, MAX(version) FROM layout_prompt_versions GROUP BY layout_hash")
+    shared_versions = {key: latest for key, latest in cursor.fetchall()}
+    next_version = dict(shared_versions)
+    cursor.execute("SELECT document_id, version, prompt, timestamp FROM prompt_versions ORDER BY document_id, version")
+    overrides = {}
+    for doc_id, version, prompt, timestamp in cursor.fetchall():
+        overrides.setdefault(doc_id, []).append((version, prompt, timestamp))
+
+    cursor.execute("SELECT id, layout_hash, layout_versions FROM documents ORDER BY created_at, id")
+    for doc_id, key, cap in cursor.fetchall():
+        shared = shared_versions.get(key) or 0
+        branch = shared if cap is None else min(cap, shared)
+        # Positions up to the branch point are the layout versions of the same number
+        # (edits stay as they are); later positions were this document's own versions
+        for position, prompt, timestamp in overrides.get(doc_id, []):
+            if position <= branch:
+                continue
+            next_version[key] = (next_version.get(key) or 0) + 1
+            cursor.execute(
+                """
+                INSERT INTO layout_prompt_versions (layout_hash, version, prompt, timestamp, document_id)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (key, next_version[key], prompt, timestamp, doc_id),
+            )
+            cursor.execute("DELETE FROM prompt_versions WHERE document_id = ? AND version = ?", (doc_id, position))
+        cursor.execute("UPDATE documents SET layout_versions = ? WHERE id = ?", (branch, doc_id))
+
+
+def _add_llm_usage_cost(cursor) -> None:
+    """Model and cost of each LLM call; NULL cost: the model had no configured price (or the row predates pricing)."""
+    cursor.execute("PRAGMA table_info(llm_usage)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if "model" not in columns:
+        cursor.execute("ALTER TABLE llm_usage ADD COLUMN model TEXT")
+    if "cost" not in columns:
+        cursor.execute("ALTER TABLE llm_usage ADD COLUMN cost REAL")
+
+
+# Applied in order; PRAGMA user_version records how many have run
+MIGRATIONS: List[Callable] = [
+    _add_layout_hash_and_indexes,
+    _move_prompt_history,
+    _share_prompt_versions_per_layout,
+    _add_listing_indexes,
+    _add_llm_usage,
+    # Databases migrated by an earlier version of migration 3 lack the column
+    _add_layout_versions_column,
+    _branch_documents_from_layout_history,
+    _add_llm_usage_cost,
+]
+
+
+def migrate(conn) -> int:
+    """Apply pending migrations, each in its own transaction; returns the schema version."""
+    cursor = conn.cursor()
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for index in range(version, len(MIGRATIONS)):
+        migration = MIGRATIONS[index]
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            # Another worker may have applied it while we waited for the lock
+            if cursor.execute("PRAGMA user_version").fetchone()[0] > index:
+                cursor.execute("COMMIT")
+                continue
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {index + 1}")
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        logging.info(f"Applied schema migration {index + 1}: {migration.__name__}")
+    return len(MIGRATIONS)
@@ -0,0 +1,143 @@
+import json
+import asyncio
+from typing import Dict, Any, AsyncIterator, Optional, Tuple
+
+import httpx
+import oci
+import requests
+
+
+CHAT_PATH = "/20231130/actions/chat"
+
+
+class OCIHTTPError(RuntimeError):
+    """Non-2xx answer from the chat action; status and Retry-After drive retries."""
+
+    def __init__(self, status: int, body: str, retry_after: Optional[float] = None):
+        super().__init__(f"OCI chat request failed ({status}): {body[:500]}")
+        self.status = status
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, response: "httpx.Response") -> "OCIHTTPError":
+        try:
+            retry_after = float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            retry_after = None
+        return cls(response.status_code, response.text, retry_after)
+
+
+class AsyncOCIChatClient:
+    """
+    Minimal asyncio client for the OCI Generative AI chat action.
+
+    The OCI Python SDK is synchronous, so this client signs requests with the
+    SDK's own Signer and sends them over a shared httpx.AsyncClient, which
+    keeps a pool of keep-alive connections to the inference endpoint. A
+    semaphore bounds the number of chat calls in flight; callers beyond the
+    bound wait on the event loop instead of holding a thread.
+    """
+
+    def __init__(
+        self,
+        config: Dict[str, Any],
+        service_endpoint: str,
+        max_connections: int = 100,
+        max_in_flight: int = 64,
+        timeout: Tuple[float, float] = (10, 240),
+    ):
+        self.service_endpoint = service_endpoint.rstrip("/")
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.signer = oci.signer.Signer(
+            tenancy=config["tenancy"],
+            user=config["user"],
+            fingerprint=config["fingerprint"],
+            private_key_file_location=config.get("key_file"),
+            pass_phrase=config.get("pass_phrase"),
+            private_key_content=config.get("key_content"),
+        )
+        # Created lazily so they bind to the event loop of the serving worker
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            connect_timeout, read_timeout = self.timeout
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._client
+
+    def _signed_headers(self, url: str, body: bytes, accept: str = "application/json") -> Dict[str, str]:
+        """Sign the request exactly as the SDK would and return the resulting headers."""
+        prepared = requests.Request(
+            "POST",
+            url,
+            data=body,
+            headers={"content-type": "application/json", "accept": accept},
+        ).prepare()
+        self.signer(prepared)
+        return dict(prepared.headers)
+
+    async def chat(self, chat_details: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """POST a ChatDetails payload (camelCase JSON) and return (response JSON, response headers)."""
+        client = self._get_client()
+        url = f"{self.service_endpoint}{CHAT_PATH}"
+        body = json.dumps(chat_details).encode("utf-8")
+
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                headers = self._signed_headers(url, body)
+                response = await client.post(url, content=body, headers=headers)
+            finally:
+                self.in_flight -= 1
+
+        if response.status_code >= 400:
+            raise OCIHTTPError.from_response(response)
+        return response.json(), dict(response.headers)
+
+    async def chat_stream(self, chat_details: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        POST a ChatDetails payload with chatRequest.isStream set and yield every
+        server-sent event as a dict (text deltas, finishReason, usage) as it arrives.
+        The in-flight slot is held until the stream is exhausted or closed.
+        """
+        client = self._get_client()
+        url = f"{self.service_endpoint}{CHAT_PATH}"
+        chat_details = dict(chat_details, chatRequest=dict(chat_details["chatRequest"], isStream=True))
+        body = json.dumps(chat_details).encode("utf-8")
+
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                headers = self._signed_headers(url, body, accept="text/event-stream")
+                async with client.stream("POST", url, content=body, headers=headers) as response:
+                    if response.status_code >= 400:
+                        await response.aread()
+                        raise OCIHTTPError.from_response(response)
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if not data or data == "[DONE]":
+                            continue
+                        try:
+                            yield json.loads(data)
+                        except json.JSONDecodeError:
+                            continue
+            finally:
+                self.in_flight -= 1
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -4,16 +4,46 @@ import json
 import math
 import logging
 import time
+import asyncio
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, Awaitable, Callable, List, Optional, Tuple
 import oci
-from docling.datamodel.base_models import InputFormat
-from docling.datamodel.pipeline_options import (
-    PdfPipelineOptions,
-    TesseractCliOcrOptions,
+import httpx
+from cache import DoclingCache, LLMResponseCache, hash_file
+from layout_index import LayoutIndex, parse_layout
+from oci_async import AsyncOCIChatClient
+from resilience import ResilientCaller
+from ratelimit import BATCH, SharedRateLimiter
+from metrics import JSON_PARSE_FAILURES, LLM_CALL_SECONDS, LLM_TOKENS, STAGE_SECONDS
+from tracing import run_in_executor, set_attributes, span, traced
+from usage import call_cost, load_pricing, record_usage
+from chunking import estimate_tokens, is_failed_extraction, merge_extractions, split_markdown
+from metadata_extraction import (
+    build_metadata_digest,
+    company_lines,
+    detect_language,
+    document_outline,
+    local_layout,
+    match_known_client,
+    metadata_is_confident,
+    parse_metadata_answer,
 )
-from docling.document_converter import DocumentConverter, PdfFormatOption
+from prompt_history import (
+    append_layout_version,
+    history_json,
+    latest_prompt,
+    layout_hash,
+    load_history,
+    load_history_versions,
+    load_layout_history,
+    parse_prompt_history,
+    set_document_version,
+)
+from conversion import ConversionPool, build_converter, conversion_config, convert_planned, plan_conversion, task_pages
+
+# Minimum layout similarity (0-100) for a saved prompt to be suggested
+LAYOUT_SIMILARITY_THRESHOLD = 70
 
 
 def sanitize_for_json(data):
@@ -37,10 +67,20 @@ def get_file_type(filename: str) -> str:
     """Extract file type (extension) using regex, e.g., pdf, xlsx, docx."""
     match = re.search(r'\.([^.]+)$', filename)
     return match.group(1).lower() if match else "unknown"
+
+
+def _run_after_commit(after_commit: Optional[Callable], callback: Callable[[], None]) -> None:
+    """Hand callback to the write's after_commit hook, or run it now when there is none."""
+    if after_commit is None:
+        callback()
+    else:
+        after_commit(callback)
+
+
 class DocumentProcessor:
     def __init__(self, config_file: str = "config.ini", profile: str = "DEFAULT"):
         """
-        Initialize OCI Generative AI Client + Docling.
+        Initialize OCI Generative AI Client + Docling + conversion cache.
         """
         if not Path(config_file).exists():
             raise FileNotFoundError("❌ config.ini not found. Please set up OCI credentials.")
@@ -51,157 +91,502 @@ class DocumentProcessor:
         if not self.compartment_id:
             raise ValueError("compartment_id missing in config.ini")
 
-        # Service endpoint
-        self.endpoint = "https://inference.generativeai.us-chicago-1.oci.oraclecloud.com"
+        # Service endpoint (OCI_GENAI_ENDPOINT can point at a local stub server)
+        self.endpoint = os.getenv(
+            "OCI_GENAI_ENDPOINT",
+            "https://inference.generativeai.us-chicago-1.oci.oraclecloud.com"
+        )
 
-        # OCI client
-        self.client = oci.generative_ai_inference.GenerativeAiInferenceClient(
+        # Per-attempt timeout; retries below happen within OCI_CALL_DEADLINE_SECONDS
+        oci_timeout = (10, float(os.getenv("OCI_TIMEOUT_SECONDS", "120")))
+
+        # Async OCI client with a shared keep-alive connection pool for the endpoints
+        # (retries are done by self.resilience)
+        self.async_client = AsyncOCIChatClient(
             config=self.config,
             service_endpoint=self.endpoint,
-            retry_strategy=oci.retry.NoneRetryStrategy(),
-            timeout=(10, 240)
+            max_connections=int(os.getenv("OCI_MAX_CONNECTIONS", "100")),
+            max_in_flight=int(os.getenv("OCI_MAX_IN_FLIGHT", "64")),
+            timeout=oci_timeout,
         )
 
-        # Docling converter
-        ocr_options = TesseractCliOcrOptions(lang=["auto"])
+        # Client-side RPM/TPM budgets shared by all workers (0 = unlimited); interactive
+        # try-prompt calls may use the last OCI_RATE_INTERACTIVE_RESERVE of each budget.
+        self.rate_limiter = SharedRateLimiter(
+            db_path=os.getenv("OCI_RATE_LIMIT_DB", "ratelimit.db"),
+            requests_per_minute=int(os.getenv("OCI_RPM_LIMIT", "0")),
+            tokens_per_minute=int(os.getenv("OCI_TPM_LIMIT", "0")),
+            output_estimate=int(os.getenv("OCI_RATE_OUTPUT_ESTIMATE", "500")),
+            interactive_reserve=float(os.getenv("OCI_RATE_INTERACTIVE_RESERVE", "0.2")),
+            max_wait=float(os.getenv("OCI_RATE_MAX_WAIT_SECONDS", "120")),
+        )
 
-        pipeline_options = PdfPipelineOptions(
-            do_ocr=True,
-            force_full_page_ocr=True,
-            ocr_options=ocr_options,
+        # Retries with jittered backoff on 429/5xx/timeouts (OCI_RETRY_BUDGET_RATIO caps
+        # retries to that share of calls), optional hedged duplicates of async calls
+        # slower than the p95 of similar calls (OCI_HEDGE=true), and a circuit breaker
+        # that fails fast for OCI_BREAKER_RESET_SECONDS after OCI_BREAKER_FAILURES
+        # consecutive transient failures (0 disables it).
+        self.resilience = ResilientCaller(
+            name="oci",
+            max_attempts=int(os.getenv("OCI_RETRY_MAX_ATTEMPTS", "4")),
+            base_delay=float(os.getenv("OCI_RETRY_BASE_DELAY_MS", "500")) / 1000,
+            max_delay=float(os.getenv("OCI_RETRY_MAX_DELAY_MS", "8000")) / 1000,
+            deadline=float(os.getenv("OCI_CALL_DEADLINE_SECONDS", "240")),
+            retry_budget_ratio=float(os.getenv("OCI_RETRY_BUDGET_RATIO", "0.2")),
+            hedge=os.getenv("OCI_HEDGE", "false").lower() in ("1", "true", "yes"),
+            hedge_percentile=float(os.getenv("OCI_HEDGE_PERCENTILE", "95")),
+            hedge_min_delay=float(os.getenv("OCI_HEDGE_MIN_DELAY_MS", "1000")) / 1000,
+            hedge_budget_ratio=float(os.getenv("OCI_HEDGE_BUDGET_RATIO", "0.05")),
+            breaker_failures=int(os.getenv("OCI_BREAKER_FAILURES", "5")),
+            breaker_reset=float(os.getenv("OCI_BREAKER_RESET_SECONDS", "30")),
+            transient_errors=(oci.exceptions.RequestException, httpx.TransportError),
         )
 
-        self.converter = DocumentConverter(
-            format_options={
-                InputFormat.PDF: PdfFormatOption(
-                    pipeline_options=pipeline_options
-                )
-            }
+        # Model + sampling parameters (also part of the LLM cache key)
+        self.model_id = os.getenv(
+            "OCI_MODEL_ID",
+            "ocid1.generativeaimodel.oc1.us-chicago-1.amaaaaaask7dceya3bsfz4ogiuv3yc7gcnlry7gi3zzx6tnikg6jltqszm2q",
         )
+        # Per-model prices for the usage records' cost (see usage.load_pricing)
+        self.pricing = load_pricing(os.getenv("LLM_PRICING", ""))
+        self.max_tokens = 2000
+        self.temperature = 0
+        self.top_p = 1
+        self.top_k = 0
+
+        # Docling conversion runs in a dedicated process pool with warmed converters
+        # (DOCLING_PROCESS_WORKERS=0 converts in-process on the calling thread instead).
+        # PDFs with DOCLING_SHARD_MIN_PAGES+ pages are OCRed in DOCLING_SHARD_PAGES-page
+        # shards in parallel (DOCLING_SHARD_PAGES=0 disables sharding).
+        # OCR_MODE=adaptive skips Tesseract on pages with a usable embedded text layer.
+        docling_workers = int(os.getenv("DOCLING_PROCESS_WORKERS", "2"))
+        self.ocr_mode = os.getenv("OCR_MODE", "full")
+        self.shard_pages = int(os.getenv("DOCLING_SHARD_PAGES", "8"))
+        self.shard_min_pages = int(os.getenv("DOCLING_SHARD_MIN_PAGES", "16"))
+        self.conversion_pool = None
+        self.converters = {}
+        if docling_workers > 0:
+            self.conversion_pool = ConversionPool(
+                max_workers=docling_workers,
+                shard_pages=self.shard_pages,
+                shard_min_pages=self.shard_min_pages,
+                ocr_mode=self.ocr_mode,
+            )
+        else:
+            self.converters[True] = build_converter(force_ocr=True)
+            if self.ocr_mode == "adaptive":
+                self.converters[False] = build_converter(force_ocr=False)
+
+        # Content-addressed Docling cache (set DOCLING_CACHE_MAX_MB=0 to disable)
+        cache_max_mb = int(os.getenv("DOCLING_CACHE_MAX_MB", "512"))
+        self.docling_cache = None
+        if cache_max_mb > 0:
+            self.docling_cache = DoclingCache(
+                cache_dir=os.getenv("DOCLING_CACHE_DIR", "cache"),
+                max_bytes=cache_max_mb * 1024 * 1024,
+                # In-process conversion never shards
+                config=conversion_config(self.ocr_mode, self.shard_pages if docling_workers > 0 else 0, self.shard_min_pages),
+            )
+
+        # Persistent LLM response cache (set LLM_CACHE_MAX_ENTRIES=0 to disable)
+        llm_cache_max_entries = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+        self.llm_cache = None
+        if llm_cache_max_entries > 0:
+            self.llm_cache = LLMResponseCache(
+                db_path=os.getenv("LLM_CACHE_DB", "llm_cache.db"),
+                ttl_seconds=int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+                max_entries=llm_cache_max_entries,
+            )
 
-    def extract_with_docling(self, file_path: str) -> Tuple[str, Dict[str, Any]]:
+        # Long documents: EXTRACTION_MODE=auto splits the markdown into table/section-aligned
+        # chunks of EXTRACTION_CHUNK_TOKENS when it exceeds that budget and extracts them
+        # concurrently; "single" always sends one prompt, "chunked" always splits.
+        self.extraction_mode = os.getenv("EXTRACTION_MODE", "auto")
+        self.chunk_tokens = int(os.getenv("EXTRACTION_CHUNK_TOKENS", "6000"))
+
+        # Metadata prompt input: METADATA_MODE=digest sends the first METADATA_DIGEST_BLOCKS
+        # blocks, table header rows and company lines (falling back to the full text on a
+        # low-confidence answer); "full" always sends the whole document; "local" derives
+        # language and layout without the LLM and only asks it for the client name when
+        # no client already in the database is named in the document.
+        self.metadata_mode = os.getenv("METADATA_MODE", "digest")
+        self.metadata_digest_blocks = int(os.getenv("METADATA_DIGEST_BLOCKS", "15"))
+
+        # COMBINED_EXTRACTION=true asks for metadata and schema fields in one LLM call
+        # (documents that fit in one extraction chunk); invalid answers fall back to two calls.
+        self.combined_extraction = os.getenv("COMBINED_EXTRACTION", "false").lower() in ("1", "true", "yes")
+
+        # Local layout-similarity index used by find_suggested_prompt.
+        # LAYOUT_LLM_TIEBREAK_TOP_K > 1 lets the LLM rank that many local candidates.
+        self.layout_index = LayoutIndex(
+            rebuild_interval=float(os.getenv("LAYOUT_INDEX_REBUILD_SECONDS", "300"))
+        )
+        self.layout_llm_tiebreak_top_k = int(os.getenv("LAYOUT_LLM_TIEBREAK_TOP_K", "0"))
+
+    def _docling_cache_get(self, content_hash: str, docling_start: float):
+        cached = self.docling_cache.get(content_hash)
+        set_attributes(cache_hit=cached is not None)
+        if cached is not None:
+            docling_duration = time.time() - docling_start
+            end_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+            logging.info(f"[DOCLING END] {end_timestamp} - Cache hit {content_hash} (Duration: {docling_duration:.2f}s)")
+            STAGE_SECONDS.observe(docling_duration, "docling_cached")
+        return cached
+
+    def _docling_cache_put(self, content_hash: str, markdown: str, metadata: Dict[str, Any]) -> None:
+        try:
+            self.docling_cache.put(content_hash, markdown, metadata)
+        except Exception as e:
+            # A failed cache write must never fail the upload
+            logging.warning(f"Failed to write Docling cache entry {content_hash}: {e}")
+
+    @staticmethod
+    def _log_docling_end(docling_start: float) -> None:
+        docling_end = time.time()
+        end_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        docling_duration = docling_end - docling_start
+        logging.info(f"[DOCLING END] {end_timestamp} - Completed document processing (Duration: {docling_duration:.2f}s)")
+        STAGE_SECONDS.observe(docling_duration, "docling")
+
+    @traced("docling")
+    def extract_with_docling(self, file_path: str, content_hash: str = None) -> Tuple[str, Dict[str, Any]]:
         """
         Convert file → Markdown and return raw markdown + basic metadata.
+        Results are looked up in / stored to the content-addressed cache first.
         """
         # Log start of Docling processing
         docling_start = time.time()
         start_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
         logging.info(f"[DOCLING START] {start_timestamp} - Starting document processing: {file_path}")
 
+        if self.docling_cache is not None:
+            if content_hash is None:
+                content_hash = hash_file(file_path)
+            cached = self._docling_cache_get(content_hash, docling_start)
+            if cached is not None:
+                return cached
+
         try:
-            conv = self.converter.convert(file_path)
-            markdown = conv.document.export_to_markdown()
+            if self.conversion_pool is not None:
+                markdown, metadata = self.conversion_pool.convert(file_path)
+            else:
+                # In-process: no parallelism, so only split where the OCR decision changes
+                tasks = plan_conversion(file_path, self.ocr_mode)
+                set_attributes(
+                    pages=sum(task_pages(file_path, page_range) for page_range, _ in tasks),
+                    tasks=len(tasks),
+                )
+                markdown, metadata = convert_planned(self.converters, file_path, tasks)
+            self._log_docling_end(docling_start)
+        except Exception as e:
+            raise RuntimeError(f"Docling extraction failed: {e}")
 
-            metadata = {
-                "language": getattr(conv, "language", "auto")
-            }
+        if self.docling_cache is not None:
+            self._docling_cache_put(content_hash, markdown, metadata)
 
-            # Log end of Docling processing
-            docling_end = time.time()
-            end_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-            docling_duration = docling_end - docling_start
-            logging.info(f"[DOCLING END] {end_timestamp} - Completed document processing (Duration: {docling_duration:.2f}s)")
+        return markdown, metadata
 
-            return markdown, metadata
+    async def aextract_with_docling(self, file_path: str, content_hash: str = None, executor=None) -> Tuple[str, Dict[str, Any]]:
+        """
+        Async counterpart of extract_with_docling: cache I/O runs on `executor`, and the
+        conversion is awaited on the process pool without holding a thread.
+        """
+        if self.conversion_pool is None:
+            return await run_in_executor(executor, self.extract_with_docling, file_path, content_hash)
+
+        return await self._aextract_pooled(file_path, content_hash, executor)
 
+    @traced("docling")
+    async def _aextract_pooled(self, file_path: str, content_hash: str, executor) -> Tuple[str, Dict[str, Any]]:
+        docling_start = time.time()
+        start_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        logging.info(f"[DOCLING START] {start_timestamp} - Starting document processing: {file_path}")
+
+        if self.docling_cache is not None:
+            if content_hash is None:
+                content_hash = await run_in_executor(executor, hash_file, file_path)
+            cached = await run_in_executor(executor, self._docling_cache_get, content_hash, docling_start)
+            if cached is not None:
+                return cached
+
+        try:
+            markdown, metadata = await self.conversion_pool.aconvert(file_path)
+            self._log_docling_end(docling_start)
         except Exception as e:
             raise RuntimeError(f"Docling extraction failed: {e}")
 
+        if self.docling_cache is not None:
+            await run_in_executor(executor, self._docling_cache_put, content_hash, markdown, metadata)
 
-    def _call_oci_llm(self, prompt: str) -> Tuple[str, int | None]:
-        """Call OCI Generative AI with a text prompt and return response text plus output tokens."""
-        # Log start of OCI API call
-        oci_start = time.time()
-        start_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-        logging.info(f"[OCI START] {start_timestamp} - Sending request to OCI Generative AI")
-
-        content = oci.generative_ai_inference.models.TextContent()
-        content.text = prompt
-        message = oci.generative_ai_inference.models.Message()
-        message.role = "USER"
-        message.content = [content]
-
-        chat_request = oci.generative_ai_inference.models.GenericChatRequest()
-        chat_request.api_format = oci.generative_ai_inference.models.BaseChatRequest.API_FORMAT_GENERIC
-        chat_request.messages = [message]
-        chat_request.max_tokens = 2000
-        chat_request.temperature = 0
-        chat_request.top_p = 1
-        chat_request.top_k = 0
-
-        chat_detail = oci.generative_ai_inference.models.ChatDetails()
-        chat_detail.serving_mode = oci.generative_ai_inference.models.OnDemandServingMode(
-            model_id="ocid1.generativeaimodel.oc1.us-chicago-1.amaaaaaask7dceya3bsfz4ogiuv3yc7gcnlry7gi3zzx6tnikg6jltqszm2q"
+        return markdown, metadata
+
+    def _llm_cache_key(self, prompt: str) -> str:
+        return LLMResponseCache.make_key(
+            prompt,
+            model_id=self.model_id,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            top_k=self.top_k,
         )
-        chat_detail.chat_request = chat_request
-        chat_detail.compartment_id = self.compartment_id
-
-        response = self.client.chat(chat_detail)
-
-        output_tokens = None
-        usage = getattr(getattr(response.data, "chat_response", None), "usage", None)
-        if usage is not None:
-            possible_fields = [
-                "output_tokens",
-                "output_token_count",
-                "completion_tokens",
-                "outputTokenCount",
-                "outputTokens",
-            ]
-            for field in possible_fields:
-                if hasattr(usage, field):
-                    output_tokens = getattr(usage, field)
-                    break
 
-        if output_tokens is None and hasattr(response, "headers"):
-            header_keys = [
-                "opc-billed-output-tokens",
-                "opc-output-token-count",
-                "opc-output-tokens",
-            ]
-            for key in header_keys:
-                header_value = response.headers.get(key)
-                if header_value is not None:
-                    output_tokens = header_value
-                    break
+    def _llm_cache_lookup(self, prompt: str, use_cache: bool) -> Tuple[str | None, Tuple[str, int | None] | None]:
+        """Return (cache_key, cached response). cache_key is None when the call must not be cached."""
+        if self.llm_cache is None or self.temperature != 0:
+            return None, None
+        cache_key = self._llm_cache_key(prompt)
+        if not use_cache:
+            self.llm_cache.record_bypass()
+            return cache_key, None
+        cached = self.llm_cache.get(cache_key)
+        if cached is not None:
+            logging.info(f"[OCI CACHE HIT] {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} - Served response from LLM cache (Output Tokens: {cached[1]})")
+        return cache_key, cached
+
+    def _llm_cache_store(self, cache_key: str | None, text: str, output_tokens: int | None) -> None:
+        if cache_key is None:
+            return
+        try:
+            self.llm_cache.put(cache_key, text, output_tokens)
+        except Exception as e:
+            logging.warning(f"Failed to write LLM cache entry: {e}")
 
-        if output_tokens is not None:
+    async def _allm_cache_lookup(self, prompt: str, use_cache: bool) -> Tuple[str | None, Tuple[str, int | None] | None]:
+        """_llm_cache_lookup on a worker thread: the shared SQLite file must not block the event loop."""
+        if self.llm_cache is None or self.temperature != 0:
+            return None, None
+        return await run_in_executor(None, self._llm_cache_lookup, prompt, use_cache)
+
+    async def _allm_cache_store(self, cache_key: str | None, text: str, output_tokens: int | None) -> None:
+        if cache_key is not None:
+            await run_in_executor(None, self._llm_cache_store, cache_key, text, output_tokens)
+
+    @staticmethod
+    def _usage_tokens(usage: Dict[str, Any] | None, headers=None) -> Tuple[int | None, int | None, int | None]:
+        """
+        (input, output, total) tokens of a chat response from its usage object;
+        output falls back to the billing headers.
+        """
+        def _int(value):
             try:
-                output_tokens = int(output_tokens)
+                return int(value)
             except (TypeError, ValueError):
-                output_tokens = None
-
-        if hasattr(response.data, "chat_response") and response.data.chat_response.choices:
-            choice = response.data.chat_response.choices[0]
-            if choice.message.content:
-                for item in choice.message.content:
-                    if hasattr(item, "text") and item.text.strip():
-                        # Log end of OCI API call
-                        oci_end = time.time()
-                        end_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-                        oci_duration = oci_end - oci_start
-                        logging.info(f"[OCI END] {end_timestamp} - Received response (Duration: {oci_duration:.2f}s, Output Tokens: {output_tokens})")
-                        return item.text.strip(), output_tokens
+                return None
+
+        usage = usage or {}
+        input_tokens = _int(usage.get("promptTokens"))
+        output_tokens = _int(usage.get("completionTokens"))
+        total_tokens = _int(usage.get("totalTokens"))
+        if output_tokens is None and headers is not None:
+            for key in ("opc-billed-output-tokens", "opc-output-token-count", "opc-output-tokens"):
+                if headers.get(key) is not None:
+                    output_tokens = _int(headers[key])
+                    break
+        return input_tokens, output_tokens, total_tokens
+
+    @staticmethod
+    def _observe_llm_call(
+        mode: str,
+        started: float,
+        purpose: str,
+        prompt: str = None,
+        input_tokens: int | None = None,
+        output_tokens: int | None = None,
+        total_tokens: int | None = None,
+    ) -> None:
+        """
+        Duration of one OCI call (retries included) and, when it succeeded, its tokens:
+        as metrics, span attributes and a usage record. Input tokens are estimated from
+        the prompt when OCI reported none. The cost is priced from self.pricing.
+        """
+        latency = time.perf_counter() - started
+        LLM_CALL_SECONDS.observe(latency, mode, "error" if prompt is None else "success")
+        set_attributes(mode=mode)
+        if prompt is None:
+            record_usage(purpose, mode, latency, outcome="error", model=self.model_id, cost=0.0)
+            return
+        estimated = input_tokens is None
+        if estimated:
+            input_tokens = estimate_tokens(prompt)
+        LLM_TOKENS.inc(input_tokens, "in")
+        if output_tokens:
+            LLM_TOKENS.inc(output_tokens, "out")
+        set_attributes(input_tokens=input_tokens, output_tokens=output_tokens)
+        record_usage(
+            purpose, mode, latency, input_tokens, output_tokens, total_tokens, tokens_estimated=estimated,
+            model=self.model_id, cost=call_cost(self.pricing, self.model_id, input_tokens, output_tokens),
+        )
+
+    @staticmethod
+    def _latency_key(prompt: str) -> str:
+        """Prompts within a factor of two in size share a latency window (for hedge delays)."""
+        return f"prompt_2^{len(prompt).bit_length()}"
+
+    def _build_chat_payload(self, prompt: str) -> Dict[str, Any]:
+        """ChatDetails as the JSON body of the REST chat action."""
+        return {
+            "compartmentId": self.compartment_id,
+            "servingMode": {"servingType": "ON_DEMAND", "modelId": self.model_id},
+            "chatRequest": {
+                "apiFormat": "GENERIC",
+                "messages": [{"role": "USER", "content": [{"type": "TEXT", "text": prompt}]}],
+                "maxTokens": self.max_tokens,
+                "temperature": self.temperature,
+                "topP": self.top_p,
+                "topK": self.top_k,
+            },
+        }
+
+    @traced("llm")
+    async def _acall_oci_llm(
+        self, prompt: str, use_cache: bool = True, priority: str = BATCH, purpose: str = "other"
+    ) -> Tuple[str, int | None]:
+        """
+        Call OCI Generative AI with a text prompt and return response text plus output tokens,
+        through the pooled AsyncOCIChatClient so no thread is held while waiting on OCI.
+        Responses are served from the LLM cache unless use_cache is False, in which
+        case OCI is called and the fresh answer replaces the cached one.
+        Only deterministic (temperature 0) requests are cached. Every attempt waits
+        for rate budget at the given priority ("interactive" or "batch"). The call's
+        tokens and latency are recorded as usage under `purpose`.
+        """
+        lookup_start = time.perf_counter()
+        cache_key, cached = await self._allm_cache_lookup(prompt, use_cache)
+        set_attributes(prompt_chars=len(prompt), priority=priority, purpose=purpose, cached=cached is not None)
+        if cached is not None:
+            record_usage(
+                purpose, "async", time.perf_counter() - lookup_start, cached=True, model=self.model_id, cost=0.0
+            )
+            return cached
+
+        # Log start of OCI API call
+        oci_start = time.time()
+        start_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        logging.info(f"[OCI START] {start_timestamp} - Sending async request to OCI Generative AI")
+
+        payload = self._build_chat_payload(prompt)
+
+        async def _attempt():
+            with span("oci.chat") as attempt:
+                waited = await self.rate_limiter.aacquire(estimate_tokens(prompt), priority)
+                if attempt is not None:
+                    attempt.set(rate_limit_wait_ms=round(waited * 1000, 1))
+                try:
+                    return await self.async_client.chat(payload)
+                except BaseException:
+                    # Every attempt (retry or hedge) reserved its own budget; one that brings
+                    # no answer (failed, or the hedge that lost and was cancelled) gets its
+                    # output estimate back. The answered one is settled below.
+                    await self.rate_limiter.asettle(0)
+                    raise
+
+        llm_start = time.perf_counter()
+        try:
+            data, headers = await self.resilience.acall(_attempt, key=self._latency_key(prompt))
+        except Exception:
+            self._observe_llm_call("async", llm_start, purpose)
+            raise
+        chat_response = data.get("chatResponse") or {}
+        input_tokens, output_tokens, total_tokens = self._usage_tokens(chat_response.get("usage"), headers)
+
+        for choice in chat_response.get("choices") or []:
+            for item in (choice.get("message") or {}).get("content") or []:
+                text = (item.get("text") or "").strip()
+                if text:
+                    # Log end of OCI API call
+                    oci_duration = time.time() - oci_start
+                    end_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+                    logging.info(f"[OCI END] {end_timestamp} - Received response (Duration: {oci_duration:.2f}s, Output Tokens: {output_tokens})")
+                    self._observe_llm_call("async", llm_start, purpose, prompt, input_tokens, output_tokens, total_tokens)
+                    await self.rate_limiter.asettle(output_tokens)
+                    await self._allm_cache_store(cache_key, text, output_tokens)
+                    return text, output_tokens
+            break  # only the first choice is used
         raise RuntimeError("No valid response from OCI LLM")
 
-    def process_document(self, file_path: str) -> Dict[str, Any]:
+    @traced("llm")
+    async def _astream_oci_llm(
+        self,
+        prompt: str,
+        on_token: Callable[[str], None],
+        use_cache: bool = True,
+        priority: str = BATCH,
+        purpose: str = "other",
+    ) -> Tuple[str, int | None]:
         """
-        1. Docling → Markdown
-        2. Regex → File type
-        3. LLM → Extract language, client_name, layout
-        4. Return markdown + metadata
+        Like _acall_oci_llm, but the answer is requested as an OCI event stream and
+        on_token(text) is called for every text delta as it arrives (once with the
+        whole answer on a cache hit). Returns the full (text, output_tokens).
         """
-        markdown, doc_metadata = self.extract_with_docling(file_path)
-        filename = os.path.basename(file_path)
+        lookup_start = time.perf_counter()
+        cache_key, cached = await self._allm_cache_lookup(prompt, use_cache)
+        set_attributes(prompt_chars=len(prompt), priority=priority, purpose=purpose, cached=cached is not None)
+        if cached is not None:
+            record_usage(
+                purpose, "stream", time.perf_counter() - lookup_start, cached=True, model=self.model_id, cost=0.0
+            )
+            on_token(cached[0])
+            return cached
 
-        # Extract file type using regex
-        file_type = get_file_type(filename)
+        oci_start = time.time()
+        start_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        logging.info(f"[OCI START] {start_timestamp} - Sending streaming request to OCI Generative AI")
 
-        # LLM prompt to extract metadata
-        logging.info(f"[METADATA EXTRACTION START] {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} - Extracting metadata from document")
-        metadata_start = time.time()
-        
-        meta_prompt = f"""
+        payload = self._build_chat_payload(prompt)
+        payload["chatRequest"]["streamOptions"] = {"isIncludeUsage": True}
+        parts: List[str] = []
+        usage: Dict[str, Any] = {}
+        first_token_at = None
+
+        async def _stream() -> None:
+            nonlocal first_token_at
+            with span("oci.chat_stream") as attempt:
+                waited = await self.rate_limiter.aacquire(estimate_tokens(prompt), priority)
+                if attempt is not None:
+                    attempt.set(rate_limit_wait_ms=round(waited * 1000, 1))
+                try:
+                    async for event in self.async_client.chat_stream(payload):
+                        # The usage arrives with the last event (streamOptions.isIncludeUsage)
+                        usage.update(event.get("usage") or {})
+                        for item in (event.get("message") or {}).get("content") or []:
+                            text = item.get("text") or ""
+                            if text:
+                                if first_token_at is None:
+                                    first_token_at = time.time()
+                                    set_attributes(first_token_ms=round((first_token_at - oci_start) * 1000, 1))
+                                parts.append(text)
+                                on_token(text)
+                except BaseException:
+                    # As in _acall_oci_llm: a retried attempt's reservation is settled here
+                    await self.rate_limiter.asettle(0)
+                    raise
+
+        # Streams are never hedged, and only retried until the first token was forwarded
+        llm_start = time.perf_counter()
+        try:
+            await self.resilience.acall(
+                _stream, key=self._latency_key(prompt), hedge=False, can_retry=lambda: first_token_at is None
+            )
+        except Exception:
+            self._observe_llm_call("stream", llm_start, purpose)
+            raise
+        input_tokens, output_tokens, total_tokens = self._usage_tokens(usage)
+        text = "".join(parts).strip()
+        if not text:
+            raise RuntimeError("No valid response from OCI LLM")
+        oci_duration = time.time() - oci_start
+        end_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        logging.info(f"[OCI END] {end_timestamp} - Received streamed response (Duration: {oci_duration:.2f}s, First token: {first_token_at - oci_start:.2f}s, Output Tokens: {output_tokens})")
+        self._observe_llm_call("stream", llm_start, purpose, prompt, input_tokens, output_tokens, total_tokens)
+        await self.rate_limiter.asettle(output_tokens)
+        await self._allm_cache_store(cache_key, text, output_tokens)
+        return text, output_tokens
+
+    def _build_metadata_prompt(self, filename: str, markdown: str) -> str:
+        if estimate_tokens(markdown) > self.chunk_tokens:
+            # Metadata lives at the top of the document; keep the prompt within budget
+            markdown = split_markdown(markdown, self.chunk_tokens)[0]
+        return f"""
         You are a metadata extractor.
         From the following document filename and content, return ONLY a JSON object:
 
@@ -214,53 +599,186 @@ class DocumentProcessor:
         Filename: {filename}
         Content: {markdown}
         """
-        raw_meta, _ = self._call_oci_llm(meta_prompt)
 
+    def _normalize_metadata(self, raw_meta: str, filename: str, doc_metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """Parse the metadata LLM answer, falling back to Docling/filename values."""
         try:
             meta_json = json.loads(raw_meta)
         except:
+            JSON_PARSE_FAILURES.inc(1, "metadata")
             meta_json = {
                 "language": doc_metadata.get("language", "NaN"),
                 "layout": [],
                 "client_name": re.sub(r"\..*$", "", filename),
             }
 
-        normalized_meta = {
-            "file_type": file_type,  # from regex
+        return {
+            "file_type": get_file_type(filename),  # from regex
             "language": meta_json.get("language", doc_metadata.get("language", "NaN")),
             "layout": meta_json.get("layout", []),
             "client_name": meta_json.get("client_name", re.sub(r"\..*$", "", filename)),
         }
-        
-        metadata_end = time.time()
-        metadata_duration = metadata_end - metadata_start
+
+    def _metadata_digest(self, markdown: str, doc_metadata: Dict[str, Any]) -> Tuple[str, bool]:
+        """(digest text, whether the document has tables) for METADATA_MODE=digest."""
+        digest = build_metadata_digest(markdown, doc_metadata, self.metadata_digest_blocks)
+        has_tables = bool(document_outline(markdown, doc_metadata, 1)["table_headers"])
+        logging.info(f"[METADATA DIGEST] {len(digest)} chars instead of {len(markdown)}")
+        return digest, has_tables
+
+    def _build_client_prompt(self, filename: str, digest: str) -> str:
+        return f"""
+        You are a metadata extractor.
+        From the following document filename and content, return ONLY a JSON object:
+
+        {{
+          "client_name": "<company name or client name>"
+        }}
+
+        Filename: {filename}
+        Content: {digest}
+        """
+
+    def _local_metadata(
+        self,
+        filename: str,
+        markdown: str,
+        doc_metadata: Dict[str, Any],
+        known_clients: List[str] = None
+    ) -> Tuple[Dict[str, Any], Optional[str]]:
+        """
+        METADATA_MODE=local: language from the character trigram profiles, layout from the
+        widest Docling table header and client_name from the known clients named in the lead
+        blocks / company lines. A layout with the same columns (normalized headers) as one
+        already saved is replaced by that saved layout's text, so it gets the same
+        layout_hash as the LLM-written layouts and inherits their prompts. Returns (metadata, digest); digest is None when the client
+        was matched locally, otherwise it is the text to ask the LLM for the client name.
+        """
+        outline = document_outline(markdown, doc_metadata, self.metadata_digest_blocks)
+        language, confidence = detect_language(markdown[:20000])
+        layout = local_layout(outline["table_headers"])
+        same_columns = self.layout_index.search(layout, threshold=100)
+        if same_columns:
+            layout = parse_layout(same_columns[0][1])
+        meta = {
+            "file_type": get_file_type(filename),
+            "language": language if language != "Unknown" else doc_metadata.get("language", "NaN"),
+            "layout": layout,
+            "client_name": None,
+        }
+        search_text = "\n".join([filename] + outline["lead_blocks"] + company_lines(markdown))
+        meta["client_name"] = match_known_client(search_text, known_clients or [])
+        logging.info(
+            f"[METADATA LOCAL] language={meta['language']} ({confidence:.2f}), "
+            f"layout={len(meta['layout'])} columns{' (saved layout)' if same_columns else ''}, "
+            f"known client={'yes' if meta['client_name'] else 'no'}"
+        )
+        if meta["client_name"] is not None:
+            return meta, None
+        return meta, build_metadata_digest(markdown, doc_metadata, self.metadata_digest_blocks)
+
+    @staticmethod
+    def _apply_client_answer(meta: Dict[str, Any], raw_answer: str, filename: str) -> Dict[str, Any]:
+        parsed = parse_metadata_answer(raw_answer) or {}
+        meta["client_name"] = parsed.get("client_name") or re.sub(r"\..*$", "", filename)
+        return meta
+
+    @traced("metadata")
+    async def _aextract_metadata(
+        self,
+        filename: str,
+        markdown: str,
+        doc_metadata: Dict[str, Any],
+        use_cache: bool = True,
+        known_clients: List[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Metadata LLM call. In digest mode only a compact digest is sent; when the answer
+        looks unreliable the call is repeated with the full text. In local mode the LLM is
+        only called when the client is not one of known_clients.
+        """
+        if self.metadata_mode == "local":
+            meta, digest = self._local_metadata(filename, markdown, doc_metadata, known_clients)
+            if digest is None:
+                return meta
+            raw_answer, _ = await self._acall_oci_llm(
+                self._build_client_prompt(filename, digest), use_cache=use_cache, purpose="metadata_client"
+            )
+            return self._apply_client_answer(meta, raw_answer, filename)
+
+        if self.metadata_mode == "digest":
+            digest, has_tables = self._metadata_digest(markdown, doc_metadata)
+            raw_meta, _ = await self._acall_oci_llm(
+                self._build_metadata_prompt(filename, digest), use_cache=use_cache, purpose="metadata_digest"
+            )
+            if metadata_is_confident(raw_meta, has_tables):
+                return self._normalize_metadata(raw_meta, filename, doc_metadata)
+            logging.info("[METADATA DIGEST] Low-confidence answer, retrying with the full document")
+
+        raw_meta, _ = await self._acall_oci_llm(
+            self._build_metadata_prompt(filename, markdown), use_cache=use_cache, purpose="metadata"
+        )
+        return self._normalize_metadata(raw_meta, filename, doc_metadata)
+
+    async def aprocess_document(
+        self,
+        file_path: str,
+        content_hash: str = None,
+        use_cache: bool = True,
+        executor=None,
+        on_stage=None,
+        known_clients: List[str] = None,
+        on_event=None,
+        filename: str = None
+    ) -> Dict[str, Any]:
+        """
+        1. Docling → Markdown (served from the content-hash cache when possible), on the
+           conversion process pool (or `executor` when the pool is disabled)
+        2. Regex → File type
+        3. LLM → Extract language, client_name, layout (see METADATA_MODE)
+        4. Return markdown + metadata
+        on_stage("metadata") is called once Docling is done;
+        on_event(name, payload) receives the "docling" and "metadata" results as they land.
+        filename is the document's original name, used in the prompt and for the file type.
+        """
+        markdown, doc_metadata = await self.aextract_with_docling(file_path, content_hash, executor=executor)
+        if on_event is not None:
+            on_event("docling", {"structured_markdown": markdown})
+        if on_stage is not None:
+            on_stage("metadata")
+        # The original upload name: file_path is a randomly named spool file, which
+        # would make every metadata/combined prompt (and its cache key) unique
+        filename = filename or os.path.basename(file_path)
+
+        logging.info(f"[METADATA EXTRACTION START] {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} - Extracting metadata from document")
+        metadata_start = time.time()
+
+        normalized_meta = await self._aextract_metadata(filename, markdown, doc_metadata, use_cache, known_clients)
+
+        metadata_duration = time.time() - metadata_start
         logging.info(f"[METADATA EXTRACTION END] {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} - Completed metadata extraction (Duration: {metadata_duration:.2f}s)")
+        STAGE_SECONDS.observe(metadata_duration, "metadata")
+        if on_event is not None:
+            on_event("metadata", normalized_meta)
 
         return {
             "structured_markdown": markdown,
             "metadata": normalized_meta,
         }
 
-    def extract_json_with_schema(
+    def _build_schema_prompt(
         self,
         structured_markdown: str,
         schema: Dict[str, Any],
         suggested_prompt: str = None
-    ) -> Dict[str, Any]:
-        """
-        Apply schema to structured markdown and return JSON.
-        If suggested_prompt is available, apply it along with the base schema extraction.
-        """
+    ) -> str:
         # Create a sample JSON with empty values based on schema
-        logging.info(f"[JSON EXTRACTION START] {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} - Starting JSON extraction with schema")
-        json_extraction_start = time.time()
-        
         sample_json = {}
         for key in schema:
             sample_json[key] = ""
             
         if suggested_prompt:
-            schema_prompt = f"""
+            return f"""
     You are a document data extraction expert.
     
     Use the following instruction to improve extraction: "{suggested_prompt}"
@@ -318,7 +836,7 @@ class DocumentProcessor:
     Return ONLY the JSON object with no additional text, explanations, or markdown formatting.
     """
         else:
-            schema_prompt = f"""
+            return f"""
     You are a document data extraction expert.
     
     Extract structured data from the following document into JSON.
@@ -377,269 +895,455 @@ class DocumentProcessor:
     If you cannot find a value for a field, leave it as an empty string.
     """
 
-        raw_json, output_tokens = self._call_oci_llm(schema_prompt)
+    @staticmethod
+    def _strip_json_fences(raw_json: str) -> str:
+        """The LLM answer without surrounding markdown code fences."""
+        raw_json = raw_json.strip()
+        if raw_json.startswith("```json"):
+            raw_json = raw_json[7:]
+        if raw_json.startswith("```"):
+            raw_json = raw_json[3:]
+        if raw_json.endswith("```"):
+            raw_json = raw_json[:-3]
+        return raw_json.strip()
 
+    def _parse_schema_response(self, raw_json: str, output_tokens: int | None, json_extraction_start: float = None):
+        """
+        Strip markdown fences from the LLM answer and parse it as JSON.
+        The [JSON EXTRACTION END] line is logged only when json_extraction_start is given.
+        """
         try:
             # Clean the response to ensure it's valid JSON
-            raw_json = raw_json.strip()
-            if raw_json.startswith("```json"):
-                raw_json = raw_json[7:]
-            if raw_json.startswith("```"):
-                raw_json = raw_json[3:]
-            if raw_json.endswith("```"):
-                raw_json = raw_json[:-3]
-            raw_json = raw_json.strip()
-            
+            raw_json = self._strip_json_fences(raw_json)
             result = json.loads(raw_json)
             
-            json_extraction_end = time.time()
-            json_extraction_duration = json_extraction_end - json_extraction_start
-            logging.info(f"[JSON EXTRACTION END] {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} - Completed JSON extraction (Duration: {json_extraction_duration:.2f}s)")
+            if json_extraction_start is not None:
+                self._log_json_extraction_end(json_extraction_start)
             
             return result, output_tokens
         except json.JSONDecodeError as e:
             logging.error(f"Failed to parse JSON: {e}")
             logging.error(f"Raw response: {raw_json}")
+            JSON_PARSE_FAILURES.inc(1, "extraction")
             return {}, output_tokens
         except Exception as e:
+            JSON_PARSE_FAILURES.inc(1, "extraction")
             return {"error": f"Failed to parse JSON: {str(e)}", "raw": raw_json}, output_tokens
 
-    def find_suggested_prompt(self, current_client: str, current_layout: str, cursor) -> str:
+    @staticmethod
+    def _log_json_extraction_end(json_extraction_start: float) -> None:
+        json_extraction_end = time.time()
+        json_extraction_duration = json_extraction_end - json_extraction_start
+        logging.info(f"[JSON EXTRACTION END] {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} - Completed JSON extraction (Duration: {json_extraction_duration:.2f}s)")
+        STAGE_SECONDS.observe(json_extraction_duration, "extraction")
+
+    def _extraction_chunks(self, structured_markdown: str, extraction_mode: str = None) -> List[str]:
         """
-        Find suggested prompt by:
-        1. First checking for exact client name match
-        2. Then using LLM to compare layouts for similarity
+        Markdown pieces to extract from: the whole document, or (chunked mode, or auto
+        mode when the document exceeds the token budget) table/section-aligned chunks.
+        """
+        mode = extraction_mode or self.extraction_mode
+        if mode == "single":
+            return [structured_markdown]
+        if mode == "auto" and estimate_tokens(structured_markdown) <= self.chunk_tokens:
+            return [structured_markdown]
+        return split_markdown(structured_markdown, self.chunk_tokens)
+
+    def _build_chunk_prompts(
+        self,
+        chunks: List[str],
+        schema: Dict[str, Any],
+        suggested_prompt: str = None
+    ) -> List[str]:
+        return [
+            self._build_schema_prompt(
+                f"(Part {index} of {len(chunks)} of the document. Leave fields that do not appear in this part empty.)\n{chunk}",
+                schema,
+                suggested_prompt,
+            )
+            for index, chunk in enumerate(chunks, start=1)
+        ]
+
+    def _merge_chunk_answers(
+        self,
+        answers: List[Tuple[str, int | None]],
+        schema: Dict[str, Any],
+        json_extraction_start: float
+    ):
+        """
+        Parse every chunk answer and merge them into one result (output tokens are summed).
+        Chunks that failed are left out of the merge; when every chunk failed, the first
+        error is returned as a single failed extraction would be.
+        """
+        results = []
+        failures = []
+        total_tokens = None
+        for index, (raw_json, output_tokens) in enumerate(answers, start=1):
+            result, _ = self._parse_schema_response(raw_json, output_tokens)
+            if is_failed_extraction(result):
+                reason = result["error"] if isinstance(result, dict) else f"a JSON {type(result).__name__}, not an object"
+                logging.warning(f"Chunk {index}/{len(answers)} returned {reason}; its fields are left out")
+                failures.append(result)
+            elif not result:
+                logging.warning(f"Chunk {index}/{len(answers)} returned no parseable JSON")
+            results.append(result)
+            if output_tokens is not None:
+                total_tokens = (total_tokens or 0) + output_tokens
+
+        self._log_json_extraction_end(json_extraction_start)
+        if failures and len(failures) == len(answers):
+            error = next((failure for failure in failures if isinstance(failure, dict)), None)
+            if error is None:
+                error = {"error": "Failed to parse JSON: no chunk returned a JSON object", "raw": answers[0][0]}
+            return error, total_tokens
+        return merge_extractions(results, schema), total_tokens
+
+    @traced("extraction")
+    async def aextract_json_with_schema(
+        self,
+        structured_markdown: str,
+        schema: Dict[str, Any],
+        suggested_prompt: str = None,
+        use_cache: bool = True,
+        extraction_mode: str = None,
+        on_token: Callable[[str], None] = None
+    ) -> Dict[str, Any]:
+        """
+        Apply schema to structured markdown and return JSON, through the pooled OCI client.
+        If suggested_prompt is available, apply it along with the base schema extraction.
+        Long documents are extracted chunk by chunk (concurrently) and merged. With on_token, a single-prompt extraction is streamed and on_token(text) is
+        called for each delta of the raw JSON answer.
+        """
+        logging.info(f"[JSON EXTRACTION START] {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} - Starting JSON extraction with schema")
+        json_extraction_start = time.time()
+
+        chunks = self._extraction_chunks(structured_markdown, extraction_mode)
+        set_attributes(chunks=len(chunks))
+        if len(chunks) == 1:
+            schema_prompt = self._build_schema_prompt(structured_markdown, schema, suggested_prompt)
+            if on_token is not None:
+                raw_json, output_tokens = await self._astream_oci_llm(
+                    schema_prompt, on_token, use_cache=use_cache, purpose="extraction"
+                )
+            else:
+                raw_json, output_tokens = await self._acall_oci_llm(schema_prompt, use_cache=use_cache, purpose="extraction")
+            return self._parse_schema_response(raw_json, output_tokens, json_extraction_start)
+
+        logging.info(f"Extracting {len(chunks)} chunks of up to {self.chunk_tokens} tokens")
+        prompts = self._build_chunk_prompts(chunks, schema, suggested_prompt)
+        answers = await asyncio.gather(*(
+            self._acall_oci_llm(prompt, use_cache=use_cache, purpose="extraction_chunk") for prompt in prompts
+        ))
+        return self._merge_chunk_answers(list(answers), schema, json_extraction_start)
+
+    def _build_combined_prompt(
+        self,
+        filename: str,
+        structured_markdown: str,
+        schema: Dict[str, Any],
+        suggested_prompt: str = None
+    ) -> str:
+        schema_prompt = self._build_schema_prompt(structured_markdown, schema, suggested_prompt)
+        return f"""{schema_prompt}
+    In the same answer, also identify the document metadata. Wrap everything in ONE JSON object:
+
+    {{
+      "metadata": {{
+        "language": "<document language>",
+        "client_name": "<company name or client name>",
+        "layout": ["<column1>", "<column2>", "<column3>", ...]
+      }},
+      "data": <the JSON object described above>
+    }}
+
+    Filename: {filename}
+    Return ONLY this JSON object.
+    """
+
+    def _split_combined_response(
+        self,
+        raw_answer: str,
+        filename: str,
+        doc_metadata: Dict[str, Any],
+        schema: Dict[str, Any],
+        local_meta: Dict[str, Any]
+    ) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """
+        Validate a combined answer and split it into (metadata, generated_json) in the
+        shapes aprocess_document / aextract_json_with_schema return. None when the answer
+        lacks a metadata or data object, names no client, or has none of the schema fields.
+        """
+        # Parsed here rather than with _parse_schema_response: a bad combined answer is
+        # counted once, as "combined", by the caller
+        try:
+            parsed = json.loads(self._strip_json_fences(raw_answer))
+        except ValueError:
+            return None
+        if not isinstance(parsed, dict):
+            return None
+        meta, data = parsed.get("metadata"), parsed.get("data")
+        if not isinstance(meta, dict) or not isinstance(data, dict):
+            return None
+        if not metadata_is_confident(json.dumps(meta), digest_has_tables=False):
+            return None
+        if schema and not any(key in data for key in schema):
+            return None
+
+        if not meta.get("layout"):
+            meta["layout"] = local_meta["layout"]
+        metadata = self._normalize_metadata(json.dumps(meta), filename, doc_metadata)
+        for key in schema or {}:
+            data.setdefault(key, "")
+        return metadata, data
+
+    async def aprocess_document_combined(
+        self,
+        file_path: str,
+        schema: Dict[str, Any],
+        find_prompt: Callable[[str, List[str]], Awaitable[Optional[str]]],
+        content_hash: str = None,
+        use_cache: bool = True,
+        executor=None,
+        on_stage=None,
+        known_clients: List[str] = None,
+        on_event=None,
+        filename: str = None
+    ) -> Dict[str, Any]:
+        """
+        Docling, metadata and schema extraction with a single LLM call. The layout and
+        known client are derived locally first so find_prompt(client, layout) can supply
+        the suggested prompt before the call.
+
+        Returns the aprocess_document result plus generated_json, output_tokens and
+        suggested_prompt. When the document needs chunked extraction or the combined
+        answer fails validation, only the metadata is extracted (separate call) and
+        generated_json is None: the caller then runs the schema extraction itself.
+        on_event(name, payload) receives the "docling" and "metadata" results.
+        filename is the document's original name, used in the prompt and for the file type.
+        """
+        markdown, doc_metadata = await self.aextract_with_docling(file_path, content_hash, executor=executor)
+        if on_event is not None:
+            on_event("docling", {"structured_markdown": markdown})
+        # The original upload name: file_path is a randomly named spool file, which
+        # would make every metadata/combined prompt (and its cache key) unique
+        filename = filename or os.path.basename(file_path)
+
+        if len(self._extraction_chunks(markdown)) == 1:
+            if on_stage is not None:
+                on_stage("extraction")
+            local_meta, _ = self._local_metadata(filename, markdown, doc_metadata, known_clients)
+            suggested_prompt = await find_prompt(local_meta["client_name"] or "", local_meta["layout"])
+
+            logging.info(f"[COMBINED EXTRACTION START] {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} - Extracting metadata and schema fields")
+            combined_start = time.time()
+            prompt = self._build_combined_prompt(filename, markdown, schema, suggested_prompt)
+            with span("combined") as combined_span:
+                raw_answer, output_tokens = await self._acall_oci_llm(prompt, use_cache=use_cache, purpose="combined")
+                split = self._split_combined_response(raw_answer, filename, doc_metadata, schema, local_meta)
+                if combined_span is not None:
+                    combined_span.set(valid=split is not None)
+            combined_duration = time.time() - combined_start
+            logging.info(f"[COMBINED EXTRACTION END] {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} - Completed combined extraction (Duration: {combined_duration:.2f}s, valid: {split is not None})")
+            STAGE_SECONDS.observe(combined_duration, "combined")
+
+            if split is not None:
+                metadata, generated_json = split
+                if on_event is not None:
+                    on_event("metadata", metadata)
+                return {
+                    "structured_markdown": markdown,
+                    "metadata": metadata,
+                    "generated_json": generated_json,
+                    "output_tokens": output_tokens,
+                    "suggested_prompt": suggested_prompt,
+                }
+            logging.info("[COMBINED EXTRACTION] Invalid combined answer, falling back to separate calls")
+            JSON_PARSE_FAILURES.inc(1, "combined")
+
+        if on_stage is not None:
+            on_stage("metadata")
+        metadata = await self._aextract_metadata(filename, markdown, doc_metadata, use_cache, known_clients)
+        if on_event is not None:
+            on_event("metadata", metadata)
+        return {
+            "structured_markdown": markdown,
+            "metadata": metadata,
+            "generated_json": None,
+        }
+
+    def find_prompt_candidates(
+        self, current_client: str, current_layout: str, cursor
+    ) -> Tuple[Optional[str], List[Tuple[float, str, str]]]:
+        """
+        Database part of the suggested prompt lookup: (latest prompt of a document of
+        the same client, []) on an exact client name match, else (None, the most
+        similar saved layouts from the local layout index as (score, layout, prompt)).
         """
         # Step 1: Check for exact client name match first
         cursor.execute(
-            "SELECT user_prompt FROM documents WHERE client_name = ? AND user_prompt IS NOT NULL LIMIT 1",
+            """
+            SELECT d.id FROM documents d
+            WHERE d.client_name = ? AND EXISTS (SELECT 1 FROM layout_prompt_versions l WHERE l.layout_hash = d.layout_hash)
+            LIMIT 1
+            """,
             (current_client,)
         )
         row = cursor.fetchone()
         if row:
-            return row[0]
-        
-        # Step 2: Get all documents with saved prompts for layout comparison
-        cursor.execute(
-            "SELECT client_name, layout, user_prompt FROM documents WHERE user_prompt IS NOT NULL"
-        )
-        candidates = cursor.fetchall()
-        
-        if not candidates:
-            return None
-            
-        # Step 3: Use LLM to find the most similar layout
-        current_layout_parsed = json.loads(current_layout) if isinstance(current_layout, str) else current_layout
-        
-        best_prompt = None
-        best_similarity_score = 0
-        
-        for candidate_client, candidate_layout, candidate_prompt in candidates:
-            try:
-                candidate_layout_parsed = json.loads(candidate_layout) if isinstance(candidate_layout, str) else candidate_layout
-                
-                # Use LLM to compare layouts
-                comparison_prompt = f"""
+            return latest_prompt(load_history(cursor, row[0])), []
+
+        # Step 2: Score saved layouts locally (Jaccard over normalized column headers)
+        self.layout_index.sync(cursor)
+        top_k = max(1, self.layout_llm_tiebreak_top_k)
+        matches = self.layout_index.search(current_layout, threshold=LAYOUT_SIMILARITY_THRESHOLD, top_k=top_k)
+        # The index keeps each layout's history JSON; the suggestion is its latest prompt
+        return None, [(score, layout, latest_prompt(parse_prompt_history(history))) for score, layout, history in matches]
+
+    async def afind_suggested_prompt(self, current_client: str, current_layout: str, read, executor=None) -> str:
+        """
+        Find suggested prompt by:
+        1. First checking for exact client name match
+        2. Then looking up the most similar saved layout in the local layout index
+           (optionally letting the LLM break ties among the top candidates)
+        The database work runs on `executor` with a connection from read() (a context
+        manager yielding (conn, cursor), as Database.read), released before any LLM call.
+        """
+        def _candidates():
+            with read() as (conn, cursor):
+                return self.find_prompt_candidates(current_client, current_layout, cursor)
+
+        client_prompt, matches = await run_in_executor(executor, _candidates)
+        if not matches:
+            return client_prompt
+        if len(matches) == 1 or self.layout_llm_tiebreak_top_k <= 1:
+            return matches[0][2]
+
+        # Step 3 (optional): ask the LLM to rank only the top-k local candidates
+        current_layout_parsed = parse_layout(current_layout)
+
+        async def _score(candidate_layout: str) -> float | None:
+            comparison_prompt = f"""
                 Compare these two document layouts and return a similarity score from 0 to 100.
                 Consider column names, data types, and overall structure.
                 Return ONLY a number between 0-100, no explanations.
                 
                 Layout 1: {json.dumps(current_layout_parsed)}
-                Layout 2: {json.dumps(candidate_layout_parsed)}
+                Layout 2: {json.dumps(parse_layout(candidate_layout))}
                 
                 Similarity score (0-100):
                 """
-                
-                score_text, _ = self._call_oci_llm(comparison_prompt)
-                
-                # Extract numeric score
-                import re
-                score_match = re.search(r'\b(\d+(?:\.\d+)?)\b', score_text)
-                if score_match:
-                    similarity_score = float(score_match.group(1))
-                    if similarity_score > best_similarity_score and similarity_score >= 70:  # Threshold for similarity
-                        best_similarity_score = similarity_score
-                        best_prompt = candidate_prompt
-                        
+            try:
+                score_text, _ = await self._acall_oci_llm(comparison_prompt, purpose="layout_compare")
             except Exception as e:
-                # Skip this candidate if there's an error
-                continue
+                # Keep the local ranking if the LLM call fails
+                logging.warning(f"Layout tie-break comparison failed: {e}")
+                return None
+            score_match = re.search(r'\b(\d+(?:\.\d+)?)\b', score_text)
+            return float(score_match.group(1)) if score_match else None
+
+        scores = await asyncio.gather(*(_score(candidate_layout) for _, candidate_layout, _ in matches))
+        best_prompt = matches[0][2]
+        best_similarity_score = 0
+        for (_, _, candidate_prompt), similarity_score in zip(matches, scores):
+            if similarity_score is not None and similarity_score > best_similarity_score and similarity_score >= LAYOUT_SIMILARITY_THRESHOLD:
+                best_similarity_score = similarity_score
+                best_prompt = candidate_prompt
         return best_prompt
 
+    def get_known_clients(self, cursor) -> List[str]:
+        """Distinct client names already stored, for METADATA_MODE=local client matching."""
+        cursor.execute("SELECT DISTINCT client_name FROM documents WHERE client_name IS NOT NULL AND client_name != ''")
+        return [row[0] for row in cursor.fetchall()]
+
+    @staticmethod
+    def versions_from_history(history: List[Dict[str, Any]], created_at) -> list:
+        """Version 0 (implicit system prompt) followed by one entry per saved user prompt."""
+        versions = [{
+            "version": 0,
+            "type": "system",
+            "prompt": None,  # System prompt is implicit
+            "timestamp": created_at
+        }]
+        for idx, prompt_entry in enumerate(history):
+            versions.append({
+                "version": idx + 1,
+                "type": "user",
+                "prompt": prompt_entry.get("prompt", ""),
+                "timestamp": prompt_entry.get("timestamp") or created_at
+            })
+        return versions
+
     def get_document_versions(self, document_id: int, cursor) -> list:
         """
         Get version history for a document.
         Returns a list of version objects with version number, type, prompt, and timestamp.
         
         Version logic:
-        - Version 0: System prompt only (user_prompt is NULL)
-        - Version 1+: User prompts stored as JSON array in user_prompt column
+        - Version 0: System prompt only (the layout has no saved prompts)
+        - Version 1+: the layout's saved prompts (layout_prompt_versions), with
+          this document's own edits (prompt_versions) applied
         """
-        cursor.execute(
-            "SELECT user_prompt, created_at FROM documents WHERE id = ?",
-            (document_id,)
-        )
+        cursor.execute("SELECT created_at FROM documents WHERE id = ?", (document_id,))
         row = cursor.fetchone()
         
         if not row:
             return []
         
-        user_prompt_data, created_at = row
-        versions = []
-        
-        # Version 0: System prompt only
-        versions.append({
-            "version": 0,
-            "type": "system",
-            "prompt": None,  # System prompt is implicit
-            "timestamp": created_at
-        })
-        
-        # Parse user prompts if they exist
-        if user_prompt_data:
-            try:
-                prompt_history = json.loads(user_prompt_data)
-                if isinstance(prompt_history, list):
-                    for idx, prompt_entry in enumerate(prompt_history):
-                        versions.append({
-                            "version": idx + 1,
-                            "type": "user",
-                            "prompt": prompt_entry.get("prompt", ""),
-                            "timestamp": prompt_entry.get("timestamp", created_at)
-                        })
-                else:
-                    # Legacy format: single prompt string
-                    versions.append({
-                        "version": 1,
-                        "type": "user",
-                        "prompt": user_prompt_data,
-                        "timestamp": created_at
-                    })
-            except json.JSONDecodeError:
-                # Legacy format: single prompt string
-                versions.append({
-                    "version": 1,
-                    "type": "user",
-                    "prompt": user_prompt_data,
-                    "timestamp": created_at
-                })
-        
-        return versions
+        return self.versions_from_history(load_history(cursor, document_id), row[0])
 
     def get_latest_prompt_for_layout(self, layout: str, cursor) -> dict:
         """
-        Get the latest user prompt for documents with the same layout.
-        Returns the prompt history (as JSON) or None if no prompts exist.
+        Get the prompt history shared by documents with this layout.
+        Returns the prompt history (as a list) or None if no prompts exist.
         """
-        cursor.execute(
-            "SELECT user_prompt FROM documents WHERE layout = ? AND user_prompt IS NOT NULL ORDER BY created_at DESC LIMIT 1",
-            (layout,)
-        )
-        row = cursor.fetchone()
-        
-        if row and row[0]:
-            try:
-                return json.loads(row[0])
-            except json.JSONDecodeError:
-                # Legacy format: return as single-item array
-                return [{"prompt": row[0], "timestamp": None}]
-        
-        return None
+        return load_layout_history(cursor, layout_hash(layout)) or None
 
-    def update_prompt_for_layout(self, layout: str, new_prompt: str, cursor, conn) -> int:
+    def update_prompt_for_layout(self, layout: str, new_prompt: str, cursor, after_commit: Callable = None) -> int:
         """
-        Add a new version to all documents with the same layout.
-        Returns the number of documents updated.
+        Add a new version to all documents with the same layout: one row in
+        layout_prompt_versions (all_documents) that every document of the layout sees.
+        Returns the number of documents with the layout. Runs inside the caller's write
+        transaction; the layout index is refreshed through after_commit (Database.after_commit)
+        so it never serves a prompt that was rolled back.
         """
-        import datetime
-        
-        # Get all documents with this layout
+        layout_key = layout_hash(layout)
+        append_layout_version(cursor, layout_key, new_prompt, datetime.now().isoformat(), all_documents=True)
+
         cursor.execute(
-            "SELECT id, user_prompt FROM documents WHERE layout = ?",
-            (layout,)
+            "SELECT id FROM documents WHERE layout_hash = ? ORDER BY created_at DESC, id DESC LIMIT 1",
+            (layout_key,)
         )
-        documents = cursor.fetchall()
-        
-        updated_count = 0
-        timestamp = datetime.datetime.now().isoformat()
-        
-        for doc_id, current_prompt_data in documents:
-            # Parse existing prompt history
-            prompt_history = []
-            if current_prompt_data:
-                try:
-                    parsed = json.loads(current_prompt_data)
-                    if isinstance(parsed, list):
-                        prompt_history = parsed
-                    else:
-                        # Legacy format: convert to new format
-                        prompt_history = [{"prompt": current_prompt_data, "timestamp": None}]
-                except json.JSONDecodeError:
-                    # Legacy format: convert to new format
-                    prompt_history = [{"prompt": current_prompt_data, "timestamp": None}]
-            
-            # Add new version
-            prompt_history.append({
-                "prompt": new_prompt,
-                "timestamp": timestamp
-            })
-            
-            # Update document
-            cursor.execute(
-                "UPDATE documents SET user_prompt = ? WHERE id = ?",
-                (json.dumps(prompt_history), doc_id)
-            )
-            updated_count += 1
-        
-        conn.commit()
-        return updated_count
+        latest = cursor.fetchone()
+        if latest is None:
+            return 0
+        prompt = history_json(load_history(cursor, latest[0]))
+        _run_after_commit(after_commit, lambda: self.layout_index.add(latest[0], layout, prompt))
+        cursor.execute("SELECT COUNT(*) FROM documents WHERE layout_hash = ?", (layout_key,))
+        return cursor.fetchone()[0]
 
-    def update_specific_version(self, document_id: int, version: int, new_prompt: str, cursor, conn) -> bool:
+    def update_specific_version(
+        self, document_id: int, version: int, new_prompt: str, cursor, after_commit: Callable = None
+    ) -> bool:
         """
         Update a specific version's prompt text for a single document.
         Version 0 cannot be edited (system prompt).
-        Returns True if successful, False otherwise.
+        Returns True if successful, False otherwise. Runs inside the caller's write
+        transaction; the layout index is refreshed through after_commit.
         """
         if version == 0:
             return False  # Cannot edit system prompt
         
-        cursor.execute(
-            "SELECT user_prompt FROM documents WHERE id = ?",
-            (document_id,)
-        )
-        row = cursor.fetchone()
-        
-        if not row:
-            return False
-        
-        user_prompt_data = row[0]
-        
-        if not user_prompt_data:
-            return False  # No user prompts to edit
-        
-        try:
-            prompt_history = json.loads(user_prompt_data)
-            if not isinstance(prompt_history, list):
-                # Legacy format
-                if version == 1:
-                    prompt_history = [{"prompt": new_prompt, "timestamp": None}]
-                else:
-                    return False
-            else:
-                # Update the specific version (version 1 = index 0)
-                version_index = version - 1
-                if 0 <= version_index < len(prompt_history):
-                    prompt_history[version_index]["prompt"] = new_prompt
-                else:
-                    return False
-            
-            # Save updated history
-            cursor.execute(
-                "UPDATE documents SET user_prompt = ? WHERE id = ?",
-                (json.dumps(prompt_history), document_id)
-            )
-            conn.commit()
-            return True
-            
-        except (json.JSONDecodeError, IndexError, KeyError):
-            return False
\ No newline at end of file
+        history = load_history_versions(cursor, [document_id]).get(document_id, [])
+        if not 1 <= version <= len(history):
+            return False  # No such document or version
+
+        # Stored as an edit of this document only; the layout's version is unchanged
+        layout_version, entry = history[version - 1]
+        set_document_version(cursor, document_id, layout_version, new_prompt, entry["timestamp"])
+
+        cursor.execute("SELECT layout FROM documents WHERE id = ?", (document_id,))
+        layout_row = cursor.fetchone()
+        if layout_row and layout_row[0]:
+            prompt = history_json(load_history(cursor, document_id))
+            _run_after_commit(after_commit, lambda: self.layout_index.add(document_id, layout_row[0], prompt))
+        return True
\ No newline at end of file
@@ -0,0 +1,186 @@
+import json
+import hashlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# SQLite's default limit on bound parameters is 999 on older builds
+_ID_BATCH = 500
+
+
+def parse_layout(layout: Any) -> List[Any]:
+    """Accept the layout either as a list or as the JSON text stored in documents.layout."""
+    if isinstance(layout, str):
+        try:
+            layout = json.loads(layout)
+        except json.JSONDecodeError:
+            return []
+    return layout if isinstance(layout, list) else []
+
+
+def layout_hash(layout: Any) -> str:
+    """
+    Key of documents.layout_hash: sha1 of the layout's canonical JSON, so the same
+    column list matches however the JSON text was formatted when it was stored.
+    """
+    return hashlib.sha1(json.dumps(parse_layout(layout)).encode("utf-8")).hexdigest()
+
+
+def parse_prompt_history(user_prompt: Optional[str]) -> List[Dict[str, Any]]:
+    """
+    Prompt history from the legacy documents.user_prompt column: a JSON array of
+    {"prompt", "timestamp"} objects, or (older rows) a bare prompt string.
+    """
+    if not user_prompt:
+        return []
+    try:
+        parsed = json.loads(user_prompt)
+    except json.JSONDecodeError:
+        return [{"prompt": user_prompt, "timestamp": None}]
+    if not isinstance(parsed, list):
+        return [{"prompt": user_prompt, "timestamp": None}]
+    return [
+        {"prompt": entry.get("prompt", ""), "timestamp": entry.get("timestamp")}
+        for entry in parsed
+        if isinstance(entry, dict)
+    ]
+
+
+def history_json(history: List[Dict[str, Any]]) -> Optional[str]:
+    """The history in the JSON form the API has always exposed as user_prompt."""
+    return json.dumps(history) if history else None
+
+
+def latest_prompt(history: List[Dict[str, Any]]) -> Optional[str]:
+    """Text of the newest version of a history (what a suggested prompt is), or None."""
+    return history[-1].get("prompt") if history else None
+
+
+def load_layout_histories(cursor, layout_keys: Iterable[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Prompt versions of each layout (oldest first), i.e. the history a new document
+    of that layout inherits; batched by layout_hash.
+    """
+    keys = [key for key in dict.fromkeys(layout_keys) if key]
+    histories: Dict[str, List[Dict[str, Any]]] = {}
+    for start in range(0, len(keys), _ID_BATCH):
+        batch = keys[start:start + _ID_BATCH]
+        cursor.execute(
+            f"""
+            SELECT layout_hash, prompt, timestamp FROM layout_prompt_versions
+            WHERE layout_hash IN ({",".join("?" * len(batch))}) AND document_id IS NULL
+            ORDER BY layout_hash, version
+            """,
+            batch,
+        )
+        for key, prompt, timestamp in cursor.fetchall():
+            histories.setdefault(key, []).append({"prompt": prompt, "timestamp": timestamp})
+    return histories
+
+
+def load_layout_history(cursor, layout_key: str) -> List[Dict[str, Any]]:
+    return load_layout_histories(cursor, [layout_key]).get(layout_key, [])
+
+
+def load_history_versions(cursor, document_ids: Iterable[int]) -> Dict[int, List[Tuple[int, Dict[str, Any]]]]:
+    """
+    Prompt history of many documents as (layout version, entry) pairs, oldest first.
+
+    A document sees the versions of its layout up to documents.layout_versions (its
+    branch point, recorded when it was inserted; NULL: all of them), versions added
+    for all documents of the layout afterwards, and versions that belong to it alone
+    (layout_prompt_versions.document_id). Its own edits (prompt_versions rows, by
+    layout version) replace the layout's text.
+    """
+    ids = list(dict.fromkeys(document_ids))
+    layout_of: Dict[int, str] = {}
+    branch_of: Dict[int, Optional[int]] = {}
+    edits: Dict[Tuple[int, int], Dict[str, Any]] = {}
+    for start in range(0, len(ids), _ID_BATCH):
+        batch = ids[start:start + _ID_BATCH]
+        placeholders = ",".join("?" * len(batch))
+        cursor.execute(f"SELECT id, layout_hash, layout_versions FROM documents WHERE id IN ({placeholders})", batch)
+        for document_id, key, branch in cursor.fetchall():
+            layout_of[document_id] = key
+            branch_of[document_id] = branch
+        cursor.execute(
+            f"SELECT document_id, version, prompt, timestamp FROM prompt_versions WHERE document_id IN ({placeholders})",
+            batch,
+        )
+        for document_id, version, prompt, timestamp in cursor.fetchall():
+            edits[(document_id, version)] = {"prompt": prompt, "timestamp": timestamp}
+
+    rows: Dict[str, List[tuple]] = {}
+    keys = [key for key in dict.fromkeys(layout_of.values()) if key]
+    for start in range(0, len(keys), _ID_BATCH):
+        batch = keys[start:start + _ID_BATCH]
+        cursor.execute(
+            f"""
+            SELECT layout_hash, version, prompt, timestamp, document_id, all_documents
+            FROM layout_prompt_versions WHERE layout_hash IN ({",".join("?" * len(batch))})
+            ORDER BY layout_hash, version
+            """,
+            batch,
+        )
+        for key, *row in cursor.fetchall():
+            rows.setdefault(key, []).append(tuple(row))
+
+    histories: Dict[int, List[Tuple[int, Dict[str, Any]]]] = {}
+    for document_id in ids:
+        branch = branch_of.get(document_id)
+        history = [
+            (version, edits.get((document_id, version)) or {"prompt": prompt, "timestamp": timestamp})
+            for version, prompt, timestamp, owner, all_documents in rows.get(layout_of.get(document_id), [])
+            if owner == document_id
+            or (owner is None and (branch is None or version <= branch or all_documents))
+        ]
+        if history:
+            histories[document_id] = history
+    return histories
+
+
+def load_histories(cursor, document_ids: Iterable[int]) -> Dict[int, List[Dict[str, Any]]]:
+    """Prompt history (oldest version first) for many documents, see load_history_versions."""
+    return {
+        document_id: [entry for _, entry in versions]
+        for document_id, versions in load_history_versions(cursor, document_ids).items()
+    }
+
+
+def load_history(cursor, document_id: int) -> List[Dict[str, Any]]:
+    return load_histories(cursor, [document_id]).get(document_id, [])
+
+
+def append_layout_version(
+    cursor, layout_key: str, prompt: str, timestamp: str, all_documents: bool = False, document_id: int = None
+) -> int:
+    """
+    Add the next prompt version of a layout (one row) and return its number. It is
+    seen by documents inserted from now on, by every document of the layout with
+    all_documents, or only by document_id.
+    """
+    cursor.execute(
+        """
+        INSERT INTO layout_prompt_versions (layout_hash, version, prompt, timestamp, document_id, all_documents)
+        SELECT ?, COALESCE(MAX(version), 0) + 1, ?, ?, ?, ? FROM layout_prompt_versions WHERE layout_hash = ?
+        """,
+        (layout_key, prompt, timestamp, document_id, int(all_documents), layout_key),
+    )
+    cursor.execute(
+        "SELECT MAX(version) FROM layout_prompt_versions WHERE layout_hash = ?",
+        (layout_key,),
+    )
+    return cursor.fetchone()[0]
+
+
+# documents.layout_versions of a document inserted now: every version its layout has so far
+BRANCH_POINT_SQL = "(SELECT COALESCE(MAX(version), 0) FROM layout_prompt_versions WHERE layout_hash = ?)"
+
+
+def set_document_version(cursor, document_id: int, version: int, prompt: str, timestamp: Optional[str]) -> None:
+    """Store a document-specific edit of one layout version (overrides the layout's text)."""
+    cursor.execute(
+        """
+        INSERT INTO prompt_versions (document_id, version, prompt, timestamp) VALUES (?, ?, ?, ?)
+        ON CONFLICT (document_id, version) DO UPDATE SET prompt = excluded.prompt
+        """,
+        (document_id, version, prompt, timestamp),
+    )
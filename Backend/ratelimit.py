@@ -0,0 +1,225 @@
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from metrics import QUEUE_WAIT_SECONDS
+from tracing import run_in_executor
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+
+class RateLimitTimeout(RuntimeError):
+    """Raised when a call would have to wait longer than max_wait for rate budget."""
+
+
+class SharedRateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets for OCI chat calls, shared by
+    all gunicorn workers through one SQLite file.
+
+    Each budget is a token bucket (capacity = the per-minute limit, refilled
+    continuously) stored as a row of rate_buckets; a call takes one request and
+    its estimated tokens (prompt estimate + output_estimate) from both buckets in
+    a single BEGIN IMMEDIATE transaction, or waits until both can cover it.
+    Once the answer is in, asettle() corrects the token bucket by the difference
+    between the real and the estimated output tokens.
+
+    Interactive calls (try-prompt) go before batch extraction: batch calls must
+    leave interactive_reserve of each bucket untouched, and inside a worker
+    batch calls hold back while an interactive call is waiting.
+    A limit of 0 disables that budget.
+    """
+
+    def __init__(
+        self,
+        db_path: str = "ratelimit.db",
+        requests_per_minute: int = 0,
+        tokens_per_minute: int = 0,
+        output_estimate: int = 500,
+        interactive_reserve: float = 0.2,
+        max_wait: float = 120.0,
+        name: str = "oci",
+    ):
+        self.db_path = db_path
+        self.limits = {"rpm": requests_per_minute, "tpm": tokens_per_minute}
+        self.output_estimate = output_estimate
+        self.interactive_reserve = interactive_reserve
+        self.max_wait = max_wait
+        self.name = name
+        self.enabled = any(limit > 0 for limit in self.limits.values())
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._interactive_waiting = 0
+        self._stats: Dict[str, Dict[str, float]] = {
+            priority: {"calls": 0, "waited": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "timeouts": 0}
+            for priority in (INTERACTIVE, BATCH)
+        }
+
+        if self.enabled:
+            self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS rate_buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """)
+
+    def _conn(self) -> sqlite3.Connection:
+        if not hasattr(self._local, "connection"):
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = conn
+        return self._local.connection
+
+    def _bucket_names(self):
+        return {kind: f"{self.name}:{kind}" for kind, limit in self.limits.items() if limit > 0}
+
+    @staticmethod
+    def _level(row: Optional[Tuple[float, float]], limit: int, now: float) -> float:
+        """Bucket level at `now`: the stored level plus the refill since it was stored."""
+        if row is None:
+            return float(limit)
+        tokens, updated_at = row
+        return min(float(limit), tokens + (now - updated_at) * limit / 60)
+
+    def _try_take(self, tokens: int, priority: str) -> float:
+        """Take one request and `tokens` if both buckets allow it; else seconds until they should."""
+        names = self._bucket_names()
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            levels, wait = {}, 0.0
+            for kind, bucket in names.items():
+                limit = self.limits[kind]
+                row = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE name = ?", (bucket,)).fetchone()
+                levels[kind] = self._level(row, limit, now)
+                reserve = limit * self.interactive_reserve if priority == BATCH else 0.0
+                # A call larger than the whole budget goes through once the bucket is full
+                need = min(1 if kind == "rpm" else tokens, limit - reserve)
+                shortfall = need + reserve - levels[kind]
+                if shortfall > 0:
+                    wait = max(wait, shortfall * 60 / limit)
+            if wait > 0:
+                conn.execute("ROLLBACK")
+                return wait
+            conn.executemany(
+                "INSERT OR REPLACE INTO rate_buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                [
+                    (bucket, levels[kind] - (1 if kind == "rpm" else tokens), now)
+                    for kind, bucket in names.items()
+                ],
+            )
+            conn.execute("COMMIT")
+            return 0.0
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    def estimate(self, prompt_tokens: int) -> int:
+        return prompt_tokens + self.output_estimate
+
+    async def _anext_wait(self, tokens: int, priority: str) -> float:
+        if priority == BATCH and self._interactive_waiting:
+            return 0.05
+        # BEGIN IMMEDIATE on the shared file can wait on other workers: keep it off the event loop
+        return await run_in_executor(None, self._try_take, tokens, priority)
+
+    def _begin_wait(self, priority: str) -> None:
+        if priority == INTERACTIVE:
+            with self._lock:
+                self._interactive_waiting += 1
+
+    def _end_wait(self, priority: str, waited: float, timed_out: bool = False) -> None:
+        QUEUE_WAIT_SECONDS.observe(waited, f"rate_limit_{priority}")
+        with self._lock:
+            if priority == INTERACTIVE:
+                self._interactive_waiting -= 1
+            stats = self._stats[priority]
+            stats["calls"] += 1
+            stats["timeouts"] += int(timed_out)
+            if waited:
+                stats["waited"] += 1
+                stats["wait_seconds"] += waited
+                stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+
+    def _timeout(self) -> RateLimitTimeout:
+        limits = ", ".join(f"{kind}={limit}" for kind, limit in self.limits.items() if limit)
+        return RateLimitTimeout(f"{self.name} rate limit: no budget for this call within {self.max_wait:g}s ({limits})")
+
+    async def aacquire(self, prompt_tokens: int, priority: str = BATCH) -> float:
+        """
+        Wait until the call fits in the budgets and take them; returns the seconds waited.
+        Sleeps on the event loop, takes budget on a thread.
+        """
+        if not self.enabled:
+            return 0.0
+        tokens = self.estimate(prompt_tokens)
+        start = time.monotonic()
+        timed_out = slept = False
+        self._begin_wait(priority)
+        try:
+            while True:
+                wait = await self._anext_wait(tokens, priority)
+                if wait <= 0:
+                    break
+                if time.monotonic() - start + wait > self.max_wait:
+                    timed_out = True
+                    raise self._timeout()
+                await asyncio.sleep(wait + random.uniform(0, 0.05))
+                slept = True
+        finally:
+            waited = time.monotonic() - start if slept else 0.0
+            self._end_wait(priority, waited, timed_out)
+        self._log_wait(priority, waited)
+        return waited
+
+    def _log_wait(self, priority: str, waited: float) -> None:
+        if waited >= 1:
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+            logging.info(f"[OCI RATE LIMIT] {timestamp} - {priority} call waited {waited:.2f}s for rate budget")
+
+    def _settle(self, output_tokens: int) -> None:
+        delta = output_tokens - self.output_estimate
+        try:
+            self._conn().execute(
+                "UPDATE rate_buckets SET tokens = MIN(?, tokens - ?) WHERE name = ?",
+                (self.limits["tpm"], delta, f"{self.name}:tpm"),
+            )
+        except sqlite3.Error as e:
+            logging.warning(f"Failed to settle rate limit tokens: {e}")
+
+    async def asettle(self, output_tokens: Optional[int]) -> None:
+        """
+        Charge (or refund) the difference between real and estimated output tokens;
+        the UPDATE runs on a thread as it waits on the shared file's write lock.
+        """
+        if not self.limits["tpm"] or output_tokens is None or output_tokens == self.output_estimate:
+            return
+        await run_in_executor(None, self._settle, output_tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        """Waiting counters for this worker process plus the shared bucket levels."""
+        with self._lock:
+            stats: Dict[str, Any] = {priority: dict(values) for priority, values in self._stats.items()}
+        stats["limits"] = {kind: limit for kind, limit in self.limits.items()}
+        stats["enabled"] = self.enabled
+        if self.enabled:
+            now = time.time()
+            levels = {}
+            for kind, bucket in self._bucket_names().items():
+                row = self._conn().execute(
+                    "SELECT tokens, updated_at FROM rate_buckets WHERE name = ?", (bucket,)
+                ).fetchone()
+                levels[kind] = round(self._level(row, self.limits[kind], now), 1)
+            stats["levels"] = levels
+        return stats
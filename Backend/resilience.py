@@ -0,0 +1,358 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple, Type
+
+# Throttling, timeouts and server-side failures; anything else (400, 401, 404...) is final
+RETRYABLE_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling the service while the circuit breaker is open."""
+
+
+def error_status(exc: BaseException) -> Optional[int]:
+    """HTTP status carried by an SDK/HTTP error (oci ServiceError.status, OCIHTTPError.status)."""
+    for attr in ("status", "status_code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive transient failures; while open every
+    call fails fast. After reset_timeout seconds one probe call is let through
+    (half-open): success closes the circuit, failure opens it again.
+    failure_threshold=0 disables the breaker.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if not self.failure_threshold:
+            return True
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._probe_in_flight = False
+            if self.state != self.CLOSED:
+                logging.info(f"[OCI CIRCUIT] {_now()} - Circuit closed")
+                self.state = self.CLOSED
+
+    def record_failure(self) -> None:
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.opens += 1
+                logging.warning(
+                    f"[OCI CIRCUIT] {_now()} - Circuit opened after {self.failures} failure(s); "
+                    f"failing fast for {self.reset_timeout:g}s"
+                )
+
+    def release(self) -> None:
+        """A call let through was abandoned (cancelled) before it had an outcome."""
+        with self._lock:
+            self._probe_in_flight = False
+
+
+class RetryBudget:
+    """
+    Caps retries (or hedges) to a fraction of calls: every call deposits `ratio`
+    tokens, every retry spends one, and at most max_tokens can be banked. While
+    the service is degraded this stops retries from multiplying its load.
+    """
+
+    def __init__(self, ratio: float, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class LatencyWindow:
+    """The last `size` successful call latencies, for percentile-based hedge delays."""
+
+    def __init__(self, size: int = 200):
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+class ResilientCaller:
+    """
+    Retry, hedging and circuit breaking around calls to one service.
+
+    Transient failures (RETRYABLE_STATUSES or one of transient_errors) are retried
+    up to max_attempts with full-jitter exponential backoff (base_delay * 2^n,
+    capped at max_delay, never shorter than a Retry-After the error carries), as
+    long as the whole call stays within `deadline` seconds and the retry budget
+    has tokens. With hedging on, a call that has not answered after the
+    hedge_percentile latency of similar calls (same `key`) gets one duplicate
+    request, and whichever answers first wins; hedges have their own budget.
+    The circuit breaker sees the outcome of every attempt. Counters and latency
+    percentiles are available from stats().
+    """
+
+    def __init__(
+        self,
+        name: str = "oci",
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        deadline: float = 240.0,
+        retry_budget_ratio: float = 0.2,
+        hedge: bool = False,
+        hedge_percentile: float = 95.0,
+        hedge_min_delay: float = 1.0,
+        hedge_min_samples: int = 20,
+        hedge_budget_ratio: float = 0.05,
+        breaker_failures: int = 5,
+        breaker_reset: float = 30.0,
+        transient_errors: Tuple[Type[BaseException], ...] = (),
+    ):
+        self.name = name
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.transient_errors = (TimeoutError, ConnectionError, asyncio.TimeoutError) + tuple(transient_errors)
+
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self.retry_budget = RetryBudget(retry_budget_ratio)
+        self.hedge_budget = RetryBudget(hedge_budget_ratio, max_tokens=5.0)
+        self._latency: Dict[str, LatencyWindow] = {}
+
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, int] = {
+            "calls": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "attempt_failures": 0,
+            "retries": 0,
+            "retry_budget_exhausted": 0,
+            "deadline_exhausted": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "short_circuited": 0,
+        }
+
+    # === Classification ===
+    def is_transient(self, exc: BaseException) -> bool:
+        return error_status(exc) in RETRYABLE_STATUSES or isinstance(exc, self.transient_errors)
+
+    def _count(self, key: str, amount: int = 1) -> None:
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def _record_success(self, key: str, seconds: float) -> None:
+        self.breaker.record_success()
+        with self._stats_lock:
+            self._latency.setdefault(key, LatencyWindow()).add(seconds)
+
+    def _record_failure(self, exc: BaseException) -> None:
+        self._count("attempt_failures")
+        if self.is_transient(exc):
+            self.breaker.record_failure()
+        else:
+            # The service answered (e.g. 400): it is healthy as far as the breaker cares
+            self.breaker.record_success()
+
+    def _backoff(self, attempt: int, exc: BaseException) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = getattr(exc, "retry_after", None)
+        if isinstance(retry_after, (int, float)):
+            delay = max(delay, min(float(retry_after), self.max_delay))
+        return delay
+
+    def _should_retry(self, exc: BaseException, attempt: int, started: float, delay: float) -> bool:
+        if attempt + 1 >= self.max_attempts or not self.is_transient(exc):
+            return False
+        if self.breaker.state == CircuitBreaker.OPEN:
+            return False
+        if time.monotonic() + delay - started >= self.deadline:
+            self._count("deadline_exhausted")
+            return False
+        if not self.retry_budget.withdraw():
+            self._count("retry_budget_exhausted")
+            return False
+        return True
+
+    def _log_retry(self, exc: BaseException, attempt: int, delay: float) -> None:
+        self._count("retries")
+        logging.warning(
+            f"[OCI RETRY] {_now()} - {self.name} attempt {attempt + 1}/{self.max_attempts} failed "
+            f"({error_status(exc) or type(exc).__name__}: {str(exc)[:200]}); retrying in {delay:.2f}s"
+        )
+
+    def _check_circuit(self) -> None:
+        if not self.breaker.allow():
+            self._count("short_circuited")
+            raise CircuitOpenError(f"{self.name} circuit breaker is open; failing fast")
+
+    # === Calls ===
+    async def acall(
+        self,
+        factory: Callable[[], Awaitable[Any]],
+        key: str = "default",
+        hedge: Optional[bool] = None,
+        can_retry: Callable[[], bool] = None,
+    ) -> Any:
+        """
+        Await factory() with retries and (if enabled) hedging. factory must build a
+        fresh awaitable each time it is called. can_retry() is consulted before a
+        retry, e.g. to refuse once a stream has already emitted tokens.
+        """
+        self._count("calls")
+        self.retry_budget.deposit()
+        self.hedge_budget.deposit()
+        started = time.monotonic()
+        hedge = self.hedge if hedge is None else hedge
+        attempt = 0
+        while True:
+            self._check_circuit()
+            attempt_start = time.perf_counter()
+            remaining = self.deadline - (time.monotonic() - started)
+            try:
+                if hedge:
+                    result = await self._hedged(factory, key, remaining)
+                else:
+                    result = await asyncio.wait_for(factory(), remaining)
+            except Exception as e:
+                self._record_failure(e)
+                delay = self._backoff(attempt, e)
+                if (can_retry is not None and not can_retry()) or not self._should_retry(e, attempt, started, delay):
+                    self._count("failed")
+                    raise
+                self._log_retry(e, attempt, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            self._record_success(key, time.perf_counter() - attempt_start)
+            self._count("succeeded")
+            return result
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+        """Seconds to wait before hedging a call of this kind (None until enough samples)."""
+        with self._stats_lock:
+            window = self._latency.get(key)
+            if window is None or len(window) < self.hedge_min_samples:
+                return None
+            return max(self.hedge_min_delay, window.percentile(self.hedge_percentile))
+
+    async def _hedged(self, factory: Callable[[], Awaitable[Any]], key: str, timeout: float) -> Any:
+        deadline = time.monotonic() + timeout
+        delay = self.hedge_delay(key)
+        first = asyncio.ensure_future(factory())
+        if delay is None or delay >= timeout:
+            return await asyncio.wait_for(first, timeout)
+
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not self.hedge_budget.withdraw():
+            return await asyncio.wait_for(first, deadline - time.monotonic())
+
+        self._count("hedges")
+        second = asyncio.ensure_future(factory())
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError(f"{self.name} call exceeded its {timeout:.0f}s deadline")
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    # === Metrics ===
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            latency = {
+                key: {
+                    "samples": len(window),
+                    "p50_seconds": round(window.percentile(50), 3),
+                    "p95_seconds": round(window.percentile(95), 3),
+                }
+                for key, window in self._latency.items()
+                if len(window)
+            }
+        stats["circuit_state"] = self.breaker.state
+        stats["circuit_opens"] = self.breaker.opens
+        stats["retry_budget_tokens"] = round(self.retry_budget.tokens, 2)
+        stats["hedging"] = self.hedge
+        stats["latency"] = latency
+        return stats
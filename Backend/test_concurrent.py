@@ -2,14 +2,27 @@
 """
 Test script for concurrent processing optimization.
 This script makes multiple simultaneous requests to verify thread-safe database access.
+
+Tests 4 and 5 upload documents, so run the server against the stubbed OCI backend:
+
+    python fake_oci_server.py &
+    OCI_GENAI_ENDPOINT=http://127.0.0.1:8090 ./start_server.sh
+    python test_concurrent.py
+
+benchmark.py measures latency and throughput of the same endpoints under load.
 """
 
+import os
 import requests
 import concurrent.futures
+import tempfile
 import time
 import json
 
+from benchmark import make_fixture_pdf
+
 BASE_URL = "http://localhost:8080"
+SCHEMA_JSON = json.dumps({"po_number": "", "items": [{"description": "", "quantity": "", "price": ""}]})
 
 def test_concurrent_list_documents(thread_id):
     """Test concurrent document listing"""
@@ -69,6 +82,79 @@ def test_concurrent_versions(thread_id):
             "error": str(e)
         }
 
+def test_concurrent_uploads(thread_id):
+    """Test concurrent uploads (each thread saves a different document)"""
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    make_fixture_pdf(path, [
+        f"PURCHASE ORDER PO-{90000 + thread_id}",
+        "Client: Concurrent Test Supplies Ltd",
+        "Item    Description    Quantity    Price",
+        f"1    Test item {thread_id}    {thread_id + 1}    9.99",
+    ])
+    try:
+        start = time.time()
+        with open(path, "rb") as f:
+            response = requests.post(
+                f"{BASE_URL}/process-document/",
+                files={"file": (f"concurrent_{thread_id}.pdf", f, "application/pdf")},
+                data={"schema_json": SCHEMA_JSON, "use_cache": "false"},
+                timeout=600,
+            )
+        elapsed = time.time() - start
+
+        data = response.json() if response.status_code == 200 else {}
+        if data.get("status") == "success":
+            return {
+                "thread_id": thread_id,
+                "status": "success",
+                "elapsed": elapsed,
+                "document_count": 1
+            }
+        return {
+            "thread_id": thread_id,
+            "status": "error",
+            "elapsed": elapsed,
+            "error": data.get("message") or response.text
+        }
+    except Exception as e:
+        return {
+            "thread_id": thread_id,
+            "status": "exception",
+            "error": str(e)
+        }
+    finally:
+        os.unlink(path)
+
+
+def count_documents():
+    response = requests.get(f"{BASE_URL}/documents/", params={"limit": 1})
+    response.raise_for_status()
+    return response.json()["total_processed"]
+
+
+def check_paged_listing(page_size=2):
+    """Following next_cursor returns every document exactly once"""
+    ids, cursor = [], None
+    total = count_documents()
+    while True:
+        params = {"limit": page_size}
+        if cursor:
+            params["cursor"] = cursor
+        data = requests.get(f"{BASE_URL}/documents-with-versions/", params=params).json()
+        if data.get("status") != "success":
+            print(f"  ✗ FAILED - {data.get('message')}")
+            return False
+        ids.extend(document["id"] for document in data["documents"])
+        cursor = data.get("next_cursor")
+        if not cursor:
+            break
+    passed = len(ids) == len(set(ids)) == total
+    print(f"  {'✓' if passed else '✗'} {len(ids)} documents over {-(-len(ids) // page_size)} pages, "
+          f"{len(set(ids))} distinct, total_processed={total}")
+    return passed
+
+
 def run_concurrent_test(test_func, num_threads=5, test_name="Test"):
     """Run a test function concurrently with multiple threads"""
     print(f"\n{'='*60}")
@@ -131,6 +217,23 @@ if __name__ == "__main__":
         test_name="Test 3: High Concurrency (10 threads)"
     )
     
+    # Test 4: Concurrent uploads; every saved document must show up in the listing
+    before = count_documents()
+    test4_passed = run_concurrent_test(
+        test_concurrent_uploads,
+        num_threads=8,
+        test_name="Test 4: Concurrent Uploads (8 threads)"
+    )
+    after = count_documents()
+    print(f"  Documents: {before} -> {after}")
+    test4_passed = test4_passed and after - before == 8
+
+    # Test 5: Paged listing
+    print(f"\n{'='*60}")
+    print("Test 5: Paged Listing")
+    print(f"{'='*60}")
+    test5_passed = check_paged_listing()
+
     # Final summary
     print(f"\n{'='*60}")
     print("FINAL RESULTS")
@@ -138,8 +241,10 @@ if __name__ == "__main__":
     print(f"Test 1 (Concurrent Listing): {'✓ PASSED' if test1_passed else '✗ FAILED'}")
     print(f"Test 2 (Concurrent Versions): {'✓ PASSED' if test2_passed else '✗ FAILED'}")
     print(f"Test 3 (High Concurrency): {'✓ PASSED' if test3_passed else '✗ FAILED'}")
+    print(f"Test 4 (Concurrent Uploads): {'✓ PASSED' if test4_passed else '✗ FAILED'}")
+    print(f"Test 5 (Paged Listing): {'✓ PASSED' if test5_passed else '✗ FAILED'}")
     
-    if all([test1_passed, test2_passed, test3_passed]):
+    if all([test1_passed, test2_passed, test3_passed, test4_passed, test5_passed]):
         print("\n🎉 All tests passed! Concurrent processing is working correctly.")
     else:
         print("\n⚠️  Some tests failed. Check the backend logs for details.")
@@ -0,0 +1,86 @@
+import os
+import time
+
+from cache import DoclingCache, LLMResponseCache, hash_file
+
+
+def test_hash_file(tmp_path):
+    """Same content, same key; the chunk size does not change the digest"""
+    a, b = tmp_path / "a.pdf", tmp_path / "b.pdf"
+    a.write_bytes(b"%PDF-1.4 same bytes" * 1000)
+    b.write_bytes(b"%PDF-1.4 same bytes" * 1000)
+    assert hash_file(str(a)) == hash_file(str(b), chunk_size=7)
+    b.write_bytes(b"%PDF-1.4 other bytes")
+    assert hash_file(str(a)) != hash_file(str(b))
+
+
+def test_docling_cache_roundtrip(tmp_path):
+    """put() then get() returns the conversion; unknown keys and corrupt entries are misses"""
+    cache = DoclingCache(str(tmp_path), config={"ocr_mode": "full"})
+    assert cache.get("abc") is None
+    cache.put("abc", "# Title", {"pages": 2})
+    assert cache.get("abc") == ("# Title", {"pages": 2})
+
+    cache._path("corrupt").write_text("{not json")
+    assert cache.get("corrupt") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["writes"]) == (1, 2, 1)
+    assert not [name for name in os.listdir(tmp_path) if name.startswith(DoclingCache.TMP_PREFIX)]
+
+
+def test_docling_cache_is_keyed_by_config(tmp_path):
+    """A different conversion config misses instead of serving the other config's output"""
+    full = DoclingCache(str(tmp_path), config={"ocr_mode": "full"})
+    adaptive = DoclingCache(str(tmp_path), config={"ocr_mode": "adaptive"})
+    assert full.config_digest != adaptive.config_digest
+    assert full.config_digest == DoclingCache(str(tmp_path), config={"ocr_mode": "full"}).config_digest
+
+    full.put("abc", "full OCR", {})
+    assert adaptive.get("abc") is None
+    adaptive.put("abc", "text layer", {})
+    assert full.get("abc") == ("full OCR", {})
+    assert adaptive.get("abc") == ("text layer", {})
+
+
+def test_docling_cache_evicts_least_recently_used(tmp_path):
+    """Over max_bytes, the entries read least recently are removed first"""
+    cache = DoclingCache(str(tmp_path), max_bytes=10 ** 6)
+    for key in ("a", "b", "c"):
+        cache.put(key, "x" * 1000, {})
+    old = time.time() - 100
+    for age, key in enumerate(("a", "b", "c")):
+        os.utime(cache._path(key), (old + age, old + age))
+    cache.get("a")  # bumps a to most recently used
+
+    cache.max_bytes = 2500
+    cache.put("d", "x" * 1000, {})
+    assert cache.get("b") is None and cache.get("c") is None
+    assert cache.get("a") is not None and cache.get("d") is not None
+    assert cache.stats()["evictions"] == 2
+
+
+def test_llm_cache_keys():
+    """Every parameter that can change the answer is part of the key"""
+    key = LLMResponseCache.make_key("prompt", model="m", temperature=0)
+    assert key == LLMResponseCache.make_key("prompt", temperature=0, model="m")
+    assert key != LLMResponseCache.make_key("prompt", model="m", temperature=0.5)
+    assert key != LLMResponseCache.make_key("other prompt", model="m", temperature=0)
+
+
+def test_llm_cache_ttl_and_bound(tmp_path):
+    """Entries expire after ttl_seconds and the table keeps at most max_entries"""
+    cache = LLMResponseCache(str(tmp_path / "llm_cache.db"), ttl_seconds=3600, max_entries=2)
+    cache.put("a", "answer a", 10)
+    assert cache.get("a") == ("answer a", 10)
+    assert cache.get("missing") is None
+
+    cache._conn().execute("UPDATE llm_cache SET created_at = created_at - 7200 WHERE key = 'a'")
+    cache._conn().commit()
+    assert cache.get("a") is None
+
+    for key in ("b", "c", "d"):
+        cache.put(key, f"answer {key}", None)
+    count = cache._conn().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+    assert count == 2
+    assert cache.get("d") == ("answer d", None)
+    assert cache.stats()["evictions"] >= 2
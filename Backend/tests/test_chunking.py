@@ -0,0 +1,80 @@
+from chunking import estimate_tokens, is_failed_extraction, merge_extractions, split_markdown
+
+TABLE = "\n".join(
+    ["| Item | Quantity | Price |", "|---|---|---|"]
+    + [f"| Item number {n} | {n} | {n}.99 |" for n in range(40)]
+)
+
+
+def test_small_document_is_one_chunk():
+    """Markdown within the budget comes back unchanged"""
+    markdown = "# Invoice\n\nClient: Acme Ltd\n\nTotal: 10.00"
+    assert split_markdown(markdown, 1000) == [markdown]
+
+
+def test_chunks_respect_budget_and_boundaries():
+    """Chunks stay within the budget and are cut between sections, never inside a paragraph"""
+    sections = [f"# Section {n}\n\n" + " ".join(f"word{n}-{i}" for i in range(40)) for n in range(6)]
+    markdown = "\n\n".join(sections)
+    chunks = split_markdown(markdown, 200)
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= 200 for chunk in chunks)
+    assert "\n\n".join(chunks) == markdown
+
+
+def test_table_stays_whole_when_it_fits():
+    """A table that fits the budget is never split across chunks"""
+    markdown = f"Intro paragraph.\n\n{TABLE}\n\nClosing paragraph."
+    chunks = split_markdown(markdown, estimate_tokens(TABLE) + 10)
+    assert any(TABLE in chunk for chunk in chunks)
+
+
+def test_oversized_table_repeats_header():
+    """Pieces of a table larger than the budget each start with the header rows"""
+    chunks = split_markdown(TABLE, 100)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.startswith("| Item | Quantity | Price |\n|---|---|---|\n| Item number")
+    rows = [line for chunk in chunks for line in chunk.splitlines()[2:]]
+    assert rows == TABLE.splitlines()[2:]
+
+
+def test_oversized_line_is_hard_wrapped():
+    """A single line larger than the budget is cut into budget-sized pieces"""
+    line = "x" * 2000
+    chunks = split_markdown(line, 100)
+    assert "".join(chunks) == line
+    assert all(estimate_tokens(chunk) <= 101 for chunk in chunks)
+
+
+def test_merge_concatenates_lists_and_keeps_first_scalar():
+    """Line items are concatenated in chunk order; scalars take the first non-empty value"""
+    merged = merge_extractions(
+        [
+            {"po_number": "", "items": [{"description": "A"}]},
+            {"po_number": "PO-1", "items": [{"description": "B"}, {}]},
+            {"po_number": "PO-2", "items": [{"description": "B"}]},
+        ],
+        schema={"po_number": "", "client": "", "items": []},
+    )
+    assert list(merged) == ["po_number", "client", "items"]
+    assert merged["po_number"] == "PO-1"
+    assert merged["client"] == ""
+    # Chunks do not overlap: a repeated row is a real repeated line item
+    assert merged["items"] == [{"description": "A"}, {"description": "B"}, {"description": "B"}]
+
+
+def test_merge_nested_objects():
+    """Nested objects are merged key by key"""
+    merged = merge_extractions([{"client": {"name": "Acme"}}, {"client": {"name": "", "vat": "GB1"}}])
+    assert merged == {"client": {"name": "Acme", "vat": "GB1"}}
+
+
+def test_merge_skips_failed_chunks():
+    """Parse errors and non-object answers add nothing to the merged result"""
+    failed = {"error": "Invalid JSON", "raw": "not json"}
+    assert is_failed_extraction(failed)
+    assert is_failed_extraction(["a list"])
+    assert not is_failed_extraction({"error": "a field named error"})
+    merged = merge_extractions([failed, {"po_number": "PO-1"}, "text"], schema={"po_number": ""})
+    assert merged == {"po_number": "PO-1"}
@@ -0,0 +1,122 @@
+import asyncio
+import os
+
+import pytest
+
+from jobs import JobQueue, QueueFullError
+
+
+def make_queue(tmp_path, **kwargs):
+    return JobQueue(db_path=str(tmp_path / "jobs.db"), upload_dir=str(tmp_path / "uploads"), **kwargs)
+
+
+def upload(tmp_path, name="upload.pdf", data=b"%PDF-1.4"):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_submit_and_claim(tmp_path):
+    """Submitted jobs are claimed oldest first, with the upload moved into upload_dir"""
+    queue = make_queue(tmp_path)
+    first = queue.submit("process", "a.pdf", upload(tmp_path, "a.pdf"), "{}")
+    second = queue.submit("inference", "b.pdf", upload(tmp_path, "b.pdf"), "{}", use_cache=False)
+    assert not (tmp_path / "a.pdf").exists()
+    assert queue.get(first)["job_status"] == "queued"
+    assert queue.pending_count() == 2
+
+    job = queue.claim()
+    assert job["job_id"] == first and os.path.exists(job["file_path"])
+    assert queue.claim()["use_cache"] is False
+    assert queue.claim() is None
+    assert queue.get(second)["job_status"] == "running"
+    assert queue.get(second)["attempts"] == 1
+
+
+def test_queue_full(tmp_path):
+    """Past max_pending queued jobs submit() refuses and leaves the upload where it was"""
+    queue = make_queue(tmp_path, max_pending=1)
+    queue.submit("process", "a.pdf", upload(tmp_path, "a.pdf"), "{}")
+    path = upload(tmp_path, "b.pdf")
+    with pytest.raises(QueueFullError):
+        queue.submit("process", "b.pdf", path, "{}")
+    assert os.path.exists(path)
+
+
+def test_stages_and_result(tmp_path):
+    """Stages report progress; finish() stores the response body and the outcome"""
+    queue = make_queue(tmp_path)
+    job_id = queue.submit("process", "a.pdf", upload(tmp_path), "{}")
+    queue.claim()
+    queue.set_stage(job_id, "extraction")
+    assert queue.get(job_id)["progress"] == JobQueue.STAGES.index("extraction") / 5
+
+    queue.finish(job_id, {"status": "success", "document_id": 7})
+    job = queue.get(job_id)
+    assert (job["job_status"], job["stage"], job["progress"]) == ("succeeded", "done", 1.0)
+    assert job["result"] == {"status": "success", "document_id": 7}
+
+    failed = queue.submit("process", "b.pdf", upload(tmp_path, "b.pdf"), "{}")
+    queue.claim()
+    queue.finish(failed, {"status": "error", "message": "bad PDF"})
+    assert queue.get(failed)["error"] == "bad PDF"
+    assert [job["job_id"] for job in queue.list(status="failed")] == [failed]
+    # Listings leave the (possibly large) result out
+    assert all(job["result"] is None for job in queue.list())
+
+
+def test_stale_jobs_are_requeued_then_failed(tmp_path):
+    """A job whose worker stopped heartbeating is requeued, and failed after max_attempts claims"""
+    queue = make_queue(tmp_path, stale_after=60, max_attempts=2)
+    job_id = queue.submit("process", "a.pdf", upload(tmp_path), "{}")
+
+    def claim_and_die():
+        job = queue.claim()
+        queue._conn().execute("UPDATE jobs SET heartbeat_at = heartbeat_at - 120 WHERE id = ?", (job_id,))
+        return job
+
+    file_path = claim_and_die()["file_path"]
+    assert queue.requeue_stale() == 1
+    assert queue.get(job_id)["job_status"] == "queued"
+
+    claim_and_die()
+    assert queue.requeue_stale() == 0
+    job = queue.get(job_id)
+    assert job["job_status"] == "failed" and "2 attempts" in job["error"]
+    assert not os.path.exists(file_path)
+
+
+def test_workers_run_jobs(tmp_path):
+    """Started workers pick up submitted jobs, report stages and store the handler's result"""
+    queue = make_queue(tmp_path, concurrency=2, poll_interval=0.05)
+    stages = []
+
+    async def handler(job, on_stage):
+        on_stage("docling")
+        stages.append(job["filename"])
+        if job["filename"] == "broken.pdf":
+            raise ValueError("cannot parse")
+        return {"status": "success", "filename": job["filename"]}
+
+    async def run():
+        queue.start(handler)
+        try:
+            ids = [
+                await queue.asubmit("process", name, upload(tmp_path, name), "{}")
+                for name in ("a.pdf", "b.pdf", "broken.pdf")
+            ]
+            for _ in range(200):
+                jobs = [await queue.aget(job_id) for job_id in ids]
+                if all(job["job_status"] in ("succeeded", "failed") for job in jobs):
+                    return jobs
+                await asyncio.sleep(0.02)
+            raise AssertionError(f"jobs did not finish: {jobs}")
+        finally:
+            await queue.stop()
+
+    jobs = asyncio.run(run())
+    assert [job["job_status"] for job in jobs] == ["succeeded", "succeeded", "failed"]
+    assert jobs[0]["result"] == {"status": "success", "filename": "a.pdf"}
+    assert jobs[2]["error"] == "cannot parse"
+    assert sorted(stages) == ["a.pdf", "b.pdf", "broken.pdf"]
+    assert not os.listdir(queue.upload_dir)
@@ -0,0 +1,102 @@
+import json
+import sqlite3
+
+from layout_index import LayoutIndex, layout_similarity, normalize_header
+from migrations import migrate
+from prompt_history import BRANCH_POINT_SQL, append_layout_version, layout_hash
+
+INVOICE = ["Item", "Description", "Quantity", "Unit Price (£)"]
+RECEIPT = ["Date", "Store", "Total"]
+
+
+def make_db():
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    conn.execute("""
+    CREATE TABLE documents (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT, file_type TEXT, client_name TEXT,
+        language TEXT, layout TEXT, user_prompt TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    migrate(conn)
+    return conn
+
+
+def insert_document(cur, layout, prompt=None):
+    """Insert a document as the upload pipeline does, giving its layout a new version when prompt is set."""
+    layout_json = json.dumps(layout)
+    key = layout_hash(layout_json)
+    if prompt:
+        append_layout_version(cur, key, prompt, "2024-01-01 00:00:00")
+    cur.execute(
+        f"INSERT INTO documents (layout, layout_hash, layout_versions) VALUES (?, ?, {BRANCH_POINT_SQL})",
+        (layout_json, key, key),
+    )
+    return cur.lastrowid
+
+
+def test_normalize_and_similarity():
+    """Headers compare without case, punctuation or currency; related layouts score partially"""
+    assert normalize_header("Unit Price (£)") == normalize_header("unit_price") == "unit price"
+    assert layout_similarity(INVOICE, list(INVOICE)) == 100
+    assert layout_similarity(INVOICE, RECEIPT) == 0
+    assert 0 < layout_similarity(["Item code", "Price"], ["Item No", "Price"]) < 100
+
+
+def test_search_threshold_and_ranking():
+    """Only layouts at or above the threshold are returned, best first"""
+    index = LayoutIndex(rebuild_interval=0)
+    index.add(1, INVOICE, "invoice prompt")
+    index.add(2, RECEIPT, "receipt prompt")
+    index.add(3, INVOICE[:3] + ["Amount"], "similar prompt")
+
+    results = index.search(INVOICE, threshold=50, top_k=3)
+    assert [prompt for _, _, prompt in results] == ["invoice prompt", "similar prompt"]
+    assert results[0][0] == 100
+    assert index.search(INVOICE, threshold=100) == [(100, json.dumps(INVOICE), "invoice prompt")]
+    assert index.search(["Unrelated"], threshold=10) == []
+
+
+def test_add_keeps_most_recent_prompt():
+    """One entry per layout, holding the prompt of the newest document"""
+    index = LayoutIndex(rebuild_interval=0)
+    index.add(2, INVOICE, "newer")
+    index.add(1, INVOICE, "older")
+    assert len(index) == 1
+    assert index.search(INVOICE)[0][2] == "newer"
+    # Removing the newest document's prompt drops the entry
+    index.add(2, INVOICE, None)
+    assert len(index) == 0
+
+
+def test_sync_reads_new_rows_and_rows_below_added_ids():
+    """sync() picks up rows inserted by other workers, including ids below ones this worker added"""
+    conn = make_db()
+    cur = conn.cursor()
+    index = LayoutIndex(rebuild_interval=0)
+    first = insert_document(cur, RECEIPT, "receipt prompt")
+    index.sync(cur)
+    assert index.search(RECEIPT)[0][2] == json.dumps([{"prompt": "receipt prompt", "timestamp": "2024-01-01 00:00:00"}])
+
+    # Another worker inserts a row, then this worker inserts (and add()s) a later one
+    other = insert_document(cur, INVOICE, "invoice prompt")
+    own = insert_document(cur, ["Name", "Email"], "contact prompt")
+    index.add(own, ["Name", "Email"], "contact prompt")
+    assert other < own and first < other
+    index.sync(cur)
+    assert len(index) == 3
+    assert index.search(INVOICE, threshold=100)
+
+
+def test_rebuild_and_clear():
+    """rebuild() reloads every row; clear() empties the index"""
+    conn = make_db()
+    cur = conn.cursor()
+    insert_document(cur, INVOICE, "invoice prompt")
+    insert_document(cur, RECEIPT)
+    index = LayoutIndex(rebuild_interval=0)
+    index.rebuild(cur)
+    # The receipt's layout has no prompt: nothing to suggest for it
+    assert len(index) == 1
+    index.clear()
+    assert len(index) == 0
+    assert index.search(INVOICE) == []
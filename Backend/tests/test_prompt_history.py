@@ -0,0 +1,125 @@
+import json
+import sqlite3
+
+from migrations import MIGRATIONS, migrate
+from prompt_history import (
+    BRANCH_POINT_SQL,
+    append_layout_version,
+    layout_hash,
+    load_histories,
+    load_layout_history,
+    parse_prompt_history,
+    set_document_version,
+)
+
+LAYOUT_A = json.dumps(["Item", "Quantity", "Price"])
+LAYOUT_B = json.dumps(["Date", "Total"])
+
+
+def entry(prompt, timestamp=None):
+    return {"prompt": prompt, "timestamp": timestamp}
+
+
+def legacy_db(documents):
+    """A database as it was before any migration: prompt histories as JSON in documents.user_prompt."""
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    conn.execute("""
+    CREATE TABLE documents (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT, file_type TEXT, client_name TEXT,
+        language TEXT, layout TEXT, user_prompt TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    for index, (layout, user_prompt) in enumerate(documents):
+        conn.execute(
+            "INSERT INTO documents (layout, user_prompt, created_at) VALUES (?, ?, ?)",
+            (layout, user_prompt, f"2024-01-{index + 1:02d} 00:00:00"),
+        )
+    return conn
+
+
+def insert_document(cur, layout):
+    """Insert a document as the upload pipeline does: it sees every version its layout has so far."""
+    key = layout_hash(layout)
+    cur.execute(
+        f"INSERT INTO documents (layout, layout_hash, layout_versions) VALUES (?, ?, {BRANCH_POINT_SQL})",
+        (layout, key, key),
+    )
+    return cur.lastrowid
+
+
+def test_parse_prompt_history():
+    """Legacy user_prompt values: JSON history, bare prompt text, or nothing"""
+    history = [entry("first", "2024-01-01"), entry("second", "2024-01-02")]
+    assert parse_prompt_history(json.dumps(history)) == history
+    assert parse_prompt_history("Extract every line item") == [entry("Extract every line item")]
+    assert parse_prompt_history('{"prompt": "not a list"}') == [entry('{"prompt": "not a list"}')]
+    assert parse_prompt_history(None) == []
+
+
+def test_layout_hash_ignores_json_formatting():
+    """The same column list hashes the same however its JSON was formatted"""
+    assert layout_hash('["Item","Price"]') == layout_hash('[ "Item", "Price" ]') == layout_hash(["Item", "Price"])
+    assert layout_hash('["Item","Price"]') != layout_hash('["Price","Item"]')
+
+
+def test_migrations_keep_every_history():
+    """After all migrations every document reads back exactly the history it had in user_prompt"""
+    histories = [
+        [entry("p1", "t1")],
+        [entry("p1", "t1"), entry("p2", "t2")],
+        [entry("p1", "t1"), entry("diverged", "t3")],
+        [],
+        [entry("other", "t4")],
+        [entry("p1", "t1"), entry("p2", "t2"), entry("p3", "t5")],
+        # The most recent document of layout A: its history becomes the layout's
+        [entry("p1", "t1")],
+    ]
+    layouts = [LAYOUT_A, LAYOUT_A, LAYOUT_A, LAYOUT_A, LAYOUT_B, LAYOUT_A, LAYOUT_A]
+    documents = [(layout, json.dumps(history) if history else None) for layout, history in zip(layouts, histories)]
+    documents.append((LAYOUT_B, "bare legacy prompt"))
+    histories.append([entry("bare legacy prompt")])
+    conn = legacy_db(documents)
+
+    assert migrate(conn) == len(MIGRATIONS)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    cur = conn.cursor()
+    loaded = load_histories(cur, range(1, len(documents) + 1))
+    for doc_id, history in enumerate(histories, start=1):
+        assert loaded.get(doc_id, []) == history, doc_id
+    assert cur.execute("SELECT COUNT(*) FROM documents WHERE user_prompt IS NOT NULL").fetchone()[0] == 0
+    assert load_layout_history(cur, layout_hash(LAYOUT_A)) == [entry("p1", "t1")]
+
+    # Running again is a no-op
+    assert migrate(conn) == len(MIGRATIONS)
+    assert load_histories(cur, range(1, len(documents) + 1)) == loaded
+
+
+def test_branch_points():
+    """Documents see their layout's versions up to their insertion, shared versions, and their own"""
+    conn = legacy_db([])
+    migrate(conn)
+    cur = conn.cursor()
+    key = layout_hash(LAYOUT_A)
+    append_layout_version(cur, key, "v1", "t1")
+    old = insert_document(cur, LAYOUT_A)
+
+    # A suggestion saved with a later upload: documents inserted before it do not see it
+    append_layout_version(cur, key, "v2", "t2")
+    new = insert_document(cur, LAYOUT_A)
+    assert load_histories(cur, [old, new]) == {old: [entry("v1", "t1")], new: [entry("v1", "t1"), entry("v2", "t2")]}
+
+    # A prompt update for the whole layout reaches every document
+    append_layout_version(cur, key, "v3", "t3", all_documents=True)
+    # A version of one document only
+    append_layout_version(cur, key, "mine", "t4", document_id=old)
+    # An edit of one document's copy of a layout version
+    set_document_version(cur, new, 1, "v1 edited", "t1")
+
+    histories = load_histories(cur, [old, new])
+    assert histories[old] == [entry("v1", "t1"), entry("v3", "t3"), entry("mine", "t4")]
+    assert histories[new] == [entry("v1 edited", "t1"), entry("v2", "t2"), entry("v3", "t3")]
+    # The layout's own history is unaffected by per-document versions and edits
+    assert load_layout_history(cur, key) == [entry("v1", "t1"), entry("v2", "t2"), entry("v3", "t3")]
+    # A document inserted now branches after every layout version
+    latest = insert_document(cur, LAYOUT_A)
+    assert load_histories(cur, [latest])[latest] == load_layout_history(cur, key)
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from ratelimit import BATCH, INTERACTIVE, RateLimitTimeout, SharedRateLimiter
+
+
+def limiter(tmp_path, **kwargs):
+    kwargs.setdefault("max_wait", 0.5)
+    return SharedRateLimiter(db_path=str(tmp_path / "ratelimit.db"), **kwargs)
+
+
+def test_disabled_limiter_never_waits(tmp_path):
+    """With no limits every call goes straight through and no database is created"""
+    rate_limiter = limiter(tmp_path)
+    assert not rate_limiter.enabled
+    assert asyncio.run(rate_limiter.aacquire(10 ** 6)) == 0.0
+    assert not (tmp_path / "ratelimit.db").exists()
+
+
+def test_requests_per_minute(tmp_path):
+    """Calls beyond the per-minute budget time out when they would wait longer than max_wait"""
+    rate_limiter = limiter(tmp_path, requests_per_minute=3, interactive_reserve=0)
+
+    async def run():
+        for _ in range(3):
+            assert await rate_limiter.aacquire(10) == 0.0
+        with pytest.raises(RateLimitTimeout):
+            await rate_limiter.aacquire(10)
+
+    asyncio.run(run())
+    stats = rate_limiter.stats()
+    assert stats[BATCH]["calls"] == 4 and stats[BATCH]["timeouts"] == 1
+    assert stats["levels"]["rpm"] < 1
+
+
+def test_budget_is_shared_through_the_file(tmp_path):
+    """Two limiters on the same file (two workers) draw from one bucket"""
+    first = limiter(tmp_path, requests_per_minute=2, interactive_reserve=0)
+    second = limiter(tmp_path, requests_per_minute=2, interactive_reserve=0)
+
+    async def run():
+        await first.aacquire(10)
+        await second.aacquire(10)
+        with pytest.raises(RateLimitTimeout):
+            await first.aacquire(10)
+
+    asyncio.run(run())
+
+
+def test_batch_calls_leave_the_interactive_reserve(tmp_path):
+    """Batch calls stop at the reserve; interactive calls can still use it"""
+    rate_limiter = limiter(tmp_path, requests_per_minute=10, interactive_reserve=0.2)
+
+    async def run():
+        for _ in range(8):
+            await rate_limiter.aacquire(10, BATCH)
+        with pytest.raises(RateLimitTimeout):
+            await rate_limiter.aacquire(10, BATCH)
+        assert await rate_limiter.aacquire(10, INTERACTIVE) == 0.0
+
+    asyncio.run(run())
+
+
+def test_settle_corrects_the_token_estimate(tmp_path):
+    """The token bucket is charged the estimate up front and corrected by the real output tokens"""
+    rate_limiter = limiter(tmp_path, tokens_per_minute=10000, output_estimate=500, interactive_reserve=0)
+
+    async def run():
+        await rate_limiter.aacquire(1000)
+        charged = rate_limiter.stats()["levels"]["tpm"]
+        await rate_limiter.asettle(100)
+        refunded = rate_limiter.stats()["levels"]["tpm"]
+        await rate_limiter.asettle(900)
+        return charged, refunded, rate_limiter.stats()["levels"]["tpm"]
+
+    charged, refunded, recharged = asyncio.run(run())
+    # Refill adds a few tokens between the reads
+    assert 8500 <= charged < 8510
+    assert 8900 <= refunded < 8920
+    assert 8500 <= recharged < 8530
@@ -0,0 +1,191 @@
+import asyncio
+import time
+
+import pytest
+
+from resilience import CircuitBreaker, CircuitOpenError, ResilientCaller, RetryBudget, error_status
+
+
+class ServiceError(Exception):
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"status {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def flaky(failures, result="ok"):
+    """factory for acall(): raises each of `failures` in turn, then returns result."""
+    calls = []
+
+    def factory():
+        async def attempt():
+            calls.append(time.monotonic())
+            if len(calls) <= len(failures):
+                raise failures[len(calls) - 1]
+            return result
+        return attempt()
+
+    return factory, calls
+
+
+def caller(**kwargs):
+    kwargs.setdefault("base_delay", 0.001)
+    kwargs.setdefault("max_delay", 0.01)
+    return ResilientCaller(name="test", **kwargs)
+
+
+def test_classification():
+    """Throttling and server errors are transient; client errors are final"""
+    resilient = caller(transient_errors=(OSError,))
+    assert error_status(ServiceError(429)) == 429
+    assert error_status(ValueError()) is None
+    assert resilient.is_transient(ServiceError(503))
+    assert resilient.is_transient(TimeoutError())
+    assert resilient.is_transient(OSError())
+    assert not resilient.is_transient(ServiceError(400))
+
+
+def test_transient_errors_are_retried():
+    """Transient failures are retried until a call succeeds"""
+    resilient = caller()
+    factory, calls = flaky([ServiceError(503), ServiceError(429)])
+    assert asyncio.run(resilient.acall(factory)) == "ok"
+    assert len(calls) == 3
+    stats = resilient.stats()
+    assert (stats["retries"], stats["succeeded"], stats["failed"]) == (2, 1, 0)
+
+
+def test_final_errors_are_not_retried():
+    """A 400 fails on the first attempt and does not count against the circuit"""
+    resilient = caller()
+    factory, calls = flaky([ServiceError(400)])
+    with pytest.raises(ServiceError):
+        asyncio.run(resilient.acall(factory))
+    assert len(calls) == 1
+    assert resilient.breaker.failures == 0
+
+
+def test_max_attempts_and_can_retry():
+    """Retries stop at max_attempts, or as soon as can_retry() refuses"""
+    resilient = caller(max_attempts=3)
+    factory, calls = flaky([ServiceError(503)] * 5)
+    with pytest.raises(ServiceError):
+        asyncio.run(resilient.acall(factory))
+    assert len(calls) == 3
+
+    factory, calls = flaky([ServiceError(503)] * 5)
+    with pytest.raises(ServiceError):
+        asyncio.run(resilient.acall(factory, can_retry=lambda: False))
+    assert len(calls) == 1
+
+
+def test_retry_after_is_honoured():
+    """A Retry-After on the error sets a floor on the backoff (capped at max_delay)"""
+    resilient = caller(max_delay=0.2)
+    factory, calls = flaky([ServiceError(429, retry_after=0.1)])
+    asyncio.run(resilient.acall(factory))
+    assert calls[1] - calls[0] >= 0.09
+
+
+def test_retry_budget():
+    """Retries beyond the banked budget are refused"""
+    budget = RetryBudget(ratio=0.5, max_tokens=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+
+    resilient = caller(max_attempts=10, retry_budget_ratio=0)
+    resilient.retry_budget.tokens = 2
+    factory, calls = flaky([ServiceError(503)] * 10)
+    with pytest.raises(ServiceError):
+        asyncio.run(resilient.acall(factory))
+    assert len(calls) == 3
+    assert resilient.stats()["retry_budget_exhausted"] == 1
+
+
+def test_circuit_breaker_opens_and_recovers():
+    """After failure_threshold failures calls fail fast; after reset_timeout one probe is let through"""
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()  # the probe
+    assert breaker.state == CircuitBreaker.HALF_OPEN and not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+
+def test_open_circuit_short_circuits_calls():
+    """While the circuit is open acall() raises CircuitOpenError without calling the service"""
+    resilient = caller(max_attempts=1, breaker_failures=1, breaker_reset=60)
+    factory, calls = flaky([ServiceError(503)] * 2)
+    with pytest.raises(ServiceError):
+        asyncio.run(resilient.acall(factory))
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(resilient.acall(factory))
+    assert len(calls) == 1
+    assert resilient.stats()["short_circuited"] == 1
+
+
+def test_cancelled_probe_releases_the_circuit():
+    """A half-open probe that is cancelled lets the next call probe instead"""
+    resilient = caller(breaker_failures=1, breaker_reset=0)
+    resilient.breaker.record_failure()
+
+    async def run():
+        async def hang():
+            await asyncio.sleep(10)
+        task = asyncio.ensure_future(resilient.acall(hang))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        factory, _ = flaky([])
+        return await resilient.acall(factory)
+
+    assert asyncio.run(run()) == "ok"
+
+
+def test_deadline():
+    """An attempt that outlives the deadline fails with a timeout"""
+    resilient = caller(deadline=0.05, max_attempts=1)
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(resilient.acall(hang))
+
+
+def test_hedged_call_takes_the_faster_answer():
+    """A call slower than the hedge delay gets a duplicate, and the first answer wins"""
+    resilient = caller(hedge=True, hedge_min_samples=3, hedge_min_delay=0.01, hedge_percentile=50)
+    for _ in range(3):
+        resilient._record_success("extraction", 0.01)
+    started = []
+
+    def factory():
+        async def attempt():
+            started.append(time.monotonic())
+            # The first request hangs, the hedge answers at once
+            if len(started) == 1:
+                await asyncio.sleep(10)
+                return "slow"
+            return "fast"
+        return attempt()
+
+    begin = time.monotonic()
+    assert asyncio.run(resilient.acall(factory, key="extraction")) == "fast"
+    assert time.monotonic() - begin < 1
+    stats = resilient.stats()
+    assert (stats["hedges"], stats["hedge_wins"]) == (1, 1)
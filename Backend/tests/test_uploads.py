@@ -0,0 +1,137 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import time
+
+import pytest
+
+from uploads import UploadLimitMiddleware, UploadSpool, UploadTooLargeError
+
+MB = 1024 * 1024
+
+
+class Upload:
+    """The part of Starlette's UploadFile that UploadSpool reads."""
+
+    def __init__(self, data: bytes, filename: str = "upload.pdf"):
+        self.file = io.BytesIO(data)
+        self.filename = filename
+
+    async def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+
+def test_spool_copies_and_hashes(tmp_path):
+    """The upload is copied to a named file in chunks, with the md5 of its content"""
+    spool = UploadSpool(str(tmp_path), chunk_size=1000)
+    data = os.urandom(25_000)
+    path, digest, size = asyncio.run(spool.spool(Upload(data)))
+    try:
+        assert os.path.dirname(path) == str(tmp_path)
+        assert size == len(data)
+        assert digest == hashlib.md5(data).hexdigest()
+        with open(path, "rb") as f:
+            assert f.read() == data
+    finally:
+        spool.discard(path)
+    assert not os.listdir(tmp_path)
+
+
+def test_spool_refuses_oversized_file(tmp_path):
+    """A file over max_bytes raises UploadTooLargeError and leaves nothing behind"""
+    spool = UploadSpool(str(tmp_path), max_bytes=10_000, chunk_size=1000)
+    with pytest.raises(UploadTooLargeError):
+        asyncio.run(spool.spool(Upload(b"x" * 10_001)))
+    assert not os.listdir(tmp_path)
+
+
+def test_sweep_removes_stale_files(tmp_path):
+    """Files older than max_age (left by a crashed worker) are swept"""
+    spool = UploadSpool(str(tmp_path), max_age=60)
+    stale, fresh = tmp_path / "upload-stale", tmp_path / "upload-fresh"
+    stale.write_bytes(b"old")
+    fresh.write_bytes(b"new")
+    old = time.time() - 120
+    os.utime(stale, (old, old))
+    assert spool.sweep() == 1
+    assert os.listdir(tmp_path) == ["upload-fresh"]
+
+
+async def echo_app(scope, receive, send):
+    """Reads the whole body, then answers 200 with its size (or 400 if the client went away)."""
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            await send({"type": "http.response.start", "status": 400, "headers": []})
+            await send({"type": "http.response.body", "body": b"disconnected"})
+            return
+        size += len(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": str(size).encode()})
+
+
+def call(middleware, chunks, content_length=None):
+    """Send the body in chunks through the middleware; returns (status, body, chunks the app received)."""
+    headers = [(b"content-length", str(content_length).encode())] if content_length is not None else []
+    scope = {"type": "http", "method": "POST", "path": "/process-document/", "headers": headers}
+    pending = [
+        {"type": "http.request", "body": chunk, "more_body": index < len(chunks) - 1}
+        for index, chunk in enumerate(chunks)
+    ]
+    received, sent = [], []
+
+    async def receive():
+        message = pending.pop(0)
+        received.append(message)
+        return message
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(middleware(scope, receive, send))
+    statuses = [message["status"] for message in sent if message["type"] == "http.response.start"]
+    assert len(statuses) == 1, sent
+    body = b"".join(message.get("body", b"") for message in sent if message["type"] == "http.response.body")
+    return statuses[0], body, len(received)
+
+
+def test_middleware_passes_bodies_within_the_limit():
+    """Requests up to max_bytes reach the app untouched"""
+    middleware = UploadLimitMiddleware(echo_app, max_bytes=MB)
+    assert call(middleware, [b"x" * 1000] * 3, content_length=3000)[:2] == (200, b"3000")
+    assert call(middleware, [b"x" * (MB // 2)] * 2)[:2] == (200, str(MB).encode())
+
+
+def test_middleware_refuses_declared_length_without_reading():
+    """A Content-Length over the limit is answered with 413 before the body is read"""
+    middleware = UploadLimitMiddleware(echo_app, max_bytes=MB)
+    status, body, received = call(middleware, [b"x" * 10], content_length=2 * MB)
+    assert status == 413
+    assert json.loads(body)["status"] == "error"
+    assert received == 0
+
+
+def test_middleware_cuts_off_chunked_bodies():
+    """A body without Content-Length is cut off once it crosses the limit, and the client gets a 413"""
+    middleware = UploadLimitMiddleware(echo_app, max_bytes=MB)
+    status, body, received = call(middleware, [b"x" * (MB // 4)] * 10)
+    assert status == 413
+    assert "limit" in json.loads(body)["message"]
+    assert received == 5
+
+
+def test_middleware_ignores_other_scopes():
+    """Lifespan and websocket scopes, or a limit of 0, go straight to the app"""
+    seen = []
+
+    async def app(scope, receive, send):
+        seen.append(scope["type"])
+
+    asyncio.run(UploadLimitMiddleware(app, max_bytes=MB)({"type": "lifespan"}, None, None))
+    asyncio.run(UploadLimitMiddleware(app, max_bytes=0)({"type": "http", "headers": []}, None, None))
+    assert seen == ["lifespan", "http"]
@@ -0,0 +1,346 @@
+import os
+import json
+import time
+import queue
+import random
+import asyncio
+import logging
+import functools
+import threading
+import contextvars
+import urllib.request
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+# Set for the whole request (also when the trace is not sampled), used in log lines
+REQUEST_ID: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+_CURRENT_SPAN: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class Span:
+    """One timed operation; spans of a request share a trace and form a tree via parent_id."""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start", "end", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def finish(self, error: BaseException = None) -> None:
+        if self.end is not None:
+            return
+        self.end = time.time()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"[:500]
+        self.trace.add(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round(((self.end or time.time()) - self.start) * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Trace:
+    """Finished spans of one request; exported when the root span finishes."""
+
+    def __init__(self, tracer: "Tracer", request_id: str):
+        self.tracer = tracer
+        self.trace_id = _new_id(128)
+        self.request_id = request_id
+        self.root: Optional[Span] = None
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+        if span is self.root:
+            self.tracer.export(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = [span.to_dict() for span in self.spans]
+        return {
+            "trace_id": self.trace_id,
+            "request_id": self.request_id,
+            "name": self.root.name,
+            "start": self.root.start,
+            "duration_ms": round((self.root.end - self.root.start) * 1000, 3),
+            "spans": spans,
+        }
+
+
+class JsonlExporter:
+    """Appends one JSON line per trace (with all its spans) to a local file."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, traces: List[Trace]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            for trace in traces:
+                f.write(json.dumps(trace.to_dict(), default=str) + "\n")
+
+
+class OTLPExporter:
+    """POSTs traces to an OpenTelemetry collector as OTLP/HTTP JSON (<url>/v1/traces)."""
+
+    def __init__(self, url: str, service_name: str = "document-intelligence-backend", timeout: float = 5.0):
+        self.url = url.rstrip("/") + "/v1/traces"
+        self.service_name = service_name
+        self.timeout = timeout
+
+    @staticmethod
+    def _value(value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def _span(self, trace: Trace, span: Span) -> Dict[str, Any]:
+        attributes = dict(span.attributes, request_id=trace.request_id)
+        otlp = {
+            "traceId": trace.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 2 if span is trace.root else 1,  # SERVER for the request, INTERNAL otherwise
+            "startTimeUnixNano": str(int(span.start * 1e9)),
+            "endTimeUnixNano": str(int(span.end * 1e9)),
+            "attributes": [{"key": key, "value": self._value(value)} for key, value in attributes.items() if value is not None],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent_id:
+            otlp["parentSpanId"] = span.parent_id
+        return otlp
+
+    def export(self, traces: List[Trace]) -> None:
+        spans = [self._span(trace, span) for trace in traces for span in list(trace.spans)]
+        body = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "tracing"}, "spans": spans}],
+            }]
+        }
+        request = urllib.request.Request(
+            self.url, data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json"}
+        )
+        urllib.request.urlopen(request, timeout=self.timeout).read()
+
+
+class Tracer:
+    """
+    Per-request span trees carried in contextvars.
+
+    start_trace() opens the root span of a request and sets REQUEST_ID; span()
+    opens a child of whatever span is current in this context. asyncio tasks
+    inherit the context automatically; work handed to threads keeps it through
+    run_in_executor() / wrap(). A sampled trace (sample_rate) is queued for
+    export when its root span finishes and written by a background thread, so
+    the request path never waits on the file or collector. With no exporter,
+    span() costs one contextvar lookup and request ids still reach the logs.
+    """
+
+    def __init__(self, exporter=None, sample_rate: float = 1.0, max_queue: int = 1000):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self._queue: "queue.Queue[Trace]" = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def start_trace(self, name: str, request_id: str = None, **attributes: Any) -> Optional[Span]:
+        """
+        Open the root span of a request in the current context and return it (None
+        when not sampled). The caller finishes it with span.finish().
+        """
+        request_id = request_id or _new_id(64)
+        REQUEST_ID.set(request_id)
+        if not self.enabled or random.random() >= self.sample_rate:
+            _CURRENT_SPAN.set(None)
+            return None
+        trace = Trace(self, request_id)
+        trace.root = Span(trace, name, None, attributes)
+        _CURRENT_SPAN.set(trace.root)
+        return trace.root
+
+    @contextmanager
+    def trace(self, name: str, request_id: str = None, **attributes: Any):
+        """start_trace() for a block (background jobs): `with tracer.trace("job", job_id): ...`."""
+        request_token = REQUEST_ID.set(REQUEST_ID.get())
+        span_token = _CURRENT_SPAN.set(_CURRENT_SPAN.get())
+        root = self.start_trace(name, request_id, **attributes)
+        try:
+            yield root
+        except BaseException as e:
+            if root is not None:
+                root.finish(e)
+            raise
+        finally:
+            if root is not None:
+                root.finish()
+            _CURRENT_SPAN.reset(span_token)
+            REQUEST_ID.reset(request_token)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any):
+        """Child span of the current one; yields None (and records nothing) outside a sampled trace."""
+        parent = _CURRENT_SPAN.get()
+        if parent is None:
+            yield None
+            return
+        span = Span(parent.trace, name, parent.span_id, attributes)
+        token = _CURRENT_SPAN.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.finish(e)
+            raise
+        finally:
+            _CURRENT_SPAN.reset(token)
+            span.finish()
+
+    def start_span(self, name: str, **attributes: Any) -> Optional[Span]:
+        """
+        Child span of the current one that is not made current, for work that ends
+        elsewhere (a future's done callback); the caller finishes it. None outside a trace.
+        """
+        parent = _CURRENT_SPAN.get()
+        if parent is None:
+            return None
+        return Span(parent.trace, name, parent.span_id, attributes)
+
+    # === Export ===
+    def export(self, trace: Trace) -> None:
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._export_loop, name="trace-export", daemon=True)
+                self._thread.start()
+
+    def _export_loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.exporter.export(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                logging.warning(f"Failed to export {len(batch)} trace(s): {e}")
+
+
+def _build_tracer() -> Tracer:
+    """TRACE_EXPORT=jsonl (TRACE_FILE) or otlp (TRACE_COLLECTOR_URL); unset disables spans."""
+    mode = os.getenv("TRACE_EXPORT", "").lower()
+    exporter = None
+    if mode == "jsonl":
+        exporter = JsonlExporter(os.getenv("TRACE_FILE", "traces.jsonl"))
+    elif mode == "otlp":
+        exporter = OTLPExporter(os.getenv("TRACE_COLLECTOR_URL", "http://localhost:4318"))
+    return Tracer(exporter, sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "1.0")))
+
+
+TRACER = _build_tracer()
+span = TRACER.span
+start_span = TRACER.start_span
+
+
+def current_request_id() -> Optional[str]:
+    return REQUEST_ID.get()
+
+
+def set_attributes(**attributes: Any) -> None:
+    """Add attributes to the current span (no-op outside a sampled trace)."""
+    current = _CURRENT_SPAN.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def traced(name: str):
+    """Decorator: run the (sync or async) function inside span(name)."""
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def wrap(fn: Callable) -> Callable:
+    """fn bound to a copy of the caller's context, for running it on another thread."""
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        # A fresh copy per call: one Context cannot be entered by two threads at once
+        return context.copy().run(fn, *args, **kwargs)
+    return wrapper
+
+
+def run_in_executor(executor, fn: Callable, *args: Any) -> "asyncio.Future":
+    """loop.run_in_executor that keeps the trace context (and request id) on the worker thread."""
+    return asyncio.get_running_loop().run_in_executor(executor, wrap(fn), *args)
+
+
+def _install_log_request_ids() -> None:
+    """Prefix log messages emitted while handling a request with [request_id]."""
+    factory = logging.getLogRecordFactory()
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        request_id = REQUEST_ID.get()
+        record.request_id = request_id
+        if request_id and isinstance(record.msg, str):
+            record.msg = f"[{request_id}] {record.msg}"
+        return record
+
+    logging.setLogRecordFactory(record_factory)
+
+
+if os.getenv("TRACE_LOG_REQUEST_IDS", "true").lower() in ("1", "true", "yes"):
+    _install_log_request_ids()
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+from typing import Tuple
+
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload exceeds the configured size limit."""
+
+
+class UploadSpool:
+    """
+    Copies a parsed upload to a named file under spool_dir in fixed-size chunks.
+
+    By the time a handler runs, Starlette has already parsed the multipart body into
+    UploadFile.file, a SpooledTemporaryFile that rolls over to an anonymous temp file
+    with no path; Docling needs a path, so the upload is copied once, and its md5 (the
+    cache key format used by DoclingCache) is computed in the same pass so the pipeline
+    never has to re-read the file to hash it. The size check here is per file (a
+    request carrying a file over max_bytes); oversized request bodies are refused
+    before parsing by UploadLimitMiddleware. Callers remove the file with discard()
+    when they are done; files older than max_age seconds (left behind by a crashed
+    worker) are swept.
+    """
+
+    def __init__(
+        self,
+        spool_dir: str = None,
+        max_bytes: int = 100 * 1024 * 1024,
+        chunk_size: int = 1024 * 1024,
+        max_age: float = 6 * 3600,
+    ):
+        self.spool_dir = spool_dir or os.path.join(tempfile.gettempdir(), "dip-uploads")
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.max_age = max_age
+        self._last_sweep = 0.0
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+    async def spool(self, upload) -> Tuple[str, str, int]:
+        """Write a FastAPI UploadFile to disk; returns (path, md5 hex digest, size in bytes)."""
+        if time.time() - self._last_sweep > self.max_age / 4:
+            self.sweep()
+
+        digest = hashlib.md5()
+        size = 0
+        fd, path = tempfile.mkstemp(dir=self.spool_dir, prefix="upload-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = await upload.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if self.max_bytes and size > self.max_bytes:
+                        raise UploadTooLargeError(
+                            f"Upload {upload.filename} exceeds the {self.max_bytes // (1024 * 1024)} MB limit"
+                        )
+                    digest.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            self.discard(path)
+            raise
+        return path, digest.hexdigest(), size
+
+    @staticmethod
+    def discard(path: str) -> None:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def sweep(self) -> int:
+        """Remove spooled files older than max_age; returns how many were removed."""
+        self._last_sweep = time.time()
+        cutoff = self._last_sweep - self.max_age
+        removed = 0
+        try:
+            with os.scandir(self.spool_dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file() and entry.stat().st_mtime < cutoff:
+                            os.unlink(entry.path)
+                            removed += 1
+                    except OSError:
+                        continue
+        except OSError:
+            return 0
+        if removed:
+            logging.info(f"Removed {removed} stale upload file(s) from {self.spool_dir}")
+        return removed
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware that refuses request bodies larger than max_bytes with a 413
+    before the multipart parser spools them: requests that declare a larger
+    Content-Length are answered without reading the body, and chunked bodies are
+    counted as they are received and cut off once the limit is crossed.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.max_bytes:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self._reject(send)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            if exceeded:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if exceeded:
+                # The app saw a disconnect; whatever it answers is replaced by the 413
+                if not response_started:
+                    response_started = True
+                    await self._reject(send)
+                return
+            response_started = response_started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+        if exceeded and not response_started:
+            await self._reject(send)
+
+    async def _reject(self, send) -> None:
+        body = json.dumps({
+            "status": "error",
+            "message": f"Request body exceeds the {self.max_bytes // (1024 * 1024)} MB limit",
+        }).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
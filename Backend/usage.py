@@ -0,0 +1,188 @@
+import json
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from tracing import current_request_id
+
+# Records of the LLM calls made in the current pipeline run / request (None: not collected)
+_USAGE: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar("llm_usage", default=None)
+
+USAGE_COLUMNS = (
+    "purpose", "mode", "outcome", "cached", "input_tokens", "output_tokens",
+    "total_tokens", "tokens_estimated", "latency_ms", "model", "cost", "request_id", "created_at",
+)
+
+# Columns /usage/summary/ can group by
+GROUP_COLUMNS = ("purpose", "mode", "outcome", "model", "day")
+
+
+def load_pricing(raw: str) -> Dict[str, Dict[str, float]]:
+    """
+    Per-model prices from a JSON object such as
+    {"<model id>": {"input_per_1k": 0.0015, "output_per_1k": 0.002}} (any currency,
+    per 1,000 tokens). Empty means no prices: usage is recorded without cost.
+    """
+    if not raw.strip():
+        return {}
+    pricing = json.loads(raw)
+    for model, prices in pricing.items():
+        missing = {"input_per_1k", "output_per_1k"} - set(prices)
+        if missing:
+            raise ValueError(f"Pricing for {model} lacks {', '.join(sorted(missing))}")
+    return {model: {kind: float(prices[kind]) for kind in ("input_per_1k", "output_per_1k")}
+            for model, prices in pricing.items()}
+
+
+def call_cost(pricing: Dict[str, Dict[str, float]], model: str, input_tokens: int, output_tokens: int) -> Optional[float]:
+    """Cost of one call at the model's prices; None when the model has no price."""
+    prices = pricing.get(model)
+    if prices is None:
+        return None
+    return round(
+        ((input_tokens or 0) * prices["input_per_1k"] + (output_tokens or 0) * prices["output_per_1k"]) / 1000, 8
+    )
+
+
+@contextmanager
+def collect_usage():
+    """
+    Collect the usage records of every LLM call made in this block (including calls
+    on threads that carry its context): `with collect_usage() as usage: ...`.
+    The caller persists them with insert_usage().
+    """
+    usage: List[Dict[str, Any]] = []
+    token = _USAGE.set(usage)
+    try:
+        yield usage
+    finally:
+        _USAGE.reset(token)
+
+
+def current_usage() -> Optional[List[Dict[str, Any]]]:
+    return _USAGE.get()
+
+
+def record_usage(
+    purpose: str,
+    mode: str,
+    latency: float,
+    input_tokens: int = 0,
+    output_tokens: int = 0,
+    total_tokens: int = None,
+    tokens_estimated: bool = False,
+    cached: bool = False,
+    outcome: str = "success",
+    model: str = None,
+    cost: float = None,
+) -> None:
+    """
+    Add one LLM call to the current collection (no-op outside collect_usage()).
+    cost is None when the model has no configured price.
+    """
+    usage = _USAGE.get()
+    if usage is None:
+        return
+    usage.append({
+        "purpose": purpose,
+        "mode": mode,
+        "outcome": outcome,
+        "cached": int(cached),
+        "input_tokens": input_tokens or 0,
+        "output_tokens": output_tokens or 0,
+        "total_tokens": total_tokens if total_tokens is not None else (input_tokens or 0) + (output_tokens or 0),
+        "tokens_estimated": int(tokens_estimated),
+        "latency_ms": round(latency * 1000, 1),
+        "model": model,
+        "cost": cost,
+        "request_id": current_request_id(),
+        "created_at": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+    })
+
+
+def insert_usage(cursor, document_id: Optional[int], usage: List[Dict[str, Any]]) -> None:
+    """Store usage records; document_id is None for calls that produced no document."""
+    cursor.executemany(
+        f"""
+        INSERT INTO llm_usage (document_id, {", ".join(USAGE_COLUMNS)})
+        VALUES (?, {", ".join("?" * len(USAGE_COLUMNS))})
+        """,
+        [(document_id, *(record[column] for column in USAGE_COLUMNS)) for record in usage],
+    )
+
+
+def usage_summary(
+    cursor,
+    group_by: str = "purpose",
+    created_from: str = None,
+    created_to: str = None,
+    document_id: int = None,
+) -> Dict[str, Any]:
+    """
+    Calls, tokens, cost and latency per group_by value, plus totals and per-document
+    averages. Cache hits are counted as calls but carry no tokens or cost; calls to a
+    model without a configured price count in unpriced_calls and add nothing to cost.
+    """
+    clauses, params = [], []
+    if created_from:
+        clauses.append("created_at >= ?")
+        params.append(created_from)
+    if created_to:
+        clauses.append("created_at <= ?")
+        params.append(created_to if len(created_to) > 10 else f"{created_to} 23:59:59")
+    if document_id is not None:
+        clauses.append("document_id = ?")
+        params.append(document_id)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    key = "substr(created_at, 1, 10)" if group_by == "day" else group_by
+
+    aggregates = """
+        COUNT(*), SUM(cached), SUM(outcome = 'error'),
+        SUM(input_tokens), SUM(output_tokens), SUM(total_tokens), SUM(tokens_estimated),
+        AVG(CASE WHEN cached = 0 THEN latency_ms END), MAX(latency_ms), SUM(latency_ms),
+        SUM(cost), SUM(cost IS NULL AND cached = 0 AND outcome = 'success')
+    """
+    names = (
+        "calls", "cached_calls", "errors", "input_tokens", "output_tokens", "total_tokens",
+        "estimated_calls", "avg_latency_ms", "max_latency_ms", "total_latency_ms", "cost", "unpriced_calls",
+    )
+
+    def _row(values) -> Dict[str, Any]:
+        # SUM/MAX over no rows are NULL; AVG stays None when every call was a cache hit
+        row = {name: value or 0 for name, value in zip(names, values)}
+        row["avg_latency_ms"] = round(values[7], 1) if values[7] is not None else None
+        for name in ("max_latency_ms", "total_latency_ms"):
+            row[name] = round(row[name], 1)
+        row["cost"] = round(row["cost"], 6)
+        return row
+
+    cursor.execute(f"SELECT {key}, {aggregates} FROM llm_usage {where} GROUP BY 1 ORDER BY 7 DESC", params)
+    groups = [{group_by: values[0], **_row(values[1:])} for values in cursor.fetchall()]
+
+    cursor.execute(f"SELECT {aggregates}, COUNT(DISTINCT document_id) FROM llm_usage {where}", params)
+    values = cursor.fetchone()
+    totals = _row(values[:-1])
+    documents = values[-1]
+    per_document = None
+    if documents:
+        cursor.execute(
+            f"""
+            SELECT AVG(calls), AVG(tokens), AVG(latency), AVG(cost) FROM (
+                SELECT COUNT(*) AS calls, SUM(total_tokens) AS tokens, SUM(latency_ms) AS latency,
+                       TOTAL(cost) AS cost
+                FROM llm_usage {where} {"AND" if where else "WHERE"} document_id IS NOT NULL
+                GROUP BY document_id
+            )
+            """,
+            params,
+        )
+        calls, tokens, latency, cost = cursor.fetchone()
+        per_document = {
+            "documents": documents,
+            "avg_calls": round(calls, 2),
+            "avg_total_tokens": round(tokens, 1),
+            "avg_llm_latency_ms": round(latency, 1),
+            "avg_cost": round(cost, 6),
+        }
+    return {"group_by": group_by, "groups": groups, "totals": totals, "per_document": per_document}